@@ -252,9 +252,9 @@ class PrecompositeBifunctor(Bifunctor):
 
   def variables(self):
     result = []
-    result.extend(self.left.variables)
-    result.extend(self.right.variables)
-    result.extend(self.bifunctor.variables)
+    result.extend(self.left.variables())
+    result.extend(self.right.variables())
+    result.extend(self.bifunctor.variables())
     return result
 
   def _liftLeft(self, B):
@@ -317,11 +317,11 @@ class Join(endofunctor.Endofunctor):
 
   # self must be covariant()
   # f takes each object x to a list f(x)
-  # return a list of all triples [(B, nt, y)] such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform self -> (B|.) o self
   #   y is in f(B)
   def importFiltered(self, f):
-    return []
+    return iter([])
   # self must be covariant()
   # return a function representing a natural transform: F o (B|.) --> (B|.) o F
   def _import(self, B):
@@ -1,8 +1,12 @@
 # Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
 
+import bisect
+import itertools
+
 from misc import *
 from calculus.basic import formula
-from calculus.basic.instantiator import FinishedInstantiatingException
+from calculus.basic.traversal import fold
+from calculus.basic import instantiator
 
 class UnliftableException(Exception):
   def __init__(self, functor, B):
@@ -18,31 +22,165 @@ class UnimportableException(Exception):
   def __str__(self):
     return "UnimportableException: can't import %s from %s"%(self.formula, self.endofunctor)
 
+# A natural transform, given by its components.
+# functor: the functor whose method built the transform.
+# kind: the name of that method, e.g. '_import'.
+# B: the formula that method was given.
+# component: a function taking objects to the component of the transform at them.
+# Each component is computed the first time it is needed and is then reused, so applying
+# the transform to the same objects twice gives the same arrow.  At most maxComponents
+# components are kept, so a transform living as long as a shared formula such as true does
+# not keep alive the objects of every proof it was applied in.
+# Likewise, at most maxTransforms transforms are kept for each B, so a shared B does not keep
+# alive every functor it was ever imported into or exported from.
+class NaturalTransform(object):
+  maxComponents = 64
+  maxTransforms = 16
+
+  def __init__(self, functor, kind, B, component):
+    self.functor = functor
+    self.kind = kind
+    self.B = B
+    self._component = component
+    # A dictionary mapping the ids of a tuple of objects to the pair (objects, component).
+    # The objects are kept so that their ids are not reused.
+    self._components = {}
+
+  def __repr__(self):
+    return "%s.%s(%s)"%(self.functor, self.kind, self.B)
+
+  def __call__(self, *xs):
+    key = tuple([id(x) for x in xs])
+    try:
+      return self._components[key][1]
+    except KeyError:
+      result = self._component(*xs)
+      if len(self._components) >= self.maxComponents:
+        self._components.clear()
+      self._components[key] = (xs, result)
+      return result
+
+  # return: a list of the pairs (xs, arrow) such that arrow is the component of self at xs,
+  #         for each component computed so far.
+  def components(self):
+    return self._components.values()
+
+# method: a method of a functor taking a formula B to a function representing a natural
+#         transform.
+# return: a method returning the same natural transform as a NaturalTransform.  The
+#         transform is built once for each functor and each B, and is then reused.
+# The transforms are cached on B rather than on the functor, since functors such as
+# identity_functor live as long as the program.  A transform is freed along with B, or when
+# B has more than NaturalTransform.maxTransforms of them.
+# The transforms can not hold their functors weakly, since their components refer to them.
+def naturalTransform(method):
+  kind = method.__name__
+  def transform(self, B):
+    try:
+      transforms = B._transforms
+    except AttributeError:
+      transforms = B._transforms = {}
+    # The transform keeps self, so its id is not reused.
+    key = (kind, id(self))
+    try:
+      return transforms[key]
+    except KeyError:
+      # The method may raise an exception, in which case nothing is cached.
+      result = NaturalTransform(self, kind, B, method(self, B))
+      if len(transforms) >= NaturalTransform.maxTransforms:
+        transforms.clear()
+      transforms[key] = result
+      return result
+  transform.__name__ = kind
+  return transform
+
 class Endofunctor:
   def variables(self):
     raise Exception("Abstract superclass.")
 
+  # return: the bitset of the ids of the variables v such that self refuses to import or
+  #         lift past it any formula in which v is free.
+  def blockedVariables(self):
+    return 0
+
   # self must be covariant()
   # f takes each object x to a list f(x)
-  # return a list of all triples [(B, nt, y)] such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform self -> (B|.) o self
   #   y is in f(B)
+  # The triples are produced lazily, so a caller that stops early does no work
+  # for the triples it never asks for.
   def importFiltered(self, f):
-    return []
+    return iter([])
   # self must not be covariant()
   # f takes each object x to a list f(x)
-  # return a list of all triples [(B, nt, y)] such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform (B|.) o self -> self
   #   y is in f(B)
   def exportFiltered(self, f):
-    return []
+    return iter([])
+
+  # self must be covariant()
+  # limit: None, or the largest number of triples to return.
+  # return a list of the first limit triples of self.importFiltered(f),
+  #   or of all of them when limit is None.
+  def importFilteredList(self, f, limit = None):
+    return list(itertools.islice(self.importFiltered(f), limit))
+  # self must not be covariant()
+  # limit: None, or the largest number of triples to return.
+  # return a list of the first limit triples of self.exportFiltered(f),
+  #   or of all of them when limit is None.
+  def exportFilteredList(self, f, limit = None):
+    return list(itertools.islice(self.exportFiltered(f), limit))
+
+  # self must be covariant()
+  # return: a dictionary whose keys are the formulas B in the triples of self.importFiltered.
+  #   The dictionary is computed at most once for each functor, and a composite builds its
+  #   dictionary from those of its components, so an exact import is a single lookup.
+  def importIndex(self):
+    try:
+      return self._importIndex
+    except AttributeError:
+      self._importIndex = self._computeImportIndex()
+      return self._importIndex
+  # self must not be covariant()
+  # return: a dictionary whose keys are the formulas B in the triples of self.exportFiltered.
+  def exportIndex(self):
+    try:
+      return self._exportIndex
+    except AttributeError:
+      self._exportIndex = self._computeExportIndex()
+      return self._exportIndex
+
+  # return: a dictionary mapping each formula B in the triples of self.importFiltered to the
+  #   natural transform of the first such triple.
+  def _computeImportIndex(self):
+    result = {}
+    for B, nt, X in self.importFiltered(lambda x: [x]):
+      result.setdefault(B, nt)
+    return result
+  def _computeExportIndex(self):
+    result = {}
+    for B, nt, X in self.exportFiltered(lambda x: [x]):
+      result.setdefault(B, nt)
+    return result
+
+  # B: a key of self.importIndex()
+  # entry: self.importIndex()[B]
+  # return: the natural transform of the first triple of self.importFiltered for B.
+  def _importIndexed(self, B, entry):
+    return entry
+  def _exportIndexed(self, B, entry):
+    return entry
   # self must be covariant()
   # return a function representing a natural transform: F o (B|.) --> (B|.) o F
+  @naturalTransform
   def _import(self, B):
     raise Exception("Abstract superclass.")
 
   # self must be covariant()
   # return a function representing a natural transform: F o (.|B) --> (.|B) o F
+  @naturalTransform
   def _importOther(self, B):
     # F(x)|B --> B|F(x) --> F(B|x) --> F(x|B)
     return (lambda x:
@@ -53,12 +191,14 @@ class Endofunctor:
 
   # self must not be covariant()
   # return a function representing some natural transform: (B|.) o F o (B|.) --> F
+  @naturalTransform
   def _export(self, B):
     raise Exception("Abstract superclass.")
 
   # self must be covariant
   # return a function representing some natural transform: (B|.) o F --> F o (B|.) if possible
   #  otherwise, throw an UnliftableException
+  @naturalTransform
   def lift(self, B):
     raise UnliftableException(self, B)
   # return a (its tgt, function represention some natural transform:
@@ -105,36 +245,22 @@ class Endofunctor:
   # return: a a natural transform self -> (B|.) o self
   #    or raise an UnimportableException if no such natural transform exists.
   def importExactly(self, e):
-    def f(x):
-      if x == e:
-        return ['dummy']
-      else:
-        return []
-    result = self.importFiltered(f)
-    if len(result) == 0:
+    index = self.importIndex()
+    if e not in index:
       raise UnimportableException(formula = e, endofunctor = self)
     else:
-      (B, nt, y) = result[0]
-      assert(B == e)
-      return nt
+      return self._importIndexed(e, index[e])
 
   # self must be contravariant
   # B: a formula
   # return: a a natural transform (B|.) o self -> self
   #    or raise an UnimportableException if no such natural transform exists.
   def exportExactly(self, B):
-    def f(x):
-      if x == B:
-        return ['dummy']
-      else:
-        return []
-    result = self.exportFiltered(f)
-    if len(result) == 0:
+    index = self.exportIndex()
+    if B not in index:
       raise UnimportableException(formula = B, endofunctor = self)
     else:
-      (also_B, nt, y) = result[0]
-      assert(also_B == B)
-      return nt
+      return self._exportIndexed(B, index[B])
 
   # self must be contravariant
   # x: a formula
@@ -177,31 +303,44 @@ class Endofunctor:
       assert(side == right)
       return self.exportRight(x)
 
-  # instantiator: an instantiator instance
-  # formula: a basic formula
-  # return: an arrow: self(formula) --> self(t) where variables are substituted in t
-  #   and claims are exported from t according to instantiator.
-  def exportRecursively(self, instantiator, x):
+  # plan: an InstantiationPlan whose steps all apply to the binders at the front of x.
+  # x: a basic formula
+  # return: a pair (arrow, y) where arrow: self(x) --> self(y) applies every step of plan.
+  # A run of consecutive instantiations is composed inside self and lifted through self once.
+  def exportByPlan(self, plan, x):
     assert(not self.covariant())
-    if x.__class__ == formula.Not:
-      return self.onArrow(x.identity())
-    elif x.__class__ == formula.Exists:
-      try:
-        v = instantiator.instantiate(x.variable, self, x.value)
-      except FinishedInstantiatingException:
-        return self.onObject(x).identity()
-      arrow = x.backwardIntroExists(v)
-      return self.onArrow(arrow).forwardCompose(
-          self.exportRecursively(instantiator, arrow.src))
-    elif x.__class__ == formula.And:
-      try:
-        side = instantiator.exportSide(x, self)
-      except FinishedInstantiatingException:
-        return self.onObject(x).identity()
-      return self.exportSide(side, x).forwardCompose(
-          self.exportRecursively(instantiator, x.getOtherSide(side)))
-    else:
-      return self.onObject(x).identity()
+    arrows = []
+    inner = None
+    for kind, value in plan.steps:
+      if kind == instantiator.instantiateStep:
+        assert(x.__class__ == formula.Exists)
+        arrow = x.backwardIntroExists(value)
+        if inner is None:
+          inner = arrow
+        else:
+          inner = arrow.forwardCompose(inner)
+        x = arrow.src
+      else:
+        assert(kind == instantiator.exportStep)
+        assert(x.__class__ == formula.And)
+        if inner is not None:
+          arrows.append(self.onArrow(inner))
+          inner = None
+        arrows.append(self.exportSide(value, x))
+        x = x.getOtherSide(value)
+    if inner is not None:
+      arrows.append(self.onArrow(inner))
+    if len(arrows) == 0:
+      return self.onObject(x).identity(), x
+    result = arrows[0]
+    for arrow in arrows[1:]:
+      result = result.forwardCompose(arrow)
+    return result, x
+
+  # self must not be covariant()
+  # return: True iff self.exportExactly(B) would find a natural transform.
+  def exportable(self, B):
+    return B in self.exportIndex()
 
   # x: a nested And formula of the form (A|(B|(C|(D|E))))
   # limit: an integer which is less than or equal to the depth of the nesting.
@@ -209,46 +348,48 @@ class Endofunctor:
   # return: a pair (xs, a) where a is an arrow which exports certain of the claims A, B, C, D, E
   #         where xs is a list of booleans indicating which claims were exported, and where len(xs) <= limit.
   #         A claim c is exported iff f(c) == True and it is exportable.
+  # The claims are visited once each, in order.  A claim that is not exported becomes a layer
+  # of the functor through which later claims are exported, and whether a claim is exportable
+  # is read from the index of that functor.
   def exportNestedAnd(self, x, limit, f):
     assert(not self.covariant())
-    if limit == 0:
-      return [], self.onObject(x).identity()
-    else:
-      if limit > 1:
+    xs = []
+    arrows = []
+    functor = self
+    for i in range(limit):
+      if i < limit - 1:
         assert(x.__class__ == formula.And)
-        b = f(x.left)
-        try:
-          if b:
-            arrow = self.exportLeft(x)
-          else:
-            raise UnimportableException(x, self)
-        except UnimportableException:
-          larger_functor = And(side = right, other = x.left).compose(self)
-          xs, rest_arrow = larger_functor.exportNestedAnd(x.right, limit-1, f)
-          ys = [False]
-          ys.extend(xs)
-          return ys, rest_arrow
-        xs, rest_arrow = self.exportNestedAnd(x.right, limit-1, f)
-        ys = [True]
-        ys.extend(xs)
-        return ys, arrow.forwardCompose(rest_arrow)
+        claim = x.left
       else:
-        assert(limit == 1)
-        b = f(x)
-        try:
-          if b:
-            arrow = self.exportBottom(x)
-          else:
-            raise UnimportableException(x, self)
-        except UnimportableException:
-          return [False], self.onObject(x).identity()
-        return [True], arrow
+        claim = x
+      arrow = None
+      if f(claim) and functor.exportable(claim):
+        if i < limit - 1:
+          arrow = functor.exportLeft(x)
+        else:
+          arrow = functor.exportBottom(x)
+      xs.append(arrow is not None)
+      if arrow is not None:
+        arrows.append(arrow)
+      if i < limit - 1:
+        if arrow is None:
+          functor = And(side = right, other = x.left).compose(functor)
+        x = x.right
+      elif arrow is None:
+        arrows.append(functor.onObject(x).identity())
+    if limit == 0:
+      arrows.append(self.onObject(x).identity())
+    result = arrows[0]
+    for arrow in arrows[1:]:
+      result = result.forwardCompose(arrow)
+    return xs, result
 
 class Exists(Endofunctor):
   def __init__(self, variable):
     self.variable = variable
   def __repr__(self):
     return "Exists(%s)"%(self.variable,)
+  @naturalTransform
   def _import(self, B):
     if self.variable in B.freeVariables():
       raise Exception("Variable %s should not be free in %s. When importing through %s"%(self.variable, B, self))
@@ -263,6 +404,7 @@ class Exists(Endofunctor):
   def negations(self):
     return 0
 
+  @naturalTransform
   def lift(self, B):
     if self.variable in B.freeVariables():
       raise UnliftableException(self, B)
@@ -273,6 +415,7 @@ class Exists(Endofunctor):
 class Always(Endofunctor):
   def __repr__(self):
     return "!"
+  @naturalTransform
   def _import(self, B):
     # B|!X --> !(B|X) (not always possible!)
     # but when   B == !C
@@ -308,6 +451,7 @@ class Not(Endofunctor):
     return "~"
   # self must not be covariant()
   # return a function representing some natural transform: (B|.) o F o (B|.) --> F
+  @naturalTransform
   def _export(self, b):
     bAnd = lambda x: formula.And(left = b, right = x)
     return (lambda x:
@@ -327,11 +471,13 @@ not_functor = Not()
 class Id(Endofunctor):
   def __repr__(self):
     return "ID"
+  @naturalTransform
   def _import(self, B):
     # Id o (B|.) --> (B|.) o Id
     # (B|x) --> (B|x)
     return (lambda x:
         formula.And(left = B, right = x).identity())
+  @naturalTransform
   def lift(self, B):
     return (lambda x: formula.And(left = B, right = x).identity())
   def variables(self):
@@ -347,22 +493,147 @@ class Id(Endofunctor):
 
 identity_functor = Id()
 
-class Composite(Endofunctor):
-  # if right is covariant, self will represent (left o right)
-  # otherwise secod is contravariant, and self will represent (oppositeFunctor(left) o right)
-  def __init__(self, left, right):
-    self.left = left
-    self.right = right
+# if right is covariant, the result will represent (left o right)
+# otherwise secod is contravariant, and the result will represent (oppositeFunctor(left) o right)
+def Composite(left, right):
+  if right.__class__ == FunctorChain and right._length == len(right._layers.functors):
+    layers = right._layers
+  else:
+    layers = _Layers()
+    layers.extend(right)
+  layers.extend(left)
+  return layers.chain(len(layers.functors))
+
+# The layers of a composite functor, outermost first, with the sums over each prefix that
+# let a composite of the first n layers answer questions about itself in O(1) time.
+# Layers are only ever appended, so composites of different lengths may share one _Layers.
+class _Layers(object):
+  def __init__(self):
+    # functors[i] is applied after functors[i + 1].  No functor is a FunctorChain.
+    self.functors = []
+    # contravariantCounts[i]: the number of contravariant functors among
+    #                         functors[0] ... functors[i]
+    self.contravariantCounts = []
+    # The variables of each functor, in reverse, appended in the order of the functors.
+    self.variables = []
+    # variableCounts[i]: the number of variables of functors[0] ... functors[i]
+    self.variableCounts = []
+    # claims: a dictionary mapping each formula importable or exportable through one of the
+    #         first self.indexed functors to the ascending list of the positions of those
+    #         functors.  It is extended only when a lookup needs it.
+    self.claims = {}
+    self.indexed = 0
+    # blockers: the ascending list of the positions of the functors with blocked variables.
+    # blockedVariables[i]: the blockedVariables() of functors[blockers[i]]
+    self.blockers = []
+    self.blockedVariables = []
+    # chains[i]: None, or the FunctorChain of the first i functors.
+    self.chains = []
+
+  # functor: a functor other than the identity.
+  # Append the layers of functor, outermost first.
+  def extend(self, functor):
+    if functor.__class__ == FunctorChain:
+      for i in range(functor._length):
+        self.append(functor._layers.functors[i])
+    else:
+      self.append(functor)
+
+  def append(self, functor):
+    if len(self.functors) == 0:
+      contravariant = 0
+      variables = 0
+    else:
+      contravariant = self.contravariantCounts[-1]
+      variables = self.variableCounts[-1]
+    self.functors.append(functor)
+    if functor.covariant():
+      self.contravariantCounts.append(contravariant)
+    else:
+      self.contravariantCounts.append(contravariant + 1)
+    functorVariables = list(functor.variables())
+    functorVariables.reverse()
+    self.variables.extend(functorVariables)
+    self.variableCounts.append(variables + len(functorVariables))
+    blocked = functor.blockedVariables()
+    if blocked != 0:
+      self.blockers.append(len(self.functors) - 1)
+      self.blockedVariables.append(blocked)
+
+  # length: at least 2.
+  # return: the chain of the first length functors.  Each chain is built only once, so
+  #         that what it caches is shared by all its uses.
+  def chain(self, length):
+    while len(self.chains) <= length:
+      self.chains.append(None)
+    if self.chains[length] is None:
+      self.chains[length] = FunctorChain(self, length)
+    return self.chains[length]
+
+  # Extend self.claims to cover the first length functors.
+  def index(self, length):
+    while self.indexed < length:
+      functor = self.functors[self.indexed]
+      if functor.covariant():
+        index = functor.importIndex()
+      else:
+        index = functor.exportIndex()
+      for claim in index:
+        self.claims.setdefault(claim, []).append(self.indexed)
+      self.indexed += 1
+
+  # return: the position of the innermost of the first length functors through which B
+  #         can be imported or exported, or None if there is no such functor.
+  #         B is imported or exported past the functors inside that position, so None is
+  #         also returned when one of them blocks a variable free in B.
+  def claimPosition(self, B, length):
+    self.index(length)
+    positions = self.claims.get(B, [])
+    i = bisect.bisect_left(positions, length)
+    if i == 0:
+      return None
+    position = positions[i - 1]
+    j = bisect.bisect_right(self.blockers, position)
+    while j < len(self.blockers) and self.blockers[j] < length:
+      if self.blockedVariables[j] & B.freeVariables().bits != 0:
+        return None
+      j += 1
+    return position
+
+# F o G o ... o Z
+# The composite of a sequence of at least two functors, none of which are FunctorChains.
+# Chains are immutable, but chains may share their _Layers: a chain consists of the first
+# self._length layers.  A chain that uses all of its layers may append to them in place,
+# so a chain of n functors is built by n compositions in O(n) time.
+class FunctorChain(Endofunctor):
+  def __init__(self, layers, length):
+    assert(length >= 2)
+    self._layers = layers
+    self._length = length
+
+  # return: the composite of the first length layers of self.
+  def _prefix(self, length):
+    if length == 1:
+      return self._layers.functors[0]
+    else:
+      return self._layers.chain(length)
+
+  # Chains present the interface of a binary composite, in which left is applied first
+  # and right is applied to the result.  Each of these takes O(1) time.
+  @property
+  def left(self):
+    return self._layers.functors[self._length - 1]
+  @property
+  def right(self):
+    return self._prefix(self._length - 1)
 
   def __repr__(self):
-    return "%s\no\n%s"%(self.left, self.right)
+    return "\no\n".join([repr(self._layers.functors[i]) for i in range(self._length - 1, -1, -1)])
 
   def covariant(self):
-    if self.left.covariant():
-      return self.right.covariant()
-    else:
-      return not self.right.covariant()
+    return 0 == (self.negations() % 2)
 
+  @naturalTransform
   def lift(self, B):
     # One of the following two calls may throw an exception, pass it on.
     left = self.left.lift(B)
@@ -395,6 +666,7 @@ class Composite(Endofunctor):
         return ('full', lambda x: self.right.onArrow(nt0(x)).forwardCompose(
                           nt1(self.left.onObject(x))))
 
+  @naturalTransform
   def _import(self, B):
     if self.right.covariant():
       assert(self.left.covariant())
@@ -412,6 +684,7 @@ class Composite(Endofunctor):
           G_o_BAnd.onArrow(self.left._export(B)(x)).forwardCompose(
             self.right._export(B)(self.left.onObject(bAnd.onObject(x)))))
 
+  @naturalTransform
   def _export(self, B):
     bAnd = And(side = right, other = B)
     if self.right.covariant():
@@ -428,35 +701,57 @@ class Composite(Endofunctor):
           bAnd.onArrow(self.right.onArrow(self.left._import(B)(x))).forwardCompose(
             self.right._export(B)(self.left.onObject(x))))
 
+  # nt: a natural transform F -> H, where self.left is F.
+  # return: the natural transform F o G -> H o G, where self.right is G.
+  def _throughRight(self, nt):
+    return (lambda x: self.right.onArrow(nt(x)))
+
+  # nt: a natural transform G -> (B|.) o G
+  # return: a natural transform F o G --> F o ((B|.) o G) --> (B|.) o F o G
+  def _importPastLeft(self, B, nt):
+    return (lambda x: nt(self.left.onObject(x)).forwardCompose(
+        self.right.onArrow(self.left._import(B)(x))))
+
+  # nt: a natural transform (B|.) o G -> G
+  # return: a natural transform
+  #   F o G --> ((B|.) o F o (B|.)) o G = ((B|.) o F) o ((B|.) o G) --> ((B|.) o F) o G
+  def _importPastLeftExporting(self, B, nt):
+    return (lambda x: self.right.onArrow(self.left._export(B)(x)).forwardCompose(
+        nt(self.left.onObject(formula.And(B, x)))))
+
+  # nt: a natural transform G -> (B|.) o G
+  # return: a natural transform (B|.) o F o G --> (B|.) o F o (B|.) o G --> F o G
+  def _exportPastLeftImporting(self, B, nt):
+    return (lambda x: nt(self.left.onObject(formula.And(B, x))).forwardCompose(
+        self.right.onArrow(self.left._export(B)(x))))
+
+  # nt: a natural transform (B|.) o G -> G
+  # return: a natural transform (B|.) o F o G --> F o (B|.) o G --> F o G
+  def _exportPastLeft(self, B, nt):
+    return (lambda x: self.right.onArrow(self.left._import(B)(x)).forwardCompose(
+        nt(self.left.onObject(x))))
+
   def importFilteredCovariantCovariant(self, f):
     assert(self.left.covariant())
     assert(self.right.covariant())
-    result = []
     # F o G --> ((B|.) o F) o G
-    result.extend([(B, lambda x, nt=nt: self.right.onArrow(nt(x)), X)
-                   for B, nt, X in self.left.importFiltered(f)])
-    # F o G --> F o ((B|.) o G) --> (B|.) o F o G
-    result.extend([(B, lambda x, B=B, nt=nt: nt(self.left.onObject(x)).forwardCompose(
-                                 self.right.onArrow(self.left._import(B)(x))), X)
-                    for B, nt, X in self.right.importFiltered(f)])
-    return result
+    for B, nt, X in self.left.importFiltered(f):
+      yield (B, self._throughRight(nt), X)
+    for B, nt, X in self.right.importFiltered(f):
+      yield (B, self._importPastLeft(B, nt), X)
 
   def importFilteredContravariantContravariant(self, f):
     assert(not self.right.covariant())
     assert(not self.left.covariant())
-    result = []
     # F o G --> ((B|.) o F) o G
-    result.extend([(B, lambda x, nt=nt: self.right.onArrow(nt(x)), X)
-                   for B, nt, X in self.left.exportFiltered(f)])
-    # F o G --> ((B|.) o F o (B|.)) o G = ((B|.) o F) o ((B|.) o G) --> ((B|.) o F) o G
-    result.extend([(B, lambda x, B=B, nt=nt: self.right.onArrow(self.left._export(B)(x)).forwardCompose(
-                                nt(self.left.onObject(formula.And(B, x)))), X)
-                   for B, nt, X in self.right.exportFiltered(f)])
-    return result
+    for B, nt, X in self.left.exportFiltered(f):
+      yield (B, self._throughRight(nt), X)
+    for B, nt, X in self.right.exportFiltered(f):
+      yield (B, self._importPastLeftExporting(B, nt), X)
 
   # self must be covariant()
   # f takes each object x to a list f(x)
-  # return a list of all triples [(B, nt, y)] such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform self -> (B|.) o self
   #   y is in f(B)
   def importFiltered(self, f):
@@ -469,32 +764,24 @@ class Composite(Endofunctor):
   def exportFilteredContravariantCovariant(self, f):
     assert(self.right.covariant())
     assert(not self.left.covariant())
-    result = []
     # (B|.) o F o G --> F o G
-    result.extend([(B, lambda x, nt=nt: self.right.onArrow(nt(x)), X)
-                   for B, nt, X in self.left.exportFiltered(f)])
-    # (B|.) o F o G --> (B|.) o F o (B|.) o G --> F o G
-    result.extend([(B, lambda x, B=B, nt=nt: nt(self.left.onObject(formula.And(B, x))).forwardCompose(
-                                 self.right.onArrow(self.left._export(B)(x))), X)
-                   for B, nt, X in self.right.importFiltered(f)])
-    return result
+    for B, nt, X in self.left.exportFiltered(f):
+      yield (B, self._throughRight(nt), X)
+    for B, nt, X in self.right.importFiltered(f):
+      yield (B, self._exportPastLeftImporting(B, nt), X)
 
   def exportFilteredCovariantContravariant(self, f):
     assert(self.left.covariant())
     assert(not self.right.covariant())
-    result = []
     # (B|.) o F o G --> F o G
-    result.extend([(B, lambda x, nt=nt: self.right.onArrow(nt(x)), X)
-                   for B, nt, X in self.left.importFiltered(f)])
-    # (B|.) o F o G --> F o (B|.) o G --> F o G
-    result.extend([(B, lambda x, B=B, nt=nt: self.right.onArrow(self.left._import(B)(x)).forwardCompose(
-                                 nt(self.left.onObject(x))), X)
-                   for B, nt, X in self.right.exportFiltered(f)])
-    return result
+    for B, nt, X in self.left.importFiltered(f):
+      yield (B, self._throughRight(nt), X)
+    for B, nt, X in self.right.exportFiltered(f):
+      yield (B, self._exportPastLeft(B, nt), X)
 
   # self must not be covariant()
   # f takes each object x to a list f(x)
-  # return a list of all triples [(B, nt, y)] such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform (B|.) o self -> self
   #   y is in f(B)
   def exportFiltered(self, f):
@@ -503,19 +790,90 @@ class Composite(Endofunctor):
     else:
       return self.exportFilteredCovariantContravariant(f)
 
+  # nt: a natural transform through self.right, as given by
+  #     self.right.importExactly(B) when self.right.covariant(),
+  #     and by self.right.exportExactly(B) otherwise.
+  # return: the corresponding natural transform through self.
+  def _throughLeft(self, B, nt):
+    if self.covariant():
+      if self.right.covariant():
+        return self._importPastLeft(B, nt)
+      else:
+        return self._importPastLeftExporting(B, nt)
+    else:
+      if self.right.covariant():
+        return self._exportPastLeftImporting(B, nt)
+      else:
+        return self._exportPastLeft(B, nt)
+
+  # Imports and exports look B up in the index of the layers, and then build the natural
+  # transform outwards from the innermost layer importing or exporting B.
+  def _exactly(self, B):
+    position = self._layers.claimPosition(B, self._length)
+    if position is None:
+      raise UnimportableException(formula = B, endofunctor = self)
+    functor = self._layers.functors[position]
+    if functor.covariant():
+      nt = functor.importExactly(B)
+    else:
+      nt = functor.exportExactly(B)
+    if position > 0:
+      nt = self._prefix(position + 1)._throughRight(nt)
+    for length in range(position + 2, self._length + 1):
+      nt = self._prefix(length)._throughLeft(B, nt)
+    return nt
+
+  def importExactly(self, e):
+    assert(self.covariant())
+    return self._exactly(e)
+
+  def exportExactly(self, B):
+    assert(not self.covariant())
+    return self._exactly(B)
+
+  # The index of a chain maps each formula to the position of the layer it is imported or
+  # exported from.  It is computed from the index of the layers on each call, since
+  # importExactly and exportExactly do not use it.
+  def _index(self):
+    self._layers.index(self._length)
+    result = {}
+    for B in self._layers.claims.keys():
+      position = self._layers.claimPosition(B, self._length)
+      if position is not None:
+        result[B] = position
+    return result
+
+  def exportable(self, B):
+    assert(not self.covariant())
+    return self._layers.claimPosition(B, self._length) is not None
+
+  def importIndex(self):
+    assert(self.covariant())
+    return self._index()
+  def exportIndex(self):
+    assert(not self.covariant())
+    return self._index()
+
   def variables(self):
-    result = list(self.left.variables())
-    result.extend(self.right.variables())
+    count = self._layers.variableCounts[self._length - 1]
+    result = self._layers.variables[:count]
+    result.reverse()
     return result
   def pop(self):
     (a, b) = self.left.pop()
     return (a, b.compose(self.right))
   def onObject(self, object):
-    return self.right.onObject(self.left.onObject(object))
+    for i in range(self._length - 1, -1, -1):
+      object = self._layers.functors[i].onObject(object)
+    return object
   def onArrow(self, arrow):
-    return self.right.onArrow(self.left.onArrow(arrow))
+    for i in range(self._length - 1, -1, -1):
+      arrow = self._layers.functors[i].onArrow(arrow)
+    return arrow
+  # return: the number of contravariant layers, which has the parity of the number of
+  #         negations.
   def negations(self):
-    return self.left.negations() + self.right.negations()
+    return self._layers.contravariantCounts[self._length - 1]
 
 class Conjunction(Endofunctor):
   def __init__(self, side, other):
@@ -562,6 +920,7 @@ class And(Conjunction):
   def stringDivider(self):
     return "|"
 
+  @naturalTransform
   def lift(self, B):
     if self.side == left:
       # (B|x)|Y --> B|(x|Y)
@@ -587,6 +946,7 @@ class And(Conjunction):
       # (Exists variable .) o (B|.) -> (B|.) o (Exists variable .)
       return ('full', lambda x: self.onObject(formula.Exists(variable, x)).forwardAndPastExists())
 
+  @naturalTransform
   def _import(self, B):
     bAnd = And(side = right, other = B)
     if self.side == left:
@@ -601,30 +961,42 @@ class And(Conjunction):
               x.forwardOnRightFollow(lambda x:
                 x.forwardCommute()))))
 
+  # Only the claims are listed, and the natural transform for a claim is built when it
+  # is first imported.
+  def _computeImportIndex(self):
+    return dict.fromkeys(self.other.producibleClaims(), None)
+
+  def _importIndexed(self, B, entry):
+    for also_B, nt, X in self.importFiltered(lambda x: [None] if x == B else []):
+      return nt
+
   # self must be covariant()
   # f takes each object x to a list f(x)
-  # return a list of triples all [(B, nt, y) such that
+  # return an iterator over all triples (B, nt, y) such that
   #   nt is a natural transform self -> (B|.) o self
   #   y is in f(B)
   def importFiltered(self, f):
     if self.side == left:
       # (X|A) --> (X|(B|A)) --> ((X|B)|A) --> ((B|X)|A)
-      return [(a.tgt.left, lambda x, a=a:
-        self.onObject(x).forwardOnRight(a).forwardFollow(lambda x:
-          x.forwardAssociateOther().forwardFollow(lambda x:
-            x.forwardOnLeftFollow(lambda x:
-              x.forwardCommute()))), X) for a, X in self.other.produceFiltered(f)]
+      for a, X in self.other.produceFiltered(f):
+        yield (a.tgt.left, lambda x, a=a:
+          self.onObject(x).forwardOnRight(a).forwardFollow(lambda x:
+            x.forwardAssociateOther().forwardFollow(lambda x:
+              x.forwardOnLeftFollow(lambda x:
+                x.forwardCommute()))), X)
     else:
       # (A|X) --> ((B|A)|X) --> ((A|B)|X) --> (A|(B|X))
       assert(self.side == right)
-      return [(a.tgt.left, lambda x, a=a:
-        self.onObject(x).forwardOnLeft(a.forwardFollow(lambda x:
-          x.forwardCommute())).forwardFollow(lambda x:
-            x.forwardAssociate()), X) for a, X in self.other.produceFiltered(f)]
+      for a, X in self.other.produceFiltered(f):
+        yield (a.tgt.left, lambda x, a=a:
+          self.onObject(x).forwardOnLeft(a.forwardFollow(lambda x:
+            x.forwardCommute())).forwardFollow(lambda x:
+              x.forwardAssociate()), X)
 
 class Or(Conjunction):
   def stringDivider(self):
     return "-"
+  @naturalTransform
   def _import(self, B):
     bAnd = And(side = right, other = B)
     if self.side == left:
@@ -648,6 +1020,13 @@ class SubstituteVariable(Endofunctor):
     return "Sub(%s->%s)"%(self.oldVariable, self.newVariable)
   def variables(self):
     return []
+  def blockedVariables(self):
+    result = 0
+    for variable in [self.oldVariable, self.newVariable]:
+      if isinstance(variable, formula.Variable):
+        result |= 1 << variable._id
+    return result
+  @naturalTransform
   def _import(self, B):
     free = B.freeVariables()
     if self.oldVariable in free or self.newVariable in free:
@@ -655,6 +1034,7 @@ class SubstituteVariable(Endofunctor):
       raise UnimportableException(B, self)
     else:
       return (lambda x: formula.And(B, self.onObject(x)).identity())
+  @naturalTransform
   def lift(self, B):
     free = B.freeVariables()
     if self.oldVariable in free or self.newVariable in free:
@@ -669,42 +1049,92 @@ class SubstituteVariable(Endofunctor):
   def negations(self):
     return 0
 
-# endofunctor: an endofunctor
+# Within substitutionArrow, the substituted form of each subformula in which a is free.
+def _expandSubstituted(a):
+  def expand(x, context):
+    if a in x.freeVariables():
+      return [(y, context) for y in x._children()]
+    else:
+      return []
+  return expand
+
+def _combineSubstituted(a, b):
+  def combine(x, context, expanded, results):
+    if a not in x.freeVariables():
+      return x
+    elif len(expanded) == 0:
+      return x.substituteVariable(a, b)
+    else:
+      return x._rebuild(results)
+  return combine
+
+# endofunctor: an endofunctor through which Always(Identical(a, b)) can be imported, or
+#              exported if it is contravariant, at each subformula of x in which a is free.
 # x: a formula
 # a, b: variables
 # return: an arrow: endofunctor.onObject(x) -> endofunctor.onObject(x.substituteVariable(a, b))
+# The formula is walked once.  Each subformula is substituted once, and the substituted
+# subformulas appear both in the functors around later subformulas and in the result.
+# Subformulas in which a is not free are left alone.
 def substitutionArrow(endofunctor, x, a, b):
-  if x.__class__ == formula.And:
-    left_functor = And(side = left, other = x.right).compose(endofunctor)
-    right_functor = And(side = right, other = x.left.substituteVariable(a, b)).compose(endofunctor)
-    return substitutionArrow(left_functor, x.left, a, b).forwardCompose(
-        substitutionArrow(right_functor, x.right, a, b))
-  elif x.__class__ == formula.Or:
-    left_functor = Or(side = left, other = x.right).compose(endofunctor)
-    right_functor = Or(side = right, other = x.left.substituteVariable(a, b)).compose(endofunctor)
-    return substitutionArrow(left_functor, x.left, a, b).forwardCompose(
-        substitutionArrow(right_functor, x.right, a, b))
-  elif x.__class__ == formula.Not:
-    return substitutionArrow(not_functor.compose(endofunctor), x.value, a, b)
-  elif x.__class__ == formula.Always:
-    return substitutionArrow(always_functor.compose(endofunctor), x.value, a, b)
-  elif x.__class__ == formula.Exists:
-    assert(x.variable not in a.freeVariables())
-    assert(x.variable not in b.freeVariables())
-    return substitutionArrow(Exists(x.variable).compose(endofunctor), x.value, a, b)
-  elif x.__class__ == formula.Unit:
+  memo = {}
+  fold(x, _expandSubstituted(a), _combineSubstituted(a, b), memo = memo)
+  substituted = lambda y: memo[(id(y), None)]
+  arrows = []
+  # A stack of the pairs (functor, y) still to be substituted, leftmost last.
+  stack = [(endofunctor, x)]
+  while len(stack) > 0:
+    functor, y = stack.pop()
+    if a not in y.freeVariables():
+      continue
+    elif y.__class__ in [formula.And, formula.Or]:
+      Functor = And if y.__class__ == formula.And else Or
+      stack.append((Functor(side = right, other = substituted(y.left)).compose(functor), y.right))
+      stack.append((Functor(side = left, other = y.right).compose(functor), y.left))
+    elif y.__class__ == formula.Not:
+      stack.append((not_functor.compose(functor), y.value))
+    elif y.__class__ == formula.Always:
+      stack.append((always_functor.compose(functor), y.value))
+    elif y.__class__ == formula.Exists:
+      assert(y.variable not in a.freeVariables())
+      assert(y.variable not in b.freeVariables())
+      stack.append((Exists(y.variable).compose(functor), y.value))
+    elif y.__class__ in [formula.Holds, formula.Identical]:
+      arrows.append(holdsSubstitutionArrow(functor, y, a, b, substituted(y)))
+    else:
+      raise Exception("Unrecognized basic formula %s"%(y,))
+  if len(arrows) == 0:
     return endofunctor.onObject(x).identity()
-  elif x.__class__ == formula.Holds:
-    return holdsSubstitutionArrow(endofunctor, x, a, b)
-  else:
-    raise Exception("Unrecognized basic formula %s"%(x,))
+  result = arrows[0]
+  for arrow in arrows[1:]:
+    result = result.forwardCompose(arrow)
+  return result
 
-# endofunctor: an endofunctor
-# x: a holds formula
+# endofunctor: an endofunctor through which Always(Identical(a, b)) can be imported, or
+#              exported if it is contravariant.
+# holds: a formula, usually a holds formula
 # a, b: variables
-# return: an arrow: endofunctor.onObject(x) -> endofunctor.onObject(x.substituteVariable(a, b))
-def holdsSubstitutionArrow(endofunctor, holds, a, b):
-  assert(a not in holds.holding.freeVariables())
-  raise Exception("Not Yet Implemented.")
+# substituted: None, or holds.substituteVariable(a, b)
+# return: an arrow: endofunctor.onObject(holds) -> endofunctor.onObject(holds.substituteVariable(a, b))
+def holdsSubstitutionArrow(endofunctor, holds, a, b, substituted = None):
+  if substituted is None:
+    substituted = holds.substituteVariable(a, b)
+  claim = formula.Always(formula.Identical(a, b))
+  if endofunctor.covariant():
+    # F(x) --> F(!(a === b) | x) --> F((a === b) | x) --> F(x[a := b])
+    return endofunctor.importExactly(claim)(holds).forwardCompose(
+        endofunctor.onArrow(formula.And(claim, holds).forwardOnLeftFollow(lambda x:
+          x.forwardUnalways()).forwardFollow(lambda x:
+            x.forwardSubstituteIdentical(a, b))))
+  else:
+    # F(x) --> F(!(a === b) | x[a := b]) --> F(x[a := b])
+    # since (a === b) | x[a := b] --> x[a := b][b := a] == x
+    if b in holds.freeVariables():
+      raise Exception("Can not substitute %s for %s in %s under a contravariant functor."%(
+        b, a, holds))
+    return endofunctor.onArrow(formula.And(claim, substituted).forwardOnLeftFollow(lambda x:
+      x.forwardUnalways()).forwardFollow(lambda x:
+        x.forwardSubstituteIdentical(b, a))).forwardCompose(
+            endofunctor.exportExactly(claim)(substituted))
 
 
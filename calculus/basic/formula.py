@@ -1,34 +1,324 @@
 # Cwpyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
 
-from misc import left, right
+from misc import left, right, Slotted
 from calculus import symbol
-from calculus.variable import Variable
+from calculus.variable import Variable, BoundVariable, FreeVariables, nodeParts, binderParts
+from calculus.basic.traversal import fold
 from lib import common_symbols
 
-from sets import Set
+import weakref
+
+# Basic formulas are hash-consed: constructing a formula that is structurally identical
+# to a live formula returns the live formula instead.  Formulas are never mutated after
+# construction, so the sharing is invisible except that equality checks between
+# identical formulas succeed on their first "self is other" test.
+# Only weak references are kept, so interned formulas are freed with the proofs using them.
+_interned = weakref.WeakValueDictionary()
+
+# The functions below compute the hash parts of a formula from the parts of its immediate
+# subformulas, as in GeneralizedVariable.hashParts.  They let the hash of a formula be found
+# without building it.
+
+def holdsHashParts(held, holding):
+  return nodeParts(_holdsShape, [held.hashParts(), holding.hashParts()])
+
+# Identical is symmetric, so its hash must not depend on the order of its sides.
+def identicalHashParts(left, right):
+  return nodeParts(_identicalShape, [left.hashParts(), right.hashParts()], symmetric = True)
+
+def existsHashParts(variable, valueParts):
+  return binderParts(_existsShape, variable, valueParts)
+
+# name: the name of the class of the conjunction, 'And' or 'Or'.
+def conjunctionHashParts(name, leftParts, rightParts):
+  return nodeParts(hash(name), [leftParts, rightParts])
+
+def notHashParts(valueParts):
+  return nodeParts(_notShape, [valueParts])
+
+def alwaysHashParts(valueParts):
+  return nodeParts(_alwaysShape, [valueParts])
+
+_holdsShape = hash('Holds')
+_existsShape = hash('Exists')
+_identicalShape = hash('Identical')
+_notShape = hash('Not')
+_alwaysShape = hash('Always')
+
+# return: the hash of a formula with the given hash parts.
+def hashOfParts(parts):
+  return hash((parts[0], parts[1]))
+
+# x: a canonical formula
+# variable: a variable
+# index: a natural number
+# return: x with each free occurrence of variable replaced by BoundVariable(index)
+def _closed(x, variable, index):
+  bit = 1 << variable._id
+  if x._free & bit == 0:
+    return x
+
+  # The context of a subformula is the index of the BoundVariable that replaces variable.
+  def expand(y, index):
+    if y._free & bit == 0:
+      return []
+    elif y.__class__ == Exists:
+      return [(y.value, index + 1)]
+    else:
+      return [(z, index) for z in y._children()]
+
+  def combine(y, index, expanded, results):
+    if y._free & bit == 0:
+      return y
+    else:
+      return y._closeWith(variable, index, results)
+
+  return fold(x, expand, combine, index, {})
+
+def _expandChildren(x, context):
+  return [(y, context) for y in x._children()]
+
+def _combineRepr(x, context, expanded, results):
+  return x._reprWith(results)
+
+# Within updateVariables, the context of a subformula maps each variable bound above it to
+# the new variable that replaces it.
+def _expandUpdated(x, mapping):
+  if x.__class__ == Exists:
+    mapping = dict(mapping)
+    mapping[x.variable] = x.variable.updateVariables()
+    return [(x.value, mapping)]
+  else:
+    return [(y, mapping) for y in x._children()]
+
+def _combineUpdated(x, mapping, expanded, results):
+  if x.__class__ == Exists:
+    return Exists(variable = expanded[0][1][x.variable], value = results[0])
+  elif len(expanded) == 0:
+    return x.substitute(mapping)
+  else:
+    return x._rebuild(results)
+
+def _expandUncanonical(x, context):
+  return [(y, context) for y in x._children() if y._canonicalForm is None]
+
+def _combineCompressed(x, context, expanded, results):
+  return x._compressWith(results)
+
+# Arrows nested at most this deep are compressed by plain recursion, which costs less per
+# arrow than the fold.  Deeper arrows are compressed with the fold.
+_maxRecursiveCompressionDepth = 100
+
+# arrow: an arrow nested depth deep in the arrow being compressed.
+# return: arrow.compress()
+def _compressArrow(arrow, depth):
+  children = arrow._children()
+  if len(children) == 0:
+    return arrow._compressWith(children)
+  elif depth < _maxRecursiveCompressionDepth:
+    return arrow._compressWith([_compressArrow(child, depth + 1) for child in children])
+  else:
+    return fold(arrow, _expandChildren, _combineCompressed)
+
+def _combineCanonical(x, context, expanded, results):
+  if x._canonicalForm is None:
+    x._cacheCanonical()
+
+class _Interned(type):
+  def __call__(cls, *args, **kwargs):
+    x = type.__call__(cls, *args, **kwargs)
+    key = x._internKey()
+    existing = _interned.get(key)
+    if existing is None:
+      x._cache()
+      _interned[key] = x
+      return x
+    else:
+      return existing
+
+class Formula(object):
+  __metaclass__ = _Interned
+  # Formulas are weakly referenced by the table of interned formulas.
+  # _transforms caches the natural transforms built for the formula, as in
+  # endofunctor.naturalTransform.
+  __slots__ = ['_parts', '_hash', '_free', '_canonicalForm', '_transforms',
+      '__weakref__']
+
+  # Formulas are pickled by their constructor arguments, so that they are interned
+  # again when they are unpickled.
+  def __reduce__(self):
+    return (self.__class__, self._constructorArgs())
+
+  # return: a tuple of the arguments from which self was constructed.
+  def _constructorArgs(self):
+    raise Exception("Abstract superclass.")
+
+  # return: a hashable key such that two formulas have the same key iff
+  #         they are structurally identical.
+  # Subformulas are interned, so they may be represented in the key by their ids.
+  def _internKey(self):
+    raise Exception("Abstract superclass.")
+
+  # Compute the data cached on a newly interned formula.
+  # Alpha equivalent formulas have the same shape and weight, and hence the same hash.
+  def _cache(self):
+    self._parts = self._hashParts()
+    self._hash = hashOfParts(self._parts)
+    self._free = self._computeFree()
+    self._canonicalForm = None
+
+  # return: the bitset of the ids of the free variables of self.
+  def _computeFree(self):
+    raise Exception("Abstract superclass.")
+
+  # return: the hash parts of self, as in GeneralizedVariable.hashParts
+  # Subformulas are interned, so their parts are already cached.
+  def _hashParts(self):
+    raise Exception("Abstract superclass.")
+
+  # return: the hash parts of self.
+  def hashParts(self):
+    return self._parts
+
+  def __hash__(self):
+    return self._hash
+
+  # Two formulas are equal iff they are alpha equivalent, iff they have the same canonical form.
+  def __eq__(self, other):
+    if self is other:
+      return True
+    return (isinstance(other, Formula)
+        and self._hash == other._hash
+        and self.canonical() is other.canonical())
+  def __ne__(self, other):
+    return not(self == other)
+
+  # Canonical formulas use a locally nameless representation:
+  #   Every binder binds the same variable, _binder.
+  #   Each bound occurrence of a variable is the BoundVariable whose index is the number
+  #   of binders between the occurrence and its own binder.
+  #   Renderings of Not are ignored, and the sides of Identical formulas are ordered.
+  # Canonical formulas are interned, so alpha equivalent formulas have the very same
+  # canonical formula.  It is computed when first needed, and then cached.
+  def canonical(self):
+    if self._canonicalForm is None:
+      # Compute the canonical forms of the subformulas of self first, from the bottom up.
+      fold(self, _expandUncanonical, _combineCanonical, memo = {})
+    if self._canonicalForm is _isCanonical:
+      return self
+    else:
+      return self._canonicalForm
+
+  # The canonical forms of the immediate subformulas of self must have been computed.
+  def _cacheCanonical(self):
+    canonical = self._computeCanonical()
+    if canonical is self:
+      # Avoid a reference cycle.
+      self._canonicalForm = _isCanonical
+    else:
+      self._canonicalForm = canonical
+
+  # return: the canonical form of self.
+  # The canonical forms of the immediate subformulas of self have already been computed.
+  def _computeCanonical(self):
+    raise Exception("Abstract superclass.")
+
+  # self must be canonical.
+  # variable: a variable free in self
+  # index: the number of binders between self and the binder of variable.
+  # children: the immediate subformulas of self, after closing.
+  # return: self with each free occurrence of variable replaced by BoundVariable(index)
+  def _closeWith(self, variable, index, children):
+    return self._rebuild(children)
 
-class Formula:
   def simplify(self):
     return self.identity()
 
   # f is a function taking each object B to a list ys
-  # return a list of all pairs (a, X) such that
+  # return an iterator over all pairs (a, X) such that
   #   a is an arrow self -> B|self
   #   X is in f(B)
   #   B == Always(C) for some C
   def produceFiltered(self, f):
+    return iter([])
+
+  # return: the list of the formulas B in the pairs of self.produceFiltered, in the same
+  #         order, computed without building any arrows.
+  def producibleClaims(self):
+    return []
+
+  # return: the list of the immediate subformulas of self.
+  def _children(self):
     return []
 
+  # children: a list of formulas, one for each of the immediate subformulas of self.
+  # return: a formula like self, but with children as its immediate subformulas.
+  def _rebuild(self, children):
+    return self
+
+  # childReprs: the reprs of the immediate subformulas of self.
+  # return: the repr of self.
+  def _reprWith(self, childReprs):
+    raise Exception("Abstract superclass.")
+
+  def __repr__(self):
+    return fold(self, _expandChildren, _combineRepr, memo = {})
+
   # Replace all bound variables with new variables.
   def updateVariables(self):
-    raise Exception("Abstract superclass.")
+    return fold(self, _expandUpdated, _combineUpdated, {})
 
-  # a, b: variables.
+  # a, b: generalized variables.
+  # Only variables are ever replaced, so when a is not a Variable this returns self.
   def substituteVariable(self, a, b):
-    raise Exception("Abstract superclass.")
-
+    if isinstance(a, Variable):
+      return self.substitute({a: b})
+    else:
+      return self
+
+  # mapping: a dictionary mapping variables to variables.
+  # return: self with each free occurrence of each key of mapping replaced by its value,
+  #         all in a single traversal.  Subformulas in which no key of mapping is free
+  #         are shared with self.
+  def substitute(self, mapping):
+    mask = 0
+    for variable in mapping:
+      mask |= 1 << variable._id
+    if self._free & mask == 0:
+      return self
+    # Maps each mask to the restriction of mapping to the variables in the mask.
+    restrictions = {mask: mapping}
+
+    # The context of a subformula is the bitset of the keys of mapping that are not
+    # bound above it.
+    def expand(x, mask):
+      if x._free & mask == 0:
+        return []
+      elif x.__class__ == Exists:
+        return [(x.value, mask & ~(1 << x.variable._id))]
+      else:
+        return [(y, mask) for y in x._children()]
+
+    def combine(x, mask, expanded, results):
+      if x._free & mask == 0:
+        return x
+      restriction = restrictions.get(mask)
+      if restriction is None:
+        restriction = dict([(a, b) for (a, b) in mapping.iteritems() if (mask >> a._id) & 1])
+        restrictions[mask] = restriction
+      return x._substituteWith(restriction, results)
+
+    return fold(self, expand, combine, mask, {})
+
+  # mapping: a dictionary mapping variables to variables.  Some key of mapping is free in self.
+  # children: the immediate subformulas of self, after substitution.
+  # return: self.substitute(mapping)
+  def _substituteWith(self, mapping, children):
+    return self._rebuild(children)
+
+  # return: an immutable FreeVariables.
   def freeVariables(self):
-    raise Exception("Abstract superclass.")
+    return FreeVariables(self._free)
 
   def forwardDoubleDual(self):
     return DoubleDual(src = self, tgt = Not(Not(self)))
@@ -72,31 +362,33 @@ class Formula:
     return Id(src = self, tgt = self)
 
 class Holds(Formula):
+  __slots__ = ['held', 'holding']
+
   def __init__(self, held, holding):
     self.held = held
     self.holding = holding
 
-  def __eq__(self, other):
-    if self is other:
-      return True
-    return (self.__class__ == other.__class__
-        and self.holding == other.holding
-        and self.held == other.held)
+  def _internKey(self):
+    return (Holds, self.held, self.holding)
+  def _constructorArgs(self):
+    return (self.held, self.holding)
 
-  def __ne__(self, other):
-    return not (self == other)
-  def __repr__(self):
+  def _hashParts(self):
+    return holdsHashParts(self.held, self.holding)
+
+  def _reprWith(self, childReprs):
     return repr(self.held) + " : " + repr(self.holding)
-  def updateVariables(self):
+  def _substituteWith(self, mapping, children):
+    return Holds(held = self.held.substitute(mapping),
+        holding = self.holding.substitute(mapping))
+  def _computeFree(self):
+    return self.holding.freeVariables().bits | self.held.freeVariables().bits
+
+  def _computeCanonical(self):
     return self
-  def substituteVariable(self, a, b):
-    return Holds(held = self.held.substituteVariable(a, b),
-        holding = self.holding.substituteVariable(a, b))
-  def freeVariables(self):
-    result = Set()
-    result.union_update(self.holding.freeVariables())
-    result.union_update(self.held.freeVariables())
-    return result
+
+  def _closeWith(self, variable, index, children):
+    return self.substitute({variable: BoundVariable(index)})
 
 def isExistentialOfLength(n, existential):
   for i in range(n):
@@ -106,44 +398,47 @@ def isExistentialOfLength(n, existential):
   return True
 
 class Exists(Formula):
+  __slots__ = ['variable', 'value']
+
   def __init__(self, variable, value):
     assert(isinstance(variable, Variable))
     self.variable = variable
     self.value = value
 
+  def _internKey(self):
+    return (Exists, self.variable, id(self.value))
+  def _constructorArgs(self):
+    return (self.variable, self.value)
+
+  def _hashParts(self):
+    return existsHashParts(self.variable, self.value.hashParts())
+
   def simplify(self):
     return OnBody(self.variable, self.value.simplify())
 
-  def __eq__(self, other):
-    if self is other:
-      return True
-    if self.__class__ != other.__class__:
-      return False
-    else:
-      if self.variable == other.variable:
-        return self.value == other.value
-      else:
-        return (self.variable not in other.value.freeVariables()
-            and self.value == other.value.substituteVariable(other.variable, self.variable))
+  def _children(self):
+    return [self.value]
+  def _rebuild(self, children):
+    return Exists(variable = self.variable, value = children[0])
 
-  def __ne__(self, other):
-    return not(self == other)
-
-  def __repr__(self):
-    return "( Exists %s . %s )"%(self.variable, self.value)
+  def _reprWith(self, childReprs):
+    return "( Exists %s . %s )"%(self.variable, childReprs[0])
 
   # f is a function taking each object B to a list ys
-  # return a list of all pairs (a, X) such that
+  # return an iterator over all pairs (a, X) such that
   #   a is an arrow self -> B|self
   #   X is in f(B)
   #   B == Always(C) for some C
   def produceFiltered(self, f):
     # Exists xs. X --> Exists xs. (B|X) --> (B|Exists xs.X)
-    return [(self.forwardOnBody(a).forwardFollow(lambda x, B=B:
-                                   AndPastExists(src = And(B, self), tgt = x).invert()), X)
-            for a, X in self.value.produceFiltered(f)
-            for B in [a.tgt.left]
-            if self.variable not in B.freeVariables()]
+    for a, X in self.value.produceFiltered(f):
+      B = a.tgt.left
+      if self.variable not in B.freeVariables():
+        yield (self.forwardOnBody(a).forwardFollow(lambda x, B=B:
+          AndPastExists(src = And(B, self), tgt = x).invert()), X)
+
+  def producibleClaims(self):
+    return [B for B in self.value.producibleClaims() if self.variable not in B.freeVariables()]
 
   def forwardOnBody(self, arrow):
     assert(isinstance(arrow, Arrow))
@@ -161,7 +456,7 @@ class Exists(Formula):
     assert(self.variable not in self.value.freeVariables())
     return RemoveExists(src = self, tgt = self.value)
   def backwardIntroExists(self, newVariable):
-    return IntroExists(src = self.value.substituteVariable(self.variable, newVariable), tgt = self)
+    return IntroExists(src = self.value.substitute({self.variable: newVariable}), tgt = self)
 
   def forwardCommuteExists(self):
     assert(self.value.__class__ == Exists)
@@ -178,23 +473,19 @@ class Exists(Formula):
     return AndPastExists(src = And(self.value.left, Exists(self.variable, self.value.right)),
         tgt = self).invert()
 
-  def updateVariables(self):
-    variable = self.variable.updateVariables()
-    return Exists(variable = variable,
-        value = self.value.substituteVariable(
-          self.variable, variable).updateVariables())
+  def _substituteWith(self, mapping, children):
+    for (a, b) in mapping.iteritems():
+      # The bound variable shadows its key.
+      if a != self.variable and a in self.value.freeVariables() and self.variable in b.freeVariables():
+        raise Exception("%s should not be in %s"%(self.variable, b.freeVariables()))
+    return Exists(variable = self.variable, value = children[0])
 
-  def substituteVariable(self, a, b):
-    if not(self.variable not in a.freeVariables()):
-      raise Exception("%s should not be in %s"%(self.variable, a.freeVariables()))
-    if not(self.variable not in b.freeVariables()):
-      raise Exception("%s should not be in %s"%(self.variable, b.freeVariables()))
+  def _computeFree(self):
+    return self.value._free & ~(1 << self.variable._id)
 
-    return Exists(variable = self.variable,
-        value = self.value.substituteVariable(a, b))
+  def _computeCanonical(self):
+    return Exists(_binder, _closed(self.value.canonical(), self.variable, 0))
 
-  def freeVariables(self):
-    return self.value.freeVariables().difference(Set([self.variable]))
 
 def MultiExists(variables, value):
   for variable in variables[::-1]:
@@ -218,23 +509,25 @@ def MultiBoundedForall(variable_domain_pairs, value):
 
 # For And and Or.
 class Conjunction(Formula):
+  __slots__ = ['left', 'right']
+
   # There is only one global right symbol.
   def __init__(self, left, right):
     self.left = left
     self.right = right
 
+  def _internKey(self):
+    return (self.__class__, id(self.left), id(self.right))
+  def _constructorArgs(self):
+    return (self.left, self.right)
+
+  def _hashParts(self):
+    return conjunctionHashParts(self.__class__.__name__,
+        self.left.hashParts(), self.right.hashParts())
+
   def simplify(self):
     return self.forwardOnConjunction(self.left.simplify(), self.right.simplify())
 
-  def __eq__(self, other):
-    if self is other:
-      return True
-    return (self.__class__ == other.__class__
-        and self.left == other.left
-        and self.right == other.right)
-  def __ne__(self, other):
-    return not(self == other)
-
   def forwardOnConjunction(self, leftArrow, rightArrow):
     assert(isinstance(leftArrow, Arrow))
     assert(isinstance(rightArrow, Arrow))
@@ -272,18 +565,17 @@ class Conjunction(Formula):
   def backwardOnRightFollow(self, f):
     return self.backwardOnRight(f(self.right))
 
-  def updateVariables(self):
-    return self.__class__(
-        left = self.left.updateVariables(),
-        right = self.right.updateVariables())
+  def _children(self):
+    return [self.left, self.right]
+  def _rebuild(self, children):
+    return self.__class__(left = children[0], right = children[1])
 
-  def substituteVariable(self, a, b):
-    return self.__class__(
-        left = self.left.substituteVariable(a, b),
-        right = self.right.substituteVariable(a, b))
+  def _computeFree(self):
+    return self.left._free | self.right._free
+
+  def _computeCanonical(self):
+    return self.__class__(left = self.left.canonical(), right = self.right.canonical())
 
-  def freeVariables(self):
-    return self.left.freeVariables().union(self.right.freeVariables())
 
   def forwardCommute(self):
     return Commute(
@@ -328,21 +620,28 @@ class Conjunction(Formula):
     return self.forwardAssociate().invert()
 
 class And(Conjunction):
+  __slots__ = []
+
   # f is a function taking each object B to a list ys
-  # return a list of all pairs (a, X) such that
+  # return an iterator over all pairs (a, X) such that
   #   a is an arrow self -> B|self
   #   X is in f(B)
   #   B == Always(C) for some C
   def produceFiltered(self, f):
-    result = []
     # (X|Y) --> (X|(B|Y)) --> (X|(Y|B)) --> ((X|Y)|B) --> (B|(X|Y))
-    result.extend([(self.forwardOnRight(a.forwardFollow(lambda x:
-      x.forwardCommute())).forwardFollow(lambda x:
-        x.forwardAssociateOther().forwardFollow(lambda x:
-          x.forwardCommute())), X) for a, X in self.right.produceFiltered(f)])
+    for a, X in self.right.produceFiltered(f):
+      yield (self.forwardOnRight(a.forwardFollow(lambda x:
+        x.forwardCommute())).forwardFollow(lambda x:
+          x.forwardAssociateOther().forwardFollow(lambda x:
+            x.forwardCommute())), X)
     # (X|Y) --> ((B|X)|Y) --> (B|(X|Y))
-    result.extend([(self.forwardOnLeft(a).forwardFollow(lambda x:
-          x.forwardAssociate()), X) for a, X in self.left.produceFiltered(f)])
+    for a, X in self.left.produceFiltered(f):
+      yield (self.forwardOnLeft(a).forwardFollow(lambda x:
+        x.forwardAssociate()), X)
+
+  def producibleClaims(self):
+    result = self.right.producibleClaims()
+    result.extend(self.left.producibleClaims())
     return result
 
   def getSide(self, side):
@@ -458,12 +757,14 @@ class And(Conjunction):
   def forwardForgetRight(self):
     return Forget(src = self, tgt = self.left)
 
-  def __repr__(self):
-    return "(%s AND %s)"%(self.left, self.right)
+  def _reprWith(self, childReprs):
+    return "(%s AND %s)"%(childReprs[0], childReprs[1])
 
 class Or(Conjunction):
-  def __repr__(self):
-    return "(%s OR %s)"%(self.left, self.right)
+  __slots__ = []
+
+  def _reprWith(self, childReprs):
+    return "(%s OR %s)"%(childReprs[0], childReprs[1])
 
   def simplifyOnce(self):
     if self.left == unit_for_conjunction(Or):
@@ -519,22 +820,31 @@ def ExpandIff(left, right):
   return And(Implies(left, right), Implies(right, left))
 
 class Not(Formula):
+  __slots__ = ['value', 'rendered']
+
   def __init__(self, value, rendered = False):
     self.value = value
     self.rendered = rendered
 
+  def _internKey(self):
+    return (Not, id(self.value), self.rendered)
+  def _constructorArgs(self):
+    return (self.value, self.rendered)
+
+  # Equality ignores self.rendered, so hashing does too.
+  def _hashParts(self):
+    return notHashParts(self.value.hashParts())
+
   def simplify(self):
     return self.forwardOnNot(self.value.simplify().invert())
 
-  def __eq__(self, other):
-    if self is other:
-      return True
-    return self.__class__ == other.__class__ and self.value == other.value
-  def __ne__(self, other):
-    return not(self == other)
+  def _children(self):
+    return [self.value]
+  def _rebuild(self, children):
+    return Not(value = children[0], rendered = self.rendered)
 
-  def __repr__(self):
-    return "~(%s)"%(self.value,)
+  def _reprWith(self, childReprs):
+    return "~(%s)"%(childReprs[0],)
 
   def forwardOnNot(self, arrow):
     assert(isinstance(arrow, Arrow))
@@ -561,51 +871,60 @@ class Not(Formula):
     return Apply(src = And(left = a, right = Not(And(left = a, right = self.value))),
                  tgt = self)
 
-  def updateVariables(self):
-    return self.__class__(value = self.value.updateVariables(),
-        rendered = self.rendered)
 
-  def substituteVariable(self, a, b):
-    return self.__class__(value = self.value.substituteVariable(a, b),
-        rendered = self.rendered)
+  def _computeFree(self):
+    return self.value._free
+
+  def _computeCanonical(self):
+    return Not(self.value.canonical())
 
-  def freeVariables(self):
-    return self.value.freeVariables()
 
 class Always(Formula):
+  __slots__ = ['value']
+
   def __init__(self, value):
     self.value = value
-    self._equal_formulas = Set()
+
+  def _internKey(self):
+    return (Always, id(self.value))
+  def _constructorArgs(self):
+    return (self.value,)
+
+  def _hashParts(self):
+    return alwaysHashParts(self.value.hashParts())
 
   def simplify(self):
     return self.forwardOnAlways(self.value.simplify())
 
   # f is a function taking each object B to a list ys
-  # return a list of all pairs (a, X) such that
+  # return an iterator over all pairs (a, X) such that
   #   a is an arrow self -> B|self
   #   X is in f(B)
   #   B == Always(C) for some C
   def produceFiltered(self, f):
-    result = []
-    result.extend([(self.forwardOnAlways(a).forwardFollow(lambda x:
-      x.forwardDistributeAlways().forwardFollow(lambda x:
-        x.forwardOnLeftFollow(lambda x:
-          x.forwardUnalways()))), X) for a, X in self.value.produceFiltered(f)])
-    result.extend([(self.forwardCopy(), X) for X in f(self)])
+    for a, X in self.value.produceFiltered(f):
+      yield (self.forwardOnAlways(a).forwardFollow(lambda x:
+        x.forwardDistributeAlways().forwardFollow(lambda x:
+          x.forwardOnLeftFollow(lambda x:
+            x.forwardUnalways()))), X)
+    for X in f(self):
+      yield (self.forwardCopy(), X)
+
+  def producibleClaims(self):
+    result = self.value.producibleClaims()
+    result.append(self)
     return result
 
   def forwardCopy(self):
     return Copy(src = self, tgt = And(self.updateVariables(), self))
 
-  def __eq__(self, other):
-    if self is other:
-      return True
-    return self.__class__ == other.__class__ and self.value == other.value
-  def __ne__(self, other):
-    return not(self == other)
+  def _children(self):
+    return [self.value]
+  def _rebuild(self, children):
+    return Always(value = children[0])
 
-  def __repr__(self):
-    return "!(%s)"%(self.value)
+  def _reprWith(self, childReprs):
+    return "!(%s)"%(childReprs[0],)
 
   def forwardUnalways(self):
     return Unalways(src = self, tgt = self.value)
@@ -640,47 +959,42 @@ class Always(Formula):
   def forwardCojoin(self):
     return Cojoin(src = self, tgt = Always(self))
 
-  def updateVariables(self):
-    return self.__class__(value = self.value.updateVariables())
 
-  def substituteVariable(self, a, b):
-    return self.__class__(value = self.value.substituteVariable(a, b))
+  def _computeFree(self):
+    return self.value._free
+
+  def _computeCanonical(self):
+    return Always(self.value.canonical())
 
-  def freeVariables(self):
-    return self.value.freeVariables()
 
 class Unit(Formula):
-  def __eq__(self, other):
-    return self.__class__ == other.__class__
-  def __ne__(self, other):
-    return not(self == other)
+  __slots__ = []
 
-  def updateVariables(self):
-    return self
+  def _internKey(self):
+    return (self.__class__,)
+  def _constructorArgs(self):
+    return ()
 
-  def substituteVariable(self, a, b):
-    return self
+  def _hashParts(self):
+    return nodeParts(hash(self.__class__.__name__), [])
 
-  def freeVariables(self):
-    return Set()
+  def _computeFree(self):
+    return 0
+
+  def _computeCanonical(self):
+    return self
 
 class AndUnit(Unit):
-  def __repr__(self):
-    return "1"
+  __slots__ = []
 
-  def __eq__(self, other):
-    return other.__class__ == AndUnit
-  def __ne__(self, other):
-    return not(self == other)
+  def _reprWith(self, childReprs):
+    return "1"
 
 class OrUnit(Unit):
-  def __repr__(self):
-    return "0"
+  __slots__ = []
 
-  def __eq__(self, other):
-    return other.__class__ == OrUnit
-  def __ne__(self, other):
-    return not(self == other)
+  def _reprWith(self, childReprs):
+    return "0"
 
 true = AndUnit()
 false = OrUnit()
@@ -689,30 +1003,42 @@ false = OrUnit()
 # that each formula F involving a has the EXACT same set of representations as
 # the formula F.substituteVariable(a, b)
 class Identical(Formula):
+  __slots__ = ['left', 'right']
+
   def __init__(self, left, right):
     self.left = left
     self.right = right
-  def __eq__(self, other):
-    if self is other:
-      return True
-    return other.__class__ == Identical and (
-        (self.left == other.left and self.right == other.right)
-        or (self.left == other.right and self.right == other.left))
-  def __ne__(self, other):
-    return not(self == other)
-  def updateVariables(self):
-    return self
-  def substituteVariable(self, a, b):
-    return Identical(left = self.left.substituteVariable(a, b),
-        right = self.right.substituteVariable(a, b))
-  def freeVariables(self):
-    result = Set()
-    result.union_update(self.left.freeVariables())
-    result.union_update(self.right.freeVariables())
-    return result
-  def __repr__(self):
+  def _internKey(self):
+    return (Identical, self.left, self.right)
+  def _constructorArgs(self):
+    return (self.left, self.right)
+  def _hashParts(self):
+    return identicalHashParts(self.left, self.right)
+  def _substituteWith(self, mapping, children):
+    return Identical(left = self.left.substitute(mapping),
+        right = self.right.substitute(mapping))
+  def _computeFree(self):
+    return self.left.freeVariables().bits | self.right.freeVariables().bits
+  def _computeCanonical(self):
+    return _orientedIdentical(self.left, self.right)
+  def _closeWith(self, variable, index, children):
+    mapping = {variable: BoundVariable(index)}
+    return _orientedIdentical(self.left.substitute(mapping), self.right.substitute(mapping))
+  def _reprWith(self, childReprs):
     return "< %s === %s >"%(self.left, self.right)
 
+# return: the canonical formula equal to Identical(left, right)
+def _orientedIdentical(left, right):
+  if left.sortKey() <= right.sortKey():
+    return Identical(left, right)
+  else:
+    return Identical(right, left)
+
+# The variable bound by every binder of a canonical formula.
+_binder = Variable()
+# Marks formulas that are their own canonical form.
+_isCanonical = object()
+
 def unit_for_conjunction(conjunction):
   if conjunction == And:
     return true
@@ -720,29 +1046,156 @@ def unit_for_conjunction(conjunction):
     assert(conjunction == Or)
     return false
 
-class Arrow:
+# Policies for validating arrows as they are constructed:
+#   eagerValidation: validate each arrow when it is constructed.
+#   deferredValidation: record each constructed arrow, and validate it on the next call to check().
+#   sampledValidation: validate one in every sampleRate constructed arrows.
+#   noValidation: never validate arrows.
+eagerValidation = 'eager'
+deferredValidation = 'deferred'
+sampledValidation = 'sampled'
+noValidation = 'off'
+
+_validationPolicy = eagerValidation
+_sampleRate = 100
+_nConstructed = 0
+# The arrows whose validation has been deferred.
+_obligations = []
+# During check(), the set of pairs (id(a), id(b)) of formulas a and b already proven equal.
+_provenEqual = None
+
+def validationPolicy():
+  return _validationPolicy
+
+# policy: one of the validation policies above.
+# sampleRate: the number of constructed arrows per validated arrow under sampledValidation.
+def setValidationPolicy(policy, sampleRate = 100):
+  global _validationPolicy, _sampleRate, _nConstructed
+  if policy not in [eagerValidation, deferredValidation, sampledValidation, noValidation]:
+    raise Exception("Unknown validation policy %s."%(policy,))
+  if sampleRate < 1:
+    raise Exception("sampleRate must be positive, not %s."%(sampleRate,))
+  _validationPolicy = policy
+  _sampleRate = sampleRate
+  _nConstructed = 0
+
+# Validate a newly constructed arrow, or record the obligation to validate it,
+# according to the current validation policy.
+# arrow: any object with a validate method.
+def validateByPolicy(arrow):
+  global _nConstructed
+  if _validationPolicy == eagerValidation:
+    arrow.validate()
+  elif _validationPolicy == deferredValidation:
+    _obligations.append(arrow)
+  elif _validationPolicy == sampledValidation:
+    _nConstructed += 1
+    if _nConstructed % _sampleRate == 0:
+      arrow.validate()
+
+# Validate every arrow whose validation has been deferred.
+# Throw an exception if any of them is invalid.  The invalid arrow, and the arrows that were
+# not yet validated when the exception was thrown, remain recorded, so check() fails again
+# until they are discarded.
+def check():
+  global _obligations, _provenEqual
+  obligations = _obligations
+  _obligations = []
+  _provenEqual = set()
+  i = 0
+  try:
+    while i < len(obligations):
+      obligations[i].validate()
+      i += 1
+  finally:
+    _obligations = obligations[i:] + _obligations
+    _provenEqual = None
+
+# Forget every arrow whose validation has been deferred, valid or not.
+# return: the list of those arrows.
+def discardObligations():
+  global _obligations
+  result = _obligations
+  _obligations = []
+  return result
+
+# return: True iff formulas a and b are equal.
+# Within check(), equalities that were already proven are not proven again.
+def provenEqual(a, b):
+  if a is b:
+    return True
+  elif _provenEqual is None:
+    return a == b
+  key = (id(a), id(b))
+  if key in _provenEqual:
+    return True
+  elif a == b:
+    _provenEqual.add(key)
+    return True
+  else:
+    return False
+
+class Arrow(Slotted):
+  __slots__ = ['src', 'tgt', '_hash']
+
   def __init__(self, src, tgt):
     self.src = src
     self.tgt = tgt
-    self.validate()
+    validateByPolicy(self)
+
+  # Arrows are built far more often than they are hashed, so each arrow computes
+  # its hash the first time it is needed and caches it in the _hash slot.
+
+  # return: a hash consistent with __eq__.
+  def _computeHash(self):
+    return hash((self.__class__.__name__, hash(self.src), hash(self.tgt)))
+
+  def __hash__(self):
+    try:
+      return self._hash
+    except AttributeError:
+      self._hash = self._computeHash()
+      return self._hash
+
+  # return: the list of the arrows from which self is built.
+  def _children(self):
+    return []
+
+  # children: a list of arrows, one for each arrow from which self is built.
+  # return: an arrow like self, but built from children.
+  def _rebuild(self, children):
+    return self
 
   def substituteVariable(self, a, b):
+    return fold(self, _expandChildren,
+        lambda x, context, expanded, results: x._substituteVariableWith(a, b, results),
+        memo = {})
+
+  # children: the arrows from which self is built, after substitution.
+  # return: self.substituteVariable(a, b)
+  def _substituteVariableWith(self, a, b, children):
     return self.__class__(src = self.src.substituteVariable(a, b),
         tgt = self.tgt.substituteVariable(a, b))
 
   def leftAssociate(self):
     return self
-  def _leftAssociate(self, f):
-    return f(self)
   def rightAssociate(self):
     return self
-  def _rightAssociate(self, f):
-    return f(self)
 
   def compress(self):
+    return _compressArrow(self, 0)
+
+  # children: the arrows from which self is built, after compression.
+  # return: self.compress()
+  def _compressWith(self, children):
     return self
 
   def __repr__(self):
+    return fold(self, _expandChildren, _combineRepr, memo = {})
+
+  # childReprs: the reprs of the arrows from which self is built.
+  # return: the repr of self.
+  def _reprWith(self, childReprs):
     return "%s"%(self.arrowTitle())
 
   # Throw an exception if self is not valid.
@@ -756,7 +1209,10 @@ class Arrow:
   def __eq__(self, other):
     if self is other:
       return True
-    return self.__class__ == other.__class__ and self.src == other.src and self.tgt == other.tgt
+    return (self.__class__ == other.__class__
+        and hash(self) == hash(other)
+        and self.src == other.src
+        and self.tgt == other.tgt)
   def __ne__(self, other):
     return not(self == other)
 
@@ -772,26 +1228,43 @@ class Arrow:
     return self.backwardCompose(f(self.src))
 
 class Isomorphism(Arrow):
+  __slots__ = []
+
   def invert(self):
     return InverseArrow(self)
 
 class InverseArrow(Isomorphism):
+  __slots__ = ['arrow']
+
   def __init__(self, arrow):
     self.arrow = arrow
     self.src = arrow.tgt
     self.tgt = arrow.src
 
-  def substituteVariable(self, a, b):
-    return InverseArrow(arrow = self.arrow.substituteVariable(a, b))
+  def _children(self):
+    return [self.arrow]
+  def _rebuild(self, children):
+    return InverseArrow(arrow = children[0])
 
-  def __repr__(self):
-    return "%s inverse"%(self.arrow,)
+  def _substituteVariableWith(self, a, b, children):
+    return self._rebuild(children)
+
+  def _compressWith(self, children):
+    if children[0] is self.arrow:
+      return self
+    else:
+      return InverseArrow(arrow = children[0])
+
+  def _reprWith(self, childReprs):
+    return "%s inverse"%(childReprs[0],)
 
   def invert(self):
     return self.arrow
 
 # A <--> A
 class Id(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Id"
   def validate(self):
@@ -799,120 +1272,232 @@ class Id(Isomorphism):
   def compose(self, other):
     return other
 
-# left, right: noncomposite arrows
-# compress the composite of arrows left o right
+# Arrows are compressed by rewriting adjacent pairs of arrows left o right according to
+# a registry of compression rules.
+# A compression rule is a function taking compressed noncomposite arrows left and right
+# such that left.tgt == right.src.  It returns None if it does not apply to them, and
+# otherwise a list of at most one compressed noncomposite arrow equivalent to left o right.
+# The empty list stands for the identity arrow.
+# Each application of a rule removes at least one arrow, so compression terminates.
+
+# A list of triples (name, rule, leftClass, rightClass), in the order they are tried.
+_compressionRules = []
+# Maps each pair (leftClass, rightClass) to a list of the pairs (name, rule) of the
+# compression rules that may apply to arrows of those classes.
+_compressionRulesByClasses = {}
+# Maps the name of each compression rule to the number of arrows it has removed.
+_compressionStatistics = {}
+
+# name: a name for rule, distinct from the names of the other compression rules.
+# rule: a compression rule.
+# leftClass, rightClass: if not None, rule is only tried when left (resp. right) has
+#   exactly that class.
+def addCompressionRule(name, rule, leftClass = None, rightClass = None):
+  if _compressionStatistics.has_key(name):
+    raise Exception("There is already a compression rule named %s."%(name,))
+  _compressionRules.append((name, rule, leftClass, rightClass))
+  _compressionRulesByClasses.clear()
+  _compressionStatistics[name] = 0
+
+def removeCompressionRule(name):
+  if not(_compressionStatistics.has_key(name)):
+    raise Exception("There is no compression rule named %s."%(name,))
+  for i in range(len(_compressionRules)):
+    if _compressionRules[i][0] == name:
+      del _compressionRules[i]
+      break
+  _compressionRulesByClasses.clear()
+  del _compressionStatistics[name]
+
+# return: a dictionary mapping the name of each compression rule to the number of arrows
+#         it has removed since the statistics were last reset.
+def compressionStatistics():
+  return dict(_compressionStatistics)
+
+def resetCompressionStatistics():
+  for name in _compressionStatistics.keys():
+    _compressionStatistics[name] = 0
+
+def _compressionRulesFor(left, right):
+  key = (left.__class__, right.__class__)
+  rules = _compressionRulesByClasses.get(key)
+  if rules is None:
+    rules = [(name, rule) for (name, rule, leftClass, rightClass) in _compressionRules
+        if (leftClass is None or leftClass == key[0])
+        and (rightClass is None or rightClass == key[1])]
+    _compressionRulesByClasses[key] = rules
+  return rules
+
+# left, right: compressed noncomposite arrows
+# return: the result of the first compression rule that applies to left o right,
+#         or None if none of them apply.
 def _compress2(left, right):
-  assert(left.__class__ != Composite)
-  assert(right.__class__ != Composite)
-  if left.__class__ == OnAlways and right.__class__ == OnAlways:
-    return OnAlways(left.arrow.forwardCompose(right.arrow)).compress()
-  elif left.__class__ == OnNot and right.__class__ == OnNot:
-    return OnNot(right.arrow.forwardCompose(left.arrow)).compress()
-  elif left.__class__ == OnBody and right.__class__ == OnBody and left.variable == right.variable:
-    return OnBody(variable = left.variable,
-        arrow = left.arrow.forwardCompose(right.arrow)).compress()
-  elif (left.__class__ == OnConjunction and right.__class__ == OnConjunction
-      and left.src.__class__ == right.src.__class__):
-    return OnConjunction(src = left.src, tgt = right.tgt,
-        leftArrow = left.leftArrow.forwardCompose(right.leftArrow),
-        rightArrow = left.rightArrow.forwardCompose(right.rightArrow)).compress()
-  elif left.__class__ == Id:
-    return right
-  elif right.__class__ == Id:
-    return left
-  elif _commutingArrow(left) and _commutingArrow(right):
-    return left.src.identity()
+  for name, rule in _compressionRulesFor(left, right):
+    replacement = rule(left, right)
+    if replacement is not None:
+      assert(len(replacement) < 2)
+      _compressionStatistics[name] += 2 - len(replacement)
+      return replacement
+  return None
+
+# arrows: a nonempty list of compressed noncomposite arrows that compose.
+# return: a compressed arrow equivalent to their composite.
+# A window of two adjacent arrows slides from right to left over the arrows.  When a rule
+# rewrites the window, the window moves back to include the arrow to the right of the
+# rewritten arrows, so a single linear pass reaches a fixed point.
+def _compressCompressed(arrows):
+  src = arrows[0].src
+  todo = list(arrows)
+  result = []
+  while len(todo) > 0:
+    arrow = todo.pop()
+    if len(result) > 0:
+      replacement = _compress2(arrow, result[-1])
+      if replacement is not None:
+        result.pop()
+        todo.extend(replacement)
+        continue
+    result.append(arrow)
+  result.reverse()
+  if len(result) == 0:
+    return src.identity()
+  elif len(result) == 1:
+    return result[0]
   else:
-    # TODO Improve compression.
-    # There are many special cases of compressions.
-    # For example: compress copy arrows with forget arrows.
-    return Composite(left, right)
+    return ArrowChain(result, validated = len(result))
 
-def _commutingArrow(arrow):
-  return (arrow.__class__ == Commute or
-    (arrow.__class__ == InverseArrow and arrow.arrow.__class__ == Commute))
-
-# A --> B --> C
-class Composite(Arrow):
-  def __init__(self, left, right):
-    self.left = left
-    self.right = right
-    self.src = left.src
-    self.tgt = right.tgt
-    self.validate()
+# left, right: compressed arrows such that left.tgt == right.src
+# return: a compressed arrow equivalent to left o right.
+def _composeCompressed(left, right):
+  return _compressCompressed(_chainArrows(left) + _chainArrows(right))
 
-  def substituteVariable(self, a, b):
-    return Composite(left = self.left.substituteVariable(a, b),
-        right =self.right.substituteVariable(a, b))
-
-  def compress(self):
-    return self.rightAssociate()._compress_rightAssocitaed()
-
-  # self must be right associated
-  # return a right associated, compressed arrow equivalent to self.
-  def _compress_rightAssocitaed(self):
-    assert(self.left.__class__ != Composite)
-    if self.right.__class__ == Composite:
-      return Composite(self.left.compress(),
-          self.right._compress_rightAssocitaed())._compress_rightAssociatedCompressed()
+# return: a new list of the noncomposite arrows that compose to arrow.
+def _chainArrows(arrow):
+  if arrow.__class__ == ArrowChain:
+    return arrow.arrows()
+  else:
+    return [arrow]
+
+# return: the composite left o right.
+# Composites are represented by ArrowChains, so that a long sequence of compositions
+# builds a single flat chain rather than a deeply nested tree.
+def Composite(left, right):
+  if left.__class__ == ArrowChain:
+    return left._extended(right)
+  elif right.__class__ == ArrowChain:
+    arrows = [left]
+    arrows.extend(right.arrows())
+    return ArrowChain(arrows)
+  else:
+    return ArrowChain([left, right])
+
+# A --> B --> ... --> Z
+# The composite of a sequence of at least two arrows, none of which are ArrowChains.
+# Chains are immutable, but chains may share a list of arrows: a chain consists of the
+# first self._length arrows of self._arrows.  A chain that uses all of its list may
+# append to that list in place, so a chain of n arrows is built by n compositions in
+# O(n) time.
+class ArrowChain(Arrow):
+  __slots__ = ['_arrows', '_length', '_validated']
+
+  # arrows: a list of at least two arrows, none of which are ArrowChains.
+  #         The new chain owns the list.
+  # length: the number of arrows of the list in the chain.  Defaults to all of them.
+  # validated: the number of leading arrows in the chain known to compose with each other.
+  def __init__(self, arrows, length = None, validated = 1):
+    if length is None:
+      length = len(arrows)
+    assert(length >= 2)
+    self._arrows = arrows
+    self._length = length
+    self._validated = validated
+    self.src = arrows[0].src
+    self.tgt = arrows[length - 1].tgt
+    if validated < length:
+      validateByPolicy(self)
+
+  # return: a new list of the arrows in self, in order.
+  def arrows(self):
+    return self._arrows[:self._length]
+
+  # return: the composite self o other.
+  def _extended(self, other):
+    if self._length == len(self._arrows):
+      arrows = self._arrows
     else:
-      return _compress2(self.left, self.right)
-
-  # self must be right associated
-  # self.left must be compressed
-  # self.right must be compressed.
-  # return a right associated, compressed arrow equivalent to self.
-  def _compress_rightAssociatedCompressed(self):
-    if self.right.__class__ == Composite:
-      x = _compress2(self.left, self.right.left)
-      if x.__class__ == Composite:
-        # Can't compress further
-        return self
-      else:
-        return Composite(x, self.right.right)._compress_rightAssociatedCompressed()
+      arrows = self.arrows()
+    if other.__class__ == ArrowChain:
+      arrows.extend(other.arrows())
     else:
-      return _compress2(self.left, self.right)
+      arrows.append(other)
+    return ArrowChain(arrows, validated = self._length)
+
+  # Chains present the interface of a left associated binary composite left o right.
+  # Each of these takes O(1) time.
+  @property
+  def left(self):
+    if self._length == 2:
+      return self._arrows[0]
+    else:
+      return ArrowChain(self._arrows, length = self._length - 1, validated = self._length - 1)
+  @property
+  def right(self):
+    return self._arrows[self._length - 1]
 
-  def leftAssociate(self):
-    return self._leftAssociate(lambda x: x)
-  def _leftAssociate(self, f):
-    # (((f(x)*x)*x)*x)
-    return self.right._leftAssociate(lambda x: Composite(self.left._leftAssociate(f), x))
+  def _computeHash(self):
+    return hash(('ArrowChain', tuple([hash(arrow) for arrow in self.arrows()])))
 
-  def rightAssociate(self):
-    return self._rightAssociate(lambda x: x)
-  def _rightAssociate(self, f):
-    # (x*(x*(x*f(x))))
-    return self.left._rightAssociate(lambda x: Composite(x, self.right._rightAssociate(f)))
+  def _children(self):
+    return self.arrows()
+  def _rebuild(self, children):
+    return ArrowChain(children)
 
-  def __repr__(self):
-    return "%s o\n%s"%(self.left, self.right)
+  def _substituteVariableWith(self, a, b, children):
+    return self._rebuild(children)
+
+  # Each arrow is compressed, and then adjacent arrows are compressed together.
+  def _compressWith(self, children):
+    return _compressCompressed(children)
+
+  def _reprWith(self, childReprs):
+    return " o\n".join(childReprs)
 
   # Throw an exception if self is not valid.
-  # Subclasses should override to implement checking.
+  # The arrows before self._validated were validated when a shorter chain was constructed,
+  # so only the arrows after them are checked.
   def validate(self):
-    if not(self.left.tgt == self.right.src):
-      raise Exception(("Invalid composite.\n"
-        "left %s\nright %s\nleft.src = %s\n"
-        "left.tgt =%s\nright.src =%s\nright.tgt = %s\n"
-          )%(self.left.compress(), self.right.compress(), self.left.src, self.left.tgt, self.right.src, self.right.tgt))
+    for i in range(self._validated, self._length):
+      left = self._arrows[i - 1]
+      right = self._arrows[i]
+      if not(provenEqual(left.tgt, right.src)):
+        raise Exception(("Invalid composite at arrow %s.\n"
+          "left.src = %s\n"
+          "left.tgt =%s\nright.src =%s\nright.tgt = %s\n"
+            )%(i, left.src, left.tgt, right.src, right.tgt))
 
   # May throw an exception.
   def invert(self):
-    return Composite(left = self.right.invert(), right = self.left.invert())
+    return ArrowChain([self._arrows[i].invert() for i in range(self._length - 1, -1, -1)])
 
   def __eq__(self, other):
     if self is other:
       return True
-    return (self.__class__ == other.__class__
-        and self.left == other.left
-        and self.right == other.right)
+    if not(self.__class__ == other.__class__
+        and self._length == other._length
+        and hash(self) == hash(other)):
+      return False
+    for i in range(self._length):
+      if not(self._arrows[i] == other._arrows[i]):
+        return False
+    return True
 
   def __ne__(self, other):
     return not(self == other)
 
 # A | (B - C) --> (A | B) - (A | C)
 class Distribute(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Distribute"
   def validate(self):
@@ -928,6 +1513,8 @@ class Distribute(Arrow):
 
 # And(base, step) --> claim
 class Induction(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Induction"
   def validate(self):
@@ -936,6 +1523,8 @@ class Induction(Arrow):
 
 # A | B --> A,  A | B --> B
 class Forget(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Forget"
   def validate(self):
@@ -944,6 +1533,8 @@ class Forget(Arrow):
 
 # A - B <-- A,  A - B <-- B
 class Admit(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Admit"
   def validate(self):
@@ -951,6 +1542,8 @@ class Admit(Arrow):
     assert(self.src in [self.tgt.left, self.tgt.right])
 
 class Commute(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Commute"
   def validate(self):
@@ -961,6 +1554,8 @@ class Commute(Isomorphism):
 
 # (A % B) % C ---> A % (B % C)
 class Associate(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Associate[[..].]-->[.[..]]"
   def validate(self):
@@ -976,6 +1571,8 @@ class Associate(Isomorphism):
 
 # A % 1 <-- A --> 1 % A
 class UnitIdentity(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "UnitIdentity"
   def validate(self):
@@ -983,8 +1580,60 @@ class UnitIdentity(Isomorphism):
     assert((self.tgt.right == unit and self.tgt.left == self.src)
         or (self.tgt.left == unit and self.tgt.right == self.src))
 
+# conjunction: And or Or
+# x: a formula.
+# return: the list of the formulas joined by conjunction in x, after flattening every
+#         nested conjunction of that class and dropping its units.
+def conjuncts(conjunction, x):
+  unit = unit_for_conjunction(conjunction)
+  result = []
+  stack = [x]
+  while len(stack) > 0:
+    y = stack.pop()
+    if y.__class__ == conjunction:
+      stack.append(y.right)
+      stack.append(y.left)
+    elif y != unit:
+      result.append(y)
+  return result
+
+# A1 % (A2 % ...) <--> B1 % (B2 % ...)
+# where the Bs are a permutation of the As, up to associativity and units of %.
+# A single Rearrange replaces a chain of Associate, Commute and UnitIdentity arrows.
+class Rearrange(Isomorphism):
+  __slots__ = ['conjunction']
+
+  def __init__(self, src, tgt, conjunction):
+    self.conjunction = conjunction
+    Arrow.__init__(self, src = src, tgt = tgt)
+
+  def arrowTitle(self):
+    return "Rearrange"
+  def validate(self):
+    counts = {}
+    for x in conjuncts(self.conjunction, self.src):
+      counts[x] = counts.get(x, 0) + 1
+    for x in conjuncts(self.conjunction, self.tgt):
+      count = counts.get(x, 0)
+      assert(count > 0)
+      if count == 1:
+        del counts[x]
+      else:
+        counts[x] = count - 1
+    assert(len(counts) == 0)
+
+  def _substituteVariableWith(self, a, b, children):
+    return Rearrange(src = self.src.substituteVariable(a, b),
+        tgt = self.tgt.substituteVariable(a, b),
+        conjunction = self.conjunction)
+
+  def invert(self):
+    return Rearrange(src = self.tgt, tgt = self.src, conjunction = self.conjunction)
+
 # A <--> ~(~A)
 class DoubleDual(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "DoubleDual"
   def validate(self):
@@ -994,6 +1643,8 @@ class DoubleDual(Isomorphism):
 
 # A | ~(A | B) --> ~B
 class Apply(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Apply"
   def validate(self):
@@ -1010,6 +1661,8 @@ class Apply(Arrow):
 
 # !A --> !!A
 class Cojoin(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Cojoin"
   def validate(self):
@@ -1019,6 +1672,8 @@ class Cojoin(Arrow):
 
 # !A --> (!A).updateVariables() | !A
 class Copy(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Copy"
   def validate(self):
@@ -1031,6 +1686,8 @@ class Copy(Arrow):
 
 # !A | !B --> !(A|B)
 class Zip(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Zip"
   def validate(self):
@@ -1044,6 +1701,8 @@ class Zip(Arrow):
 
 # !A --> A
 class Unalways(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Unalways"
   def validate(self):
@@ -1052,6 +1711,8 @@ class Unalways(Arrow):
 
 # A --> Exists x . A[v->x]
 class IntroExists(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "IntroExists"
   def validate(self):
@@ -1063,6 +1724,8 @@ class IntroExists(Arrow):
 # colimits (Exists x).  We just need a precise sense in which (Exists x) is a colimit.
 # (A|Exists x. B) --> Exists x. (A|B)
 class AndPastExists(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "AndPastExists"
   def validate(self):
@@ -1075,6 +1738,8 @@ class AndPastExists(Isomorphism):
 
 # Exists x . Exists y . A --> Exists y . Exists x . A
 class CommuteExists(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "CommuteExists"
   def validate(self):
@@ -1085,8 +1750,85 @@ class CommuteExists(Isomorphism):
     assert(self.src.variable == self.tgt.value.variable)
     assert(self.src.value.variable == self.tgt.variable)
 
+# A binder is a pair (variable, domain) where domain is None or a formula.
+# binders: a list of binders.
+# body: a formula.
+# return: Exists v1 . (D1 | Exists v2 . (D2 | ... body)) where the conjunct Di is
+#         omitted when the domain of the binder for vi is None.
+def bindAll(binders, body):
+  result = body
+  for variable, domain in binders[::-1]:
+    if domain is not None:
+      result = And(domain, result)
+    result = Exists(variable, result)
+  return result
+
+# binders: a list of binders.
+# x: a formula of the form bindAll(binders, body).
+# return: body
+def unbindAll(binders, x):
+  for variable, domain in binders:
+    assert(x.__class__ == Exists)
+    assert(x.variable == variable)
+    x = x.value
+    if domain is not None:
+      assert(x.__class__ == And)
+      assert(x.left == domain)
+      x = x.right
+  return x
+
+# bindAll(binders, A) <--> bindAll([binders[i] for i in permutation], A)
+# where the variables of the binders are distinct, and no domain mentions the variable of
+# another binder.
+# A single PermuteExists replaces a chain of CommuteExists, AndPastExists and
+# conjunction arrows for each transposition of the binders.
+class PermuteExists(Isomorphism):
+  __slots__ = ['binders', 'permutation']
+
+  def __init__(self, src, tgt, binders, permutation):
+    self.binders = binders
+    self.permutation = permutation
+    Arrow.__init__(self, src = src, tgt = tgt)
+
+  def arrowTitle(self):
+    return "PermuteExists%s"%(self.permutation,)
+  def validate(self):
+    assert(sorted(self.permutation) == range(len(self.binders)))
+    for i in range(len(self.binders)):
+      variable, domain = self.binders[i]
+      for j in range(len(self.binders)):
+        if i != j:
+          other, otherDomain = self.binders[j]
+          assert(other != variable)
+          assert(domain is None or other not in domain.freeVariables())
+    body = unbindAll(self.binders, self.src)
+    assert(self.tgt == bindAll(self.permutedBinders(), body))
+
+  # return: the binders of self.tgt, in order.
+  def permutedBinders(self):
+    return [self.binders[i] for i in self.permutation]
+
+  def _substituteVariableWith(self, a, b, children):
+    binders = []
+    for variable, domain in self.binders:
+      if domain is not None:
+        domain = domain.substituteVariable(a, b)
+      binders.append((variable, domain))
+    return PermuteExists(src = self.src.substituteVariable(a, b),
+        tgt = self.tgt.substituteVariable(a, b),
+        binders = binders, permutation = self.permutation)
+
+  def invert(self):
+    inverse = [None] * len(self.permutation)
+    for i in range(len(self.permutation)):
+      inverse[self.permutation[i]] = i
+    return PermuteExists(src = self.tgt, tgt = self.src,
+        binders = self.permutedBinders(), permutation = inverse)
+
 # !(Exists x . B) --> Exists x . !B
 class AlwaysPastExists(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "AlwaysPastExists"
   def validate(self):
@@ -1098,6 +1840,8 @@ class AlwaysPastExists(Isomorphism):
 
 # Exists x . A --> A
 class RemoveExists(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "RemoveExists"
   def validate(self):
@@ -1107,6 +1851,8 @@ class RemoveExists(Arrow):
 
 # ~1 <--> -
 class NotTrueIsFalse(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "NotTrueIsFalse"
   def validate(self):
@@ -1116,6 +1862,8 @@ class NotTrueIsFalse(Isomorphism):
 
 # ~0 <--> 1
 class NotFalseIsTrue(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "NotFalseIsTrue"
   def validate(self):
@@ -1131,6 +1879,8 @@ trueIsNotFalse = notFalseIsTrue.invert()
 # a === b | A --> A.substituteVariable(a, b)
 # a === b | A --> A.substituteVariable(b, a)
 class SubstituteArrow(Arrow):
+  __slots__ = []
+
   def arrowTitle(self):
     return "Substitute(%s->%s)"%(self.src.left.left, self.src.left.right)
   def validate(self):
@@ -1142,6 +1892,8 @@ class SubstituteArrow(Arrow):
         A.substituteVariable(b, a) == self.tgt)
 
 class TrueAlways(Isomorphism):
+  __slots__ = []
+
   def arrowTitle(self):
     return "TrueAlways"
   def validate(self):
@@ -1152,7 +1904,9 @@ trueAlways = TrueAlways(src = true, tgt = Always(true))
 
 # a == a <--> ture
 class IdenticalReflexive(Isomorphism):
-  def name(self):
+  __slots__ = []
+
+  def arrowTitle(self):
     return "IdenticalReflexive"
   def validate(self):
     assert(self.src.__class__ == Identical)
@@ -1161,18 +1915,34 @@ class IdenticalReflexive(Isomorphism):
 
 # For arrow built from the application of functors to other arrows.
 class FunctorialArrow(Arrow):
-  def __repr__(self):
-    return self.reprAround('\n'.join(['  ' + l for l in repr(self.arrow).split('\n')]))
-
-  def substituteVariable(self, a, b):
-    return self.__class__(arrow = self.arrow.substituteVariable(a, b))
-
-  def compress(self):
-    arrow = self.arrow.compress()
-    if arrow.__class__ == Id:
+  __slots__ = []
+
+  def _children(self):
+    return [self.arrow]
+  def _rebuild(self, children):
+    return self.__class__(arrow = children[0])
+
+  def _reprWith(self, childReprs):
+    return self.reprAround('\n'.join(['  ' + l for l in childReprs[0].split('\n')]))
+
+  def _substituteVariableWith(self, a, b, children):
+    return self._rebuild(children)
+
+  def _compressWith(self, children):
+    allIdentities = True
+    unchanged = True
+    olds = self._children()
+    for i in range(len(children)):
+      if children[i].__class__ != Id:
+        allIdentities = False
+      if children[i] is not olds[i]:
+        unchanged = False
+    if allIdentities:
       return self.src.identity()
+    elif unchanged:
+      return self
     else:
-      return self.__class__(arrow = arrow)
+      return self._rebuild(children)
 
   def reprAround(self, middle):
     return "%s {\n%s\n} %s"%(self.arrowTitle(), middle, self.arrowTitle())
@@ -1188,6 +1958,8 @@ def OnOr(leftArrow, rightArrow):
       tgt = Or(leftArrow.tgt, rightArrow.tgt))
 
 class OnConjunction(FunctorialArrow):
+  __slots__ = ['leftArrow', 'rightArrow']
+
   def __init__(self, leftArrow, rightArrow, src, tgt):
     assert(src.__class__ in [And, Or])
     assert(src.__class__ == tgt.__class__)
@@ -1200,28 +1972,20 @@ class OnConjunction(FunctorialArrow):
     self.src = src
     self.tgt = tgt
 
-  def substituteVariable(self, a, b):
-    return self.__class__(
-        leftArrow = self.leftArrow.substituteVariable(a, b),
-        rightArrow = self.rightArrow.substituteVariable(a, b),
-        src = self.src.substituteVariable(a, b),
-        tgt = self.tgt.substituteVariable(a, b))
+  def _children(self):
+    return [self.leftArrow, self.rightArrow]
+  def _rebuild(self, children):
+    conjunction = self.src.__class__
+    return OnConjunction(leftArrow = children[0], rightArrow = children[1],
+        src = conjunction(children[0].src, children[1].src),
+        tgt = conjunction(children[0].tgt, children[1].tgt))
 
   def invert(self):
     return OnConjunction(src = self.tgt, tgt = self.src,
         leftArrow = self.leftArrow.invert(), rightArrow = self.rightArrow.invert())
 
-
-  def compress(self):
-    left = self.leftArrow.compress()
-    right = self.rightArrow.compress()
-    if left.__class__ == Id and right.__class__ == Id:
-      return self.src.identity()
-    else:
-      return self.__class__(leftArrow = left, rightArrow = right, src = self.src, tgt = self.tgt)
-
-  def __repr__(self):
-    return self.reprAround(_hconcat(repr(self.leftArrow), repr(self.rightArrow)))
+  def _reprWith(self, childReprs):
+    return self.reprAround(_hconcat(childReprs[0], childReprs[1]))
 
   def arrowTitle(self):
     if self.src.__class__ == And:
@@ -1231,10 +1995,18 @@ class OnConjunction(FunctorialArrow):
       return "OnOr"
 
 class OnAlways(FunctorialArrow):
-  def __init__(self, arrow):
+  __slots__ = ['arrow']
+
+  # src, tgt: None, or the formulas Always(arrow.src) and Always(arrow.tgt) when the caller
+  #           already has them.
+  def __init__(self, arrow, src = None, tgt = None):
     self.arrow = arrow
-    self.src = Always(arrow.src)
-    self.tgt = Always(arrow.tgt)
+    if src is None:
+      src = Always(arrow.src)
+    self.src = src
+    if tgt is None:
+      tgt = Always(arrow.tgt)
+    self.tgt = tgt
 
   def invert(self):
     return OnAlways(self.arrow.invert())
@@ -1243,30 +2015,42 @@ class OnAlways(FunctorialArrow):
     return "OnAlways"
 
 class OnBody(FunctorialArrow):
-  def __init__(self, variable, arrow):
+  __slots__ = ['arrow', 'variable']
+
+  # src, tgt: None, or the formulas Exists(variable, arrow.src) and
+  #           Exists(variable, arrow.tgt) when the caller already has them.
+  def __init__(self, variable, arrow, src = None, tgt = None):
     self.arrow = arrow
     self.variable = variable
-    self.src = Exists(variable, arrow.src)
-    self.tgt = Exists(variable, arrow.tgt)
+    if src is None:
+      src = Exists(variable, arrow.src)
+    self.src = src
+    if tgt is None:
+      tgt = Exists(variable, arrow.tgt)
+    self.tgt = tgt
 
   def invert(self):
     return OnBody(self.variable, self.arrow.invert())
 
-  def compress(self):
-    arrow = self.arrow.compress()
-    if arrow.__class__ == Id:
-      return self.src.identity()
-    else:
-      return OnBody(variable = self.variable, arrow = arrow)
+  def _rebuild(self, children):
+    return OnBody(variable = self.variable, arrow = children[0])
 
   def arrowTitle(self):
     return "OnBody"
 
 class OnNot(FunctorialArrow):
-  def __init__(self, arrow):
+  __slots__ = ['arrow']
+
+  # src, tgt: None, or the formulas Not(arrow.tgt) and Not(arrow.src) when the caller
+  #           already has them.
+  def __init__(self, arrow, src = None, tgt = None):
     self.arrow = arrow
-    self.src = Not(arrow.tgt)
-    self.tgt = Not(arrow.src)
+    if src is None:
+      src = Not(arrow.tgt)
+    self.src = src
+    if tgt is None:
+      tgt = Not(arrow.src)
+    self.tgt = tgt
 
   def invert(self):
     return OnNot(self.arrow.invert())
@@ -1274,6 +2058,113 @@ class OnNot(FunctorialArrow):
   def arrowTitle(self):
     return "OnNot"
 
+# The compression rules of a functor fuse the images of two arrows into the image of
+# their composite.
+
+# arrow: a compressed arrow.
+# return: [f(arrow)], or the empty list if arrow is an identity.
+def _functorialReplacement(f, arrow):
+  if arrow.__class__ == Id:
+    return []
+  else:
+    return [f(arrow)]
+
+# The image of the composite goes from left.src to right.tgt, so those formulas are reused.
+def _compressOnAlways(left, right):
+  return _functorialReplacement(lambda arrow:
+      OnAlways(arrow = arrow, src = left.src, tgt = right.tgt),
+      _composeCompressed(left.arrow, right.arrow))
+
+def _compressOnNot(left, right):
+  return _functorialReplacement(lambda arrow:
+      OnNot(arrow = arrow, src = left.src, tgt = right.tgt),
+      _composeCompressed(right.arrow, left.arrow))
+
+def _compressOnBody(left, right):
+  if left.variable == right.variable:
+    return _functorialReplacement(lambda arrow:
+        OnBody(variable = left.variable, arrow = arrow, src = left.src, tgt = right.tgt),
+        _composeCompressed(left.arrow, right.arrow))
+
+def _compressOnConjunction(left, right):
+  if left.src.__class__ == right.src.__class__:
+    leftArrow = _composeCompressed(left.leftArrow, right.leftArrow)
+    rightArrow = _composeCompressed(left.rightArrow, right.rightArrow)
+    if leftArrow.__class__ == Id and rightArrow.__class__ == Id:
+      return []
+    else:
+      return [OnConjunction(src = left.src, tgt = right.tgt,
+          leftArrow = leftArrow, rightArrow = rightArrow)]
+
+def _compressLeftIdentity(left, right):
+  return [right]
+
+def _compressRightIdentity(left, right):
+  return [left]
+
+def _commutingArrow(arrow):
+  return (arrow.__class__ == Commute or
+    (arrow.__class__ == InverseArrow and arrow.arrow.__class__ == Commute))
+
+# Commuting twice is the identity.
+def _compressCommutes(left, right):
+  if _commutingArrow(left) and _commutingArrow(right):
+    return []
+
+# Two rearrangements of the same conjunction are a single rearrangement.
+def _compressRearranges(left, right):
+  if left.conjunction == right.conjunction:
+    if left.src == right.tgt:
+      return []
+    else:
+      return [Rearrange(src = left.src, tgt = right.tgt, conjunction = left.conjunction)]
+
+# Two permutations of the same binders are a single permutation.
+def _compressPermuteExists(left, right):
+  if len(left.binders) != len(right.binders):
+    return None
+  for (variable, domain), (other, otherDomain) in zip(left.permutedBinders(), right.binders):
+    if variable != other or domain != otherDomain:
+      return None
+  permutation = [left.permutation[i] for i in right.permutation]
+  if permutation == range(len(permutation)):
+    return []
+  else:
+    return [PermuteExists(src = left.src, tgt = right.tgt,
+      binders = left.binders, permutation = permutation)]
+
+# An isomorphism followed by its inverse is the identity.
+def _compressInverseRight(left, right):
+  if right.arrow == left:
+    return []
+
+def _compressInverseLeft(left, right):
+  if left.arrow == right:
+    return []
+
+# !A --> !A' | !A --> !A
+def _compressCopyForget(left, right):
+  if right.tgt == left.src:
+    return []
+
+# !A --> !!A --> !A
+def _compressCojoinUnalways(left, right):
+  return []
+
+addCompressionRule('OnAlways', _compressOnAlways, OnAlways, OnAlways)
+addCompressionRule('OnNot', _compressOnNot, OnNot, OnNot)
+addCompressionRule('OnBody', _compressOnBody, OnBody, OnBody)
+addCompressionRule('OnConjunction', _compressOnConjunction, OnConjunction, OnConjunction)
+addCompressionRule('leftIdentity', _compressLeftIdentity, leftClass = Id)
+addCompressionRule('rightIdentity', _compressRightIdentity, rightClass = Id)
+addCompressionRule('commutes', _compressCommutes)
+addCompressionRule('rearranges', _compressRearranges, Rearrange, Rearrange)
+addCompressionRule('permuteExists', _compressPermuteExists, PermuteExists, PermuteExists)
+addCompressionRule('inverseRight', _compressInverseRight, rightClass = InverseArrow)
+addCompressionRule('inverseLeft', _compressInverseLeft, leftClass = InverseArrow)
+addCompressionRule('copyForget', _compressCopyForget, Copy, Forget)
+addCompressionRule('cojoinUnalways', _compressCojoinUnalways, Cojoin, Unalways)
+
 # The horizontal concatenation of two strings
 def _hconcat(left, right):
   if len(left) == 0:
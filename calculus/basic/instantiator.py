@@ -1,13 +1,44 @@
 # Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
 
 from misc import *
+from calculus.basic import formula
 
-class FinishedInstantiatingException(Exception):
-  pass
+instantiateStep = 'instantiate'
+exportStep = 'export'
 
-class Instantiator:
-  def instantiate(self, variable, endofunctor, formula):
-    raise Exception("Abstract superclass.")
-  def exportSide(self, formula, endofunctor):
-    raise Exception("Abstract superclass.")
+# A plan for instantiating the outermost binders of a formula, made all at once.
+# steps: a list of pairs (kind, value) applied in order to the outermost binders:
+#        (instantiateStep, variable) instantiates an Exists with variable, and
+#        (exportStep, side) exports the given side of an And.
+class InstantiationPlan:
+  def __init__(self, steps):
+    self.steps = steps
 
+  def __repr__(self):
+    return "InstantiationPlan(%s)"%(self.steps,)
+
+  # return: the number of variables self instantiates.
+  def instantiations(self):
+    return len([kind for kind, value in self.steps if kind == instantiateStep])
+
+# variables: a list of variables.
+# x: a basic formula.
+# return: the plan which instantiates each Exists binder at the front of x with the next of
+#         variables in order, and exports the left side of at most one And after each
+#         instantiation.  It stops at the first binder it can not handle this way.
+def inOrderPlan(variables, x):
+  steps = []
+  i = 0
+  justExported = False
+  while True:
+    if x.__class__ == formula.Exists and i < len(variables):
+      steps.append((instantiateStep, variables[i]))
+      i += 1
+      justExported = False
+      x = x.value
+    elif x.__class__ == formula.And and not justExported:
+      steps.append((exportStep, left))
+      justExported = True
+      x = x.right
+    else:
+      return InstantiationPlan(steps)
@@ -0,0 +1,39 @@
+# Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
+
+# Folds over trees of formulas and arrows.
+# A fold keeps its own stack rather than recursing, so the depth of a tree is not limited
+# by the depth of the Python stack.
+
+# root: the root of a tree.
+# expand: a function taking a node and its context to a list of pairs (child, childContext),
+#         one for each child of the node that the fold should visit.
+#         It is called on the nodes in preorder, from left to right.
+# combine: a function taking a node, its context, the list expand returned for it, and the
+#          list of the results for those children, to the result for the node.
+#          It is called on the nodes in postorder.
+# context: the context of root.
+# memo: either None, or a dictionary.  When memo is a dictionary, contexts must be
+#       hashable, and a node visited again in the same context reuses its first result.
+#       This is much faster on formulas, whose subformulas are shared.
+# return: the result for root.
+def fold(root, expand, combine, context = None, memo = None):
+  stack = [(root, context, expand(root, context), [])]
+  while True:
+    node, context, expanded, results = stack[-1]
+    if len(results) < len(expanded):
+      child, childContext = expanded[len(results)]
+      if memo is not None:
+        key = (id(child), childContext)
+        if key in memo:
+          results.append(memo[key])
+          continue
+      stack.append((child, childContext, expand(child, childContext), []))
+    else:
+      stack.pop()
+      result = combine(node, context, expanded, results)
+      if memo is not None:
+        memo[(id(node), context)] = result
+      if len(stack) == 0:
+        return result
+      else:
+        stack[-1][3].append(result)
@@ -2,6 +2,7 @@
 
 from misc import *
 import misc
+import weakref
 from calculus.variable import ApplySymbolVariable, ProductVariable, StringVariable, Variable
 from calculus.enriched import spec, formula as formula
 from calculus.basic import formula as basicFormula
@@ -39,6 +40,42 @@ class Endofunctor:
   def search(self, spec):
     raise Exception("Abstract superclass.")
 
+  # spec: a SearchSpec instance.
+  # return: the list self.search(spec), which the caller must not modify.
+  # The list is computed at most once for each functor and each live spec, and a composite
+  # builds its list from those of its components.  A path that advances past one more layer,
+  # or retreats past one, therefore searches only the layer that changed.
+  # The lists are held weakly by their specs, so a spec built for a single query does not
+  # keep its lists alive after the query.
+  def cachedSearch(self, spec):
+    try:
+      searches = self._searches
+    except AttributeError:
+      searches = self._searches = weakref.WeakKeyDictionary()
+    try:
+      return searches[spec]
+    except KeyError:
+      result = self._cachedSearch(spec)
+      searches[spec] = result
+      return result
+
+  def _cachedSearch(self, spec):
+    return self.search(spec)
+
+  # return: a ClaimDatabase of the claims self.search finds for a spec accepting everything.
+  #         It is built once for each functor.
+  def claimDatabase(self):
+    try:
+      return self._claimDatabase
+    except AttributeError:
+      self._claimDatabase = ClaimDatabase(self.cachedSearch(all_claims_search_spec))
+      return self._claimDatabase
+
+  # spec: a SearchSpec instance which searches every hidden formula.
+  # return: the list self.search(spec), answered from self.claimDatabase().
+  def indexedSearch(self, spec):
+    return spec.lookup(self.claimDatabase())
+
   # self must not be the identity functor.
   # return a pair of endofunctors (a, b) such that a.compose(b) == self, a is non-trivial
   # and a is "as small as possible".
@@ -62,7 +99,7 @@ class Endofunctor:
       else:
         src = self.onObject(arrow.tgt)
         tgt = self.onObject(arrow.src)
-      return formula.Arrow(src = src, tgt = tgt, basicArrow = basicArrow)
+      return formula.trustedArrow(src = src, tgt = tgt, basicArrow = basicArrow)
 
   def compose(self, other):
     return Composite(self, other)
@@ -80,10 +117,11 @@ class Endofunctor:
     assert(x.__class__ == formula.Exists)
     assert(len(variables) == len(x.bindings))
     value = fully_substituted(variables, x)
-    ins = InOrderInstantiator(variables)
-    basicArrow = self.translate().exportRecursively(ins, x.translate())
-    if not ins.complete():
+    basicX = x.translate()
+    plan = instantiator.inOrderPlan(variables, basicX)
+    if plan.instantiations() != len(variables):
       raise Exception("Instantiation did not complete.")
+    basicArrow, basicValue = self.translate().exportByPlan(plan, basicX)
     result = formula.Arrow(src = self.onObject(x),
         tgt = self.onObject(value),
         basicArrow = basicArrow)
@@ -113,13 +151,10 @@ class Endofunctor:
           tgt = self.onObject(formula.And([B, x])),
           basicArrow = self.translate().importExactly(B.translate())(x.translate())))
 
-  def importAboutGenerally(self, f, g, x):
-    class S(spec.SearchSpec):
-      def search_hidden_formula(self, name):
-        return True
-      def valid(self, e):
-        return e.__class__ == formula.Always and f([], e.value)
-    importable_claims = self.search(S())
+  # about: None, or a variable which must be an applied or free variable of the claims.
+  def importAboutGenerally(self, f, g, x, about = None):
+    importable_claims = [e for e in self.claimDatabase().select(about = about)
+        if e.__class__ == formula.Always and f([], e.value)]
     claim = importable_claims[g(importable_claims)]
     import_arrow = self.importExactly(claim)(x)
     return import_arrow, formula.And([claim, x])
@@ -129,6 +164,7 @@ class Endofunctor:
   # f: a function from a list of variables bindings and a formula to a boolean.
   # g: a function from a list of formulas to an index into that list.
   # x: a formula
+  # about: None, or a variable which must be an applied or free variable of the claims.
   #
   # search this endofunctor for claims at covariant spots of the form:
   #  Forall(xs, Y) such that len(xs) == len(variables) and f(xs, Y) == True
@@ -136,25 +172,19 @@ class Endofunctor:
   # (arrow, value) such that arrow imports and instantiates to get L[I]
   # and self.onObject(value) == arrow.tgt
   #   self -> L[i]
-  def importAbout(self, variables, f, g, x):
+  # The claims are looked up by their number of bindings in self.claimDatabase(), and a
+  # formula of L is substituted only when g looks at it.
+  def importAbout(self, variables, f, g, x, about = None):
     if len(variables) == 0:
-      return self.importAboutGenerally(f, g, x)
+      return self.importAboutGenerally(f, g, x, about)
     assert(self.covariant())
-    # TODO Improve performance once it becomes important.
-    class S(spec.SearchSpec):
-      def search_hidden_formula(self, name):
-        return True
-      def valid(self, e):
-        result = (e.__class__ == formula.Always
-            and e.value.__class__ == formula.Not
-            and e.value.value.__class__ == formula.Exists
-            and len(e.value.value.bindings) == len(variables)
-            and e.value.value.value.__class__ == formula.Not
-            and f(e.value.value.bindings, e.value.value.value.value))
-        return result
-    importable_claims = self.search(S())
-    xs = [ claim.value.value.substituteAllVariablesInBody(variables).value
-        for claim in importable_claims ]
+    importable_claims = []
+    for claim in self.claimDatabase().select(count = len(variables), about = about):
+      bindings, body = universal_parts(claim)
+      if f(bindings, body):
+        importable_claims.append(claim)
+    xs = LazyList([ (lambda claim=claim: claim.value.value.substituteAllVariablesInBody(variables).value)
+        for claim in importable_claims ])
     index = g(xs)
     claim = importable_claims[index]
     substituted_claim = xs[index]
@@ -166,17 +196,14 @@ class Endofunctor:
     B = formula.Always(formula.Not(formula.Not(substituted_claim)))
     return import_arrow.forwardCompose(instantiate_arrow), formula.And([B, x])
 
-  def importAboutNegating(self, variables, f, g, x):
+  def importAboutNegating(self, variables, f, g, x, about = None):
     assert(not self.covariant())
-    arrow, value = not_functor.compose(self).importAbout(variables, f, g, formula.Not(x))
+    arrow, value = not_functor.compose(self).importAbout(variables, f, g, formula.Not(x), about)
     return self.onArrow(x.backwardUndoubleDual()).forwardCompose(arrow), formula.Not(value)
 
 def fully_substituted(variables, x):
   assert(x.__class__ == formula.Exists)
-  value = x.value
-  for i in range(len(variables)):
-    value = value.substituteVariable(x.bindings[i].variable, variables[i])
-  return value
+  return x.substituteAllVariablesInBody(variables)
 
 class Composite(Endofunctor):
   # if right is covariant, self will represent (left o right)
@@ -195,6 +222,25 @@ class Composite(Endofunctor):
     result.extend(self.left.search(spec))
     return result
 
+  def _cachedSearch(self, spec):
+    result = list(self.right.cachedSearch(spec))
+    result.extend(self.left.cachedSearch(spec))
+    return result
+
+  # A component without claims contributes nothing, so the database of the other component
+  # is shared.
+  def claimDatabase(self):
+    try:
+      return self._claimDatabase
+    except AttributeError:
+      if len(self.left.cachedSearch(all_claims_search_spec)) == 0:
+        self._claimDatabase = self.right.claimDatabase()
+      elif len(self.right.cachedSearch(all_claims_search_spec)) == 0:
+        self._claimDatabase = self.left.claimDatabase()
+      else:
+        self._claimDatabase = ClaimDatabase(self.cachedSearch(all_claims_search_spec))
+      return self._claimDatabase
+
   # object: An enriched formula.
   # return: The enriched formula obtained by applying self to object.
   def onObject(self, object):
@@ -216,7 +262,11 @@ class Composite(Endofunctor):
       return self.right.factor_left()
     else:
       a, b = self.left.factor_left()
-      return (a, b.compose(self.right))
+      if is_identity_functor(b):
+        # Return self.right itself, so that what was computed for it is reused.
+        return (a, self.right)
+      else:
+        return (a, b.compose(self.right))
 
   def factor_right(self):
     if is_identity_functor(self.right):
@@ -227,13 +277,25 @@ class Composite(Endofunctor):
       a, b = self.right.factor_right()
       return (self.left.compose(a), b)
 
+  # The translation is computed once, so that the basic functor, and the import index it
+  # builds, are shared by every use of self.
   def translate(self):
-    return self.left.translate().compose(self.right.translate())
+    try:
+      return self._translated
+    except AttributeError:
+      self._translated = self.left.translate().compose(self.right.translate())
+      return self._translated
+  # The variance is computed once, since composites nest as deeply as the paths they
+  # describe.
   def covariant(self):
-    if self.left.covariant():
-      return self.right.covariant()
-    else:
-      return not self.right.covariant()
+    try:
+      return self._covariant
+    except AttributeError:
+      if self.left.covariant():
+        self._covariant = self.right.covariant()
+      else:
+        self._covariant = not self.right.covariant()
+      return self._covariant
 
 class VariableBinding:
   # return: an endofunctor representing existential quantification
@@ -245,6 +307,20 @@ class VariableBinding:
   def is_ordinary(self):
     return False
 
+  # parts: the hash parts of a basic formula x.
+  # return: None, or the parts of self.translate().onObject(x), computed without translating.
+  def hashPartsAround(self, parts):
+    return None
+  # other: a VariableBinding instance.
+  # return: True if self and other bind the same variable in the same way.
+  def sameBinding(self, other):
+    return self is other
+
+  # return: the pair (variable, domain) describing the translation of self to
+  #         basicFormula.bindAll, where domain is None for an unbounded variable.
+  def basicBinder(self):
+    raise Exception("Bindings of class %s can not be permuted."%(self.__class__,))
+
   def assertBoundedNatural(self):
     assert(self.__class__ == BoundedVariableBinding)
     assert(self.relation == common_vars.natural)
@@ -311,6 +387,17 @@ class BoundedVariableBinding(VariableBinding):
   def search(self, spec):
     return [claim for claim in [self.inDomain] if spec.valid(claim)]
 
+  def basicBinder(self):
+    return (self.variable, self.inDomain.translate())
+
+  def hashPartsAround(self, parts):
+    return basicFormula.existsHashParts(self.variable,
+        basicFormula.conjunctionHashParts('And', self.inDomain.hashParts(), parts))
+  def sameBinding(self, other):
+    return (other.__class__ == BoundedVariableBinding
+        and self.variable == other.variable
+        and self.relation == other.relation)
+
   def render(self, context):
     return (renderBoundedVariableBinding(self.variable, self.domain), context)
 
@@ -336,6 +423,14 @@ class OrdinaryVariableBinding(VariableBinding):
   def translate(self):
     return basicEndofunctor.Exists(self.variable)
 
+  def basicBinder(self):
+    return (self.variable, None)
+
+  def hashPartsAround(self, parts):
+    return basicFormula.existsHashParts(self.variable, parts)
+  def sameBinding(self, other):
+    return other.__class__ == OrdinaryVariableBinding and self.variable == other.variable
+
   def render(self, context):
     return (self.variable.render(), context)
 
@@ -455,6 +550,13 @@ class Conjunction(Endofunctor):
     return self.multiOp()(newValues)
 
   def translate(self):
+    try:
+      return self._translated
+    except AttributeError:
+      self._translated = self._computeTranslation()
+      return self._translated
+
+  def _computeTranslation(self):
     # e.g.
     # self.values = [a, b, c, d]
     # self.index = 2
@@ -522,68 +624,131 @@ class WellDefinedFunctor(Endofunctor):
   def translate(self):
     return self.expanded
 
+# return: True iff x and y are built the same way from Always, Not, And and Or out of
+#         Holds and Identical formulas.
 def same_structure(x, y):
-  if x.__class__ == formula.Always:
-    return y.__class__ == formula.Always and same_structure(x.value, y.value)
-  elif x.__class__ == formula.Not:
-    return y.__class__ == formula.Not and same_structure(x.value, y.value)
-  elif isinstance(x, formula.Conjunction):
-    return (y.__class__ == x.__class__
-        and len(x.values) == len(y.values)
-        and all([same_structure(x.values[i], x.values[i]) for i in range(len(x.values))]))
-  elif x.__class__ == formula.Identical:
-    return y.__class__ == formula.Identical
-  elif x.__class__ == formula.Holds:
-    return y.__class__ == formula.Holds
-  else:
-    return False
+  signature = x.structuralSignature()
+  return signature is not None and signature == y.structuralSignature()
 
 class DefinitionSearchSpec(spec.SearchSpec):
   def __init__(self, x):
     self.x = x
   def valid(self, y):
-    if y.__class__ == formula.Always:
-      if y.value.__class__ == formula.Not:
-        if y.value.value.__class__ == formula.Exists:
-          if y.value.value.value.__class__ == formula.Not:
-            body = y.value.value.value.value
-            if body.__class__ == formula.Iff:
-              left = body.left
-              if same_structure(left, self.x):
-                return True
-    return False
+    parts = universal_parts(y)
+    return (parts is not None
+        and parts[1].__class__ == formula.Iff
+        and same_structure(parts[1].left, self.x))
   def definitons_only(self):
     return True
   def search_hidden_formula(self, name):
     return True
+  def lookup(self, database):
+    return database.definitions(self.x)
 
-# Statefull.
-class InOrderInstantiator(instantiator.Instantiator):
-  def __init__(self, variables):
-    self.variables = variables
-    self.i = 0
-    self.just_exported = False
-    self.exports = 0
-
-  def complete(self):
-    return self.i == len(self.variables)
-
-  # May throw FinishedInstantiatingException
-  def instantiate(self, variable, endofunctor, formula):
-    if self.complete():
-      raise instantiator.FinishedInstantiatingException()
+class AllClaimsSearchSpec(spec.SearchSpec):
+  def valid(self, x):
+    return True
+  def search_hidden_formula(self, name):
+    return True
+
+all_claims_search_spec = AllClaimsSearchSpec()
+
+# claim: an enriched formula
+# return: the pair (bindings, body) if claim has the form !~Exists bindings. ~body
+#         None otherwise
+def universal_parts(claim):
+  if (claim.__class__ == formula.Always
+      and claim.value.__class__ == formula.Not
+      and claim.value.value.__class__ == formula.Exists
+      and claim.value.value.value.__class__ == formula.Not):
+    return (claim.value.value.bindings, claim.value.value.value.value)
+  else:
+    return None
+
+# Indices over a list of claims, so that searches for claims of a given shape look only at
+# the claims of that shape.  Claims are listed in the order of the list they came from.
+class ClaimDatabase:
+  def __init__(self, claims):
+    self.claims = claims
+    # Map each number of bindings, and each pair (number of bindings, class of the body),
+    # to the list of the universal claims of that shape.
+    self._byCount = {}
+    self._byHead = {}
+    # Map each class of a body to the list of the universal claims with bodies of that class.
+    self._byHeadOnly = {}
+    # Map each variable to the set of the ids of claims in which it is applied or free.
+    self._byVariable = {}
+    # Map the structural signature of the left side of the body of each universal claim
+    # whose body is an Iff to the list of those claims.
+    self._definitions = {}
+    for claim in claims:
+      parts = universal_parts(claim)
+      if parts is not None:
+        bindings, body = parts
+        self._byCount.setdefault(len(bindings), []).append(claim)
+        self._byHead.setdefault((len(bindings), body.__class__), []).append(claim)
+        self._byHeadOnly.setdefault(body.__class__, []).append(claim)
+        if body.__class__ == formula.Iff:
+          signature = body.left.structuralSignature()
+          if signature is not None:
+            self._definitions.setdefault(signature, []).append(claim)
+      for variable in claim.applied_variables():
+        self._byVariable.setdefault(variable, set()).add(id(claim))
+      for variable in claim.translate().freeVariables():
+        self._byVariable.setdefault(variable, set()).add(id(claim))
+
+  # count: None, or a number of bindings.
+  # head: None, or the class of a body.
+  # about: None, or a variable.
+  # return: the list of the claims such that
+  #   if count is not None or head is not None, the claim is universal, and
+  #   if count is not None, the claim has count bindings, and
+  #   if head is not None, the body of the claim is an instance of head, and
+  #   if about is not None, about is an applied or free variable of the claim.
+  def select(self, count = None, head = None, about = None):
+    if count is None and head is None:
+      result = self.claims
+    elif count is None:
+      result = self._byHeadOnly.get(head, [])
+    elif head is None:
+      result = self._byCount.get(count, [])
     else:
-      result = self.variables[self.i]
-      self.i += 1
-      self.just_exported = False
-      return result
+      result = self._byHead.get((count, head), [])
+    if about is not None:
+      ids = self._byVariable.get(about, set())
+      result = [claim for claim in result if id(claim) in ids]
+    return result
 
-  # May throw FinishedInstantiatingException
-  def exportSide(self, formula, endofunctor):
-    if self.just_exported:
-      raise instantiator.FinishedInstantiatingException()
+  # x: an enriched formula
+  # return: the list of the universal claims whose bodies are Iff formulas with left sides
+  #         of the same structure as x.
+  def definitions(self, x):
+    signature = x.structuralSignature()
+    if signature is None:
+      return []
     else:
-      self.just_exported = True
-      self.exports += 1
-      return left
+      return self._definitions.get(signature, [])
+
+# A list whose elements are computed only when they are first looked at.
+class LazyList:
+  # thunks: a list of functions of no arguments, one computing each element.
+  def __init__(self, thunks):
+    self.thunks = thunks
+    self.values = {}
+
+  def __len__(self):
+    return len(self.thunks)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self.thunks)
+    if i < 0 or i >= len(self.thunks):
+      raise IndexError(i)
+    if i not in self.values:
+      self.values[i] = self.thunks[i]()
+    return self.values[i]
+
+  def __iter__(self):
+    for i in range(len(self.thunks)):
+      yield self[i]
 
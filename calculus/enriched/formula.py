@@ -12,17 +12,74 @@ from ui.render.text import primitives, distances, colors
 
 from sets import Set
 
-class Formula:
+# return: True iff each of news is the very same object as the corresponding one of olds.
+def _allSame(olds, news):
+  for i in range(len(olds)):
+    if olds[i] is not news[i]:
+      return False
+  return True
+
+# arrow: an enriched arrow simplifying a subformula.
+# return: True iff the subformula was already simplified, so that the formula containing it
+#         need not be rebuilt.
+def _unchanged(arrow):
+  return arrow.src is arrow.tgt
+
+def _allUnchanged(arrows):
+  for arrow in arrows:
+    if not _unchanged(arrow):
+      return False
+  return True
+
+# When True, each comparison of formulas decided without translating them is checked
+# against the comparison of their translations.  This is slow, and meant for debugging.
+_crossCheckEquality = False
+
+def setEqualityCrossCheck(enabled):
+  global _crossCheckEquality
+  _crossCheckEquality = enabled
+
+# Maps each key describing the structure of a formula to the small integer standing for it.
+_signatures = {}
+
+# key: a hashable description of a structure.
+# return: the integer standing for key.  Equal keys give equal integers.
+def _internSignature(key):
+  try:
+    return _signatures[key]
+  except KeyError:
+    result = len(_signatures)
+    _signatures[key] = result
+    return result
+
+class Formula(Slotted):
+  __slots__ = ['_cached_translate', '_cached_signature', '_cached_hashParts', '_cached_hash',
+      '_cached_forwardSimplify', '_cached_backwardSimplify']
+
   def translate(self):
-    if self.__dict__.has_key('_cached_translate'):
+    try:
       return self._cached_translate
-    else:
+    except AttributeError:
       self._cached_translate = self._translate()
       return self._cached_translate
 
   def _translate(self):
     raise Exception("Abstract superclass.")
 
+  # return: None, or an integer describing the structure of self by its Always, Not, And
+  #         and Or nodes and the classes of its Holds and Identical leaves.  Formulas with
+  #         equal signatures have the same structure.  Formulas of other classes, or with
+  #         subformulas of other classes, have the signature None.
+  def structuralSignature(self):
+    try:
+      return self._cached_signature
+    except AttributeError:
+      self._cached_signature = self._structuralSignature()
+      return self._cached_signature
+
+  def _structuralSignature(self):
+    return None
+
   def forwardGatherExistentials(self):
     arrow, bindings, value = self._forwardGatherExistentials()
     return Arrow(src = self, tgt = Exists(bindings, value),
@@ -40,16 +97,79 @@ class Formula:
   def search(self, spec):
     return []
 
+  # Simplification depends only on the formula, so each formula caches its simplifying
+  # arrows.  Subformulas are shared between the steps of a proof, so a subformula already
+  # simplified in an earlier step is not revisited.  A formula in normal form caches
+  # its identity arrow.
+
+  # return: an arrow self --> x where x is simplified.
   def forwardSimplify(self):
-    return self.identity()
+    try:
+      return self._cached_forwardSimplify
+    except AttributeError:
+      self._cached_forwardSimplify = self._forwardSimplify()
+      return self._cached_forwardSimplify
+
+  # return: an arrow x --> self where x is simplified.
   def backwardSimplify(self):
+    try:
+      return self._cached_backwardSimplify
+    except AttributeError:
+      self._cached_backwardSimplify = self._backwardSimplify()
+      return self._cached_backwardSimplify
+
+  def _forwardSimplify(self):
+    return self.identity()
+  def _backwardSimplify(self):
     return self.identity()
 
+  # return: the hash parts of self.translate(), as in
+  #         GeneralizedVariable.hashParts.  Where possible they are computed from the parts of
+  #         the subformulas of self, without translating self.
+  def hashParts(self):
+    try:
+      return self._cached_hashParts
+    except AttributeError:
+      self._cached_hashParts = self._hashParts()
+      return self._cached_hashParts
+
+  def _hashParts(self):
+    return self.translate().hashParts()
+
+  # Equal formulas have equal translations, and hence equal hashes.
+  def __hash__(self):
+    try:
+      return self._cached_hash
+    except AttributeError:
+      self._cached_hash = basicFormula.hashOfParts(self.hashParts())
+      return self._cached_hash
+
+  # Two formulas are equal iff their translations are equal.  Formulas with different hashes
+  # are unequal, and formulas built the same way from equal parts are equal, so the
+  # translations are compared only when neither applies.
   def __eq__(self, other):
-    return isinstance(other, Formula) and self.translate() == other.translate()
+    if self is other:
+      return True
+    if not isinstance(other, Formula):
+      return False
+    if hash(self) != hash(other):
+      result = False
+    elif self.__class__ == other.__class__ and self._sameConstruction(other):
+      result = True
+    else:
+      return self.translate() == other.translate()
+    if _crossCheckEquality:
+      assert(result == (self.translate() == other.translate()))
+    return result
   def __ne__(self, other):
     return not (self == other)
 
+  # other: a formula of the same class as self.
+  # return: True if self and other are built from equal parts, so that their translations
+  #         are equal.  False if that could not be determined.
+  def _sameConstruction(self, other):
+    return False
+
   # Render self as text.
   # Render And[A, B, C] as
   #     |   |
@@ -78,6 +198,12 @@ class Formula:
   def substituteVariable(self, a, b):
     raise Exception("Abstract superclass.")
 
+  # mapping: a dictionary mapping variables to variables.
+  # return: self with each key of mapping replaced by its value, simultaneously and in a
+  #         single traversal.  Subformulas left unchanged are shared with self.
+  def substitute(self, mapping):
+    raise Exception("Abstract superclass.")
+
   def applied_variables(self):
     raise Exception("Abstract superclass.")
 
@@ -109,33 +235,87 @@ class Formula:
   def identity(self):
     return Arrow(src = self, tgt = self, basicArrow = self.translate().identity())
 
-class Arrow:
+# Audit levels for trusted arrows, which the library's own combinators (forwardCompose,
+# invert, onArrow and the like) build from arrows that were already checked.  Such arrows are
+# valid whenever their parts are.
+#   auditNone: never validate trusted arrows.
+#   auditSampled: validate one in every sampleRate trusted arrows.
+#   auditAll: validate each trusted arrow.
+# An audited arrow is validated at once, whatever the validation policy of basicFormula, so
+# that the sample rates of the two do not multiply.
+auditNone = 'none'
+auditSampled = 'sampled'
+auditAll = 'all'
+
+_auditLevel = auditSampled
+_auditSampleRate = 100
+_nTrusted = 0
+
+def auditLevel():
+  return _auditLevel
+
+# level: one of the audit levels above.
+# sampleRate: the number of trusted arrows per audited arrow under auditSampled.
+def setAuditLevel(level, sampleRate = 100):
+  global _auditLevel, _auditSampleRate, _nTrusted
+  if level not in [auditNone, auditSampled, auditAll]:
+    raise Exception("Unknown audit level %s."%(level,))
+  if sampleRate < 1:
+    raise Exception("sampleRate must be positive, not %s."%(sampleRate,))
+  _auditLevel = level
+  _auditSampleRate = sampleRate
+  _nTrusted = 0
+
+# Build an arrow without checking it, except as the audit level requires.
+# src, tgt, basicArrow: as for Arrow, where basicArrow is known to go from the translation
+#                       of src to the translation of tgt.
+def trustedArrow(src, tgt, basicArrow):
+  global _nTrusted
+  result = Arrow.__new__(Arrow)
+  result.src = src
+  result.tgt = tgt
+  result.basicArrow = basicArrow
+  if _auditLevel == auditAll:
+    result.validate()
+  elif _auditLevel == auditSampled:
+    _nTrusted += 1
+    if _nTrusted % _auditSampleRate == 0:
+      result.validate()
+  return result
+
+class Arrow(Slotted):
+  __slots__ = ['src', 'tgt', 'basicArrow']
+
   def __init__(self, src, tgt, basicArrow):
     self.src = src
     self.tgt = tgt
     self.basicArrow = basicArrow
-    if not(basicArrow.src == src.translate()):
-      raise Exception("basicArrow.src =\n%s\nsrc.translate() =\n%s"%(basicArrow.src, src.translate()))
-    if not(basicArrow.tgt == tgt.translate()):
-      raise Exception("basicArrow.tgt =\n%s\ntgt.translate() =\n%s"%(basicArrow.tgt, tgt.translate()))
+    basicFormula.validateByPolicy(self)
+
+  # Throw an exception if self is not valid.
+  def validate(self):
+    if not(basicFormula.provenEqual(self.basicArrow.src, self.src.translate())):
+      raise Exception("basicArrow.src =\n%s\nsrc.translate() =\n%s"%(self.basicArrow.src, self.src.translate()))
+    if not(basicFormula.provenEqual(self.basicArrow.tgt, self.tgt.translate())):
+      raise Exception("basicArrow.tgt =\n%s\ntgt.translate() =\n%s"%(self.basicArrow.tgt, self.tgt.translate()))
 
   def translate(self):
     return self.basicArrow
 
   def compress(self):
-    return Arrow(src = self.src,
+    return trustedArrow(src = self.src,
         tgt = self.tgt,
         basicArrow = self.basicArrow.compress())
 
   def invert(self):
-    return Arrow(src = self.tgt, tgt = self.src, basicArrow = self.basicArrow.invert())
+    return trustedArrow(src = self.tgt, tgt = self.src, basicArrow = self.basicArrow.invert())
 
   def forwardCompose(self, arrow):
-    return Arrow(src = self.src, tgt = arrow.tgt,
+    return trustedArrow(src = self.src, tgt = arrow.tgt,
         basicArrow = self.basicArrow.forwardCompose(arrow.basicArrow))
 
   def backwardCompose(self, arrow):
-    return Arrow(src = arrow.src, tgt = self.tgt,
+    return trustedArrow(src = arrow.src, tgt = self.tgt,
         basicArrow = self.basicArrow.backwardCompose(arrow.basicArrow))
 
   def forwardFollow(self, f):
@@ -145,6 +325,8 @@ class Arrow:
     return self.backwardCompose(f(self.src))
 
 class Holds(Formula):
+  __slots__ = ['held', 'holding']
+
   def __init__(self, held, holding):
     self.held = held
     self.holding = holding
@@ -155,6 +337,12 @@ class Holds(Formula):
   def __repr__(self):
     return "%s IS %s"%(self.held, self.holding)
 
+  def _structuralSignature(self):
+    return _internSignature('Holds')
+  def _hashParts(self):
+    return basicFormula.holdsHashParts(self.held, self.holding)
+  def _sameConstruction(self, other):
+    return self.held == other.held and self.holding == other.holding
   def _translate(self):
     return basicFormula.Holds(held = self.held,
         holding = self.holding)
@@ -178,6 +366,14 @@ class Holds(Formula):
     return Holds(held = self.held.substituteVariable(a, b),
         holding = self.holding.substituteVariable(a, b))
 
+  def substitute(self, mapping):
+    held = self.held.substitute(mapping)
+    holding = self.holding.substitute(mapping)
+    if _allSame([self.held, self.holding], [held, holding]):
+      return self
+    else:
+      return Holds(held = held, holding = holding)
+
   def updateVariables(self):
     return self
 
@@ -185,18 +381,23 @@ def _isUnit(x):
   return isinstance(x, Conjunction) and len(x.values) == 0
 
 class Not(Formula):
+  __slots__ = ['value']
+
   def __init__(self, value):
     self.value = value
 
   def applied_variables(self):
     return self.value.applied_variables()
 
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     arrow = self.value.backwardSimplify()
     value = arrow.src
-    result = Arrow(src = self,
-          tgt = Not(value),
-          basicArrow = basicFormula.OnNot(arrow.basicArrow))
+    if _unchanged(arrow):
+      result = self.identity()
+    else:
+      result = Arrow(src = self,
+            tgt = Not(value),
+            basicArrow = basicFormula.OnNot(arrow.basicArrow))
     if value.__class__ == Not:
       return result.forwardFollow(lambda x:
           Arrow(src = x, tgt = x.value.value,
@@ -214,11 +415,14 @@ class Not(Formula):
     else:
       return result
 
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     arrow = self.value.forwardSimplify()
     value = arrow.tgt
-    result = Arrow(tgt = self, src = Not(value),
-        basicArrow = basicFormula.OnNot(arrow.basicArrow))
+    if _unchanged(arrow):
+      result = self.identity()
+    else:
+      result = Arrow(tgt = self, src = Not(value),
+          basicArrow = basicFormula.OnNot(arrow.basicArrow))
     if value.__class__ == Not:
       return result.backwardFollow(lambda x:
           Arrow(src = x.value.value, tgt = x,
@@ -248,16 +452,34 @@ class Not(Formula):
 
   def __repr__(self):
     return "~%s"%(self.value,)
+  def _structuralSignature(self):
+    value = self.value.structuralSignature()
+    if value is None:
+      return None
+    else:
+      return _internSignature(('Not', value))
+  def _hashParts(self):
+    return basicFormula.notHashParts(self.value.hashParts())
+  def _sameConstruction(self, other):
+    return self.value == other.value
   def _translate(self):
     return basicFormula.Not(self.value.translate())
   def render(self, context):
     return self.value.render(context.negate())
   def substituteVariable(self, a, b):
     return Not(self.value.substituteVariable(a, b))
+  def substitute(self, mapping):
+    value = self.value.substitute(mapping)
+    if value is self.value:
+      return self
+    else:
+      return Not(value)
   def updateVariables(self):
     return Not(self.value.updateVariables())
 
 class Exists(Formula):
+  __slots__ = ['bindings', 'value']
+
   def __init__(self, bindings, value):
     self.bindings = bindings
     self.value = value
@@ -283,12 +505,22 @@ class Exists(Formula):
       assert(binding.variable not in a.freeVariables())
       assert(binding.variable not in b.freeVariables())
     return Exists(self.bindings, self.value.substituteVariable(a, b))
+  def substitute(self, mapping):
+    for binding in self.bindings:
+      for (a, b) in mapping.iteritems():
+        assert(binding.variable not in a.freeVariables())
+        assert(binding.variable not in b.freeVariables())
+    value = self.value.substitute(mapping)
+    if value is self.value:
+      return self
+    else:
+      return Exists(self.bindings, value)
   def substituteAllVariablesInBody(self, variables):
     assert(len(self.bindings) == len(variables))
-    result = self.value
+    mapping = {}
     for i in range(len(self.bindings)):
-      result = result.substituteVariable(self.bindings[i].variable, variables[i])
-    return result
+      mapping[self.bindings[i].variable] = variables[i]
+    return self.value.substitute(mapping)
   def forwardMaybeCollapse(self):
     if isinstance(self.value, Conjunction) and len(self.value.values) == 0:
       def f(i, x):
@@ -307,13 +539,17 @@ class Exists(Formula):
           basicArrow = f(0, self.translate()))
     else:
       return self.identity()
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     arrow = self.value.forwardSimplify()
+    if _unchanged(arrow):
+      return self.forwardMaybeCollapse()
     return Arrow(src = self, tgt = Exists(bindings = self.bindings, value = arrow.tgt),
         basicArrow = self._endofunctor_translate().onArrow(arrow.basicArrow)).forwardFollow(lambda x:
             x.forwardMaybeCollapse())
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     arrow = self.value.backwardSimplify()
+    if _unchanged(arrow):
+      return self.identity()
     return Arrow(src = Exists(bindings = self.bindings, value = arrow.src), tgt = self,
         basicArrow = self._endofunctor_translate().onArrow(arrow.basicArrow))
   def __repr__(self):
@@ -323,6 +559,21 @@ class Exists(Formula):
     for binding in self.bindings[::-1]:
       result = result.compose(binding.translate())
     return result
+  # Bindings which can not compute their parts are translated.
+  def _hashParts(self):
+    result = self.value.hashParts()
+    for binding in self.bindings[::-1]:
+      result = binding.hashPartsAround(result)
+      if result is None:
+        return self.translate().hashParts()
+    return result
+  def _sameConstruction(self, other):
+    if len(self.bindings) != len(other.bindings):
+      return False
+    for i in range(len(self.bindings)):
+      if not self.bindings[i].sameBinding(other.bindings[i]):
+        return False
+    return self.value == other.value
   def _translate(self):
     return self._endofunctor_translate().onObject(self.value.translate())
   def forwardSplit(self, i):
@@ -333,35 +584,29 @@ class Exists(Formula):
   def forwardPushAndSplit(self, i):
     assert(0 <= i)
     assert(i < len(self.bindings))
-    a = self.identity()
-    while i+1 < len(self.bindings):
-      a = a.forwardFollow(lambda e:
-          e.forwardPush(i))
-      i += 1
-    a = a.forwardFollow(lambda e:
+    permutation = range(len(self.bindings))
+    permutation.append(permutation.pop(i))
+    return self.forwardPermute(permutation).forwardFollow(lambda e:
         e.forwardSplit(len(self.bindings) - 1))
-    return a
 
   # i: an index such that self.bindings[i] and self.bindings[i+1] both exist.
   # return: an enriched arrow commuting self.bindings[i] with self.bindings[i+1]
   def forwardPush(self, i):
-    A = self.bindings[:i]
-    b = self.bindings[i]
-    c = self.bindings[i+1]
-    D = self.bindings[i+2:]
-    bindings = []
-    bindings.extend(A)
-    bindings.append(c)
-    bindings.append(b)
-    bindings.extend(D)
-    x = self.value.translate()
-    for binding in D[::-1]:
-      x = binding.translate().onObject(x)
-    a = c.commute(b)(x)
-    for binding in A[::-1]:
-      a = binding.translate().onArrow(a)
+    permutation = range(len(self.bindings))
+    permutation[i], permutation[i+1] = permutation[i+1], permutation[i]
+    return self.forwardPermute(permutation)
+
+  # permutation: a list of the indices of self.bindings in some order.
+  # return: an enriched arrow
+  #         self --> Exists([self.bindings[i] for i in permutation], self.value)
+  #         consisting of a single basic arrow.
+  def forwardPermute(self, permutation):
+    bindings = [self.bindings[i] for i in permutation]
     return Arrow(src = self, tgt = Exists(bindings, self.value),
-        basicArrow = a)
+        basicArrow = basicFormula.PermuteExists(src = self.translate(),
+          tgt = Exists(bindings, self.value).translate(),
+          binders = [binding.basicBinder() for binding in self.bindings],
+          permutation = permutation))
 
   def render(self, context):
     quantifierStackingDimension = _dimension_for_variance(context.covariant)
@@ -385,6 +630,8 @@ class Exists(Formula):
         spacing = distances.quantifier_after_divider_spacing)
 
 class Always(Formula):
+  __slots__ = ['value']
+
   def __init__(self, value):
     self.value = value
   def applied_variables(self):
@@ -399,10 +646,13 @@ class Always(Formula):
     assert(self.value.__class__ == Always)
     return Arrow(src = self, tgt = self.value,
         basicArrow = self.translate().forwardUnalways())
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     arrow = self.value.forwardSimplify()
-    result = Arrow(src = self, tgt = Always(arrow.tgt),
-        basicArrow = basicFormula.OnAlways(arrow.translate()))
+    if _unchanged(arrow):
+      result = self.identity()
+    else:
+      result = Arrow(src = self, tgt = Always(arrow.tgt),
+          basicArrow = basicFormula.OnAlways(arrow.translate()))
     if arrow.tgt.__class__ == Always:
       return result.forwardFollow(lambda x:
           x.forwardJoin())
@@ -415,10 +665,13 @@ class Always(Formula):
     assert(self.value.__class__ == Always)
     return Arrow(tgt = self, src = self.value,
         basicArrow = self.value.translate().forwardCojoin())
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     arrow = self.value.backwardSimplify()
-    result = Arrow(src = Always(arrow.src), tgt = self,
-        basicArrow = basicFormula.OnAlways(arrow.basicArrow))
+    if _unchanged(arrow):
+      result = self.identity()
+    else:
+      result = Arrow(src = Always(arrow.src), tgt = self,
+          basicArrow = basicFormula.OnAlways(arrow.basicArrow))
     if arrow.src.__class__ == Always:
       return result.backwardFollow(lambda x:
           x.backwardCojoin())
@@ -433,6 +686,16 @@ class Always(Formula):
         basicArrow = self.translate().forwardUnalways())
   def __repr__(self):
     return "!%s"%(self.value,)
+  def _structuralSignature(self):
+    value = self.value.structuralSignature()
+    if value is None:
+      return None
+    else:
+      return _internSignature(('Always', value))
+  def _hashParts(self):
+    return basicFormula.alwaysHashParts(self.value.hashParts())
+  def _sameConstruction(self, other):
+    return self.value == other.value
   def _translate(self):
     return basicFormula.Always(self.value.translate())
   def render(self, context):
@@ -441,22 +704,34 @@ class Always(Formula):
         colors.exponentialColor(context.covariant))
   def substituteVariable(self, a, b):
     return Always(self.value.substituteVariable(a, b))
+  def substitute(self, mapping):
+    value = self.value.substitute(mapping)
+    if value is self.value:
+      return self
+    else:
+      return Always(value)
   def updateVariables(self):
     return Always(self.value.updateVariables())
 
 class WellDefined(Formula):
+  __slots__ = ['variable', 'newVariable', 'equivalence', 'value']
+
   def __init__(variable, newVariable, equivalence, value):
     self.variable = variable
     self.newVariable = newVariable
     self.equivalence = equivalence
     self.value = value
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     arrow = self.value.forwardSimplify()
+    if _unchanged(arrow):
+      return self.identity()
     return Arrow(src = self, tgt = WellDefined(variable = self.variable,
       newVariable = self.newVariable, equivalence = self.equivalence, value = arrow.tgt),
       basicArrow = self.getBasicFunctor().onArrow(arrow.basicArrow))
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     arrow = self.value.backwardSimplify()
+    if _unchanged(arrow):
+      return self.identity()
     return Arrow(src = WellDefined(variable = self.variable,
       newVariable = self.newVariable, equivalence = self.equivalence, value = arrow.src),
       tgt = self,
@@ -474,6 +749,14 @@ class WellDefined(Formula):
         newVariable = self.newVariable.substituteVariable(a, b),
         equivalence = self.equivalence.substituteVariable(a, b),
         value = self.value.substituteVariable(a, b))
+  def substitute(self, mapping):
+    olds = [self.variable, self.newVariable, self.equivalence, self.value]
+    news = [x.substitute(mapping) for x in olds]
+    if _allSame(olds, news):
+      return self
+    else:
+      return WellDefined(variable = news[0], newVariable = news[1],
+          equivalence = news[2], value = news[3])
   def updateVariables(self):
     return WellDefined(variable = self.variable,
         newVariable = self.newVariable,
@@ -492,30 +775,59 @@ def ExpandWellDefined(variable, newVariable, equivalence):
   return basicBifunctor.and_functor.precomposeRight(F).join()
 
 class Conjunction(Formula):
+  __slots__ = ['values', '_basicBinop']
+
   def __init__(self, values):
     for i in range(len(values)):
       value = values[i]
       if not(isinstance(value, Formula)):
         raise Exception("%s at index %s is not an enriched formula."%(value, i))
     self.values = values
-    self.basicBinop = self.basicBinop()
+    self._basicBinop = self.basicBinop()
   def __repr__(self):
     return "%s%s"%(self.name(), self.values)
+  def _structuralSignature(self):
+    values = []
+    for value in self.values:
+      signature = value.structuralSignature()
+      if signature is None:
+        return None
+      values.append(signature)
+    return _internSignature((self.__class__.__name__, tuple(values)))
+  # As in basicFormula.multiple_conjunction
+  def _hashParts(self):
+    if len(self.values) == 0:
+      return basicFormula.unit_for_conjunction(self._basicBinop).hashParts()
+    result = self.values[-1].hashParts()
+    for value in self.values[-2::-1]:
+      result = basicFormula.conjunctionHashParts(self._basicBinop.__name__,
+          value.hashParts(), result)
+    return result
+  def _sameConstruction(self, other):
+    if len(self.values) != len(other.values):
+      return False
+    for i in range(len(self.values)):
+      if self.values[i] != other.values[i]:
+        return False
+    return True
   def _translate(self):
-    return basicFormula.multiple_conjunction(conjunction = self.basicBinop,
+    return basicFormula.multiple_conjunction(conjunction = self._basicBinop,
         values = [value.translate() for value in self.values])
   def applied_variables(self):
     result = Set([])
     for value in self.values:
       result.union_update(value.applied_variables())
     return result
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     if len(self.values) == 0:
       return self.identity()
     else:
       arrows = [v.forwardSimplify() for v in self.values]
-      result = Arrow(src = self, tgt = self.__class__(values = [a.tgt for a in arrows]),
-          basicArrow = self.forwardOnArrows(arrows))
+      if _allUnchanged(arrows):
+        result = self.identity()
+      else:
+        result = Arrow(src = self, tgt = self.__class__(values = [a.tgt for a in arrows]),
+            basicArrow = self.forwardOnArrows(arrows))
       return result.forwardFollow(lambda x:
           x.forwardSimplifyConjunction())
 
@@ -543,13 +855,16 @@ class Conjunction(Formula):
     else:
       return self.identity()
 
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     if len(self.values) == 0:
       return self.identity()
     else:
       arrows = [v.backwardSimplify() for v in self.values]
-      result = Arrow(tgt = self, src = self.__class__(values = [a.src for a in arrows]),
-          basicArrow = self.forwardOnArrows(arrows))
+      if _allUnchanged(arrows):
+        result = self.identity()
+      else:
+        result = Arrow(tgt = self, src = self.__class__(values = [a.src for a in arrows]),
+            basicArrow = self.forwardOnArrows(arrows))
       return result.backwardFollow(lambda x:
           x.backwardSimplifyConjunction())
 
@@ -561,88 +876,54 @@ class Conjunction(Formula):
     return self.backwardIntroduceUnits().backwardFollow(lambda x:
             x.backwardMaybeUnsingleton())
 
-  def myUnit(self, x):
-    return x.__class__ == self.__class__ and len(x.values) == 0
-
   def forwardRemoveUnits(self):
     if len(self.values) == 0:
       return self.identity()
     elif len(self.values) == 1:
-      if self.myUnit(self.values[0]):
+      if self.values[0].__class__ == self.__class__:
         return Arrow(src = self, tgt = self.values[0],
             basicArrow = self.translate().identity())
-      elif self.values[0].__class__ == self.__class__:
-        return self.forwardMaybeUnsingleton()
       else:
         return self.identity()
     else:
-      arrow = self.__class__(self.values[1:]).forwardRemoveUnits()
-      tgt_values = arrow.tgt.values
-      for value in tgt_values:
-        if not(value.__class__ != self.__class__):
-          raise Exception("values contains another copy like %s self %s"%(self.__class__, tgt_values,))
-      if self.values[0].__class__ == self.__class__:
-        if len(self.values[0].values) == 0:
-          if self.__class__ == And:
-            forgettingArrow = self.translate().simplifyOnce()
-          else:
-            assert(self.__class__ == Or)
-            forgettingArrow = self.translate().simplifyOnce()
-          return Arrow(src = self, tgt = arrow.tgt,
-              basicArrow = forgettingArrow.forwardCompose(arrow.translate()))
+      values = []
+      for value in self.values:
+        if value.__class__ == self.__class__:
+          values.extend(value.values)
         else:
-          def f(i):
-            if i == len(self.values[0].values) - 1:
-              return (lambda x: x.identity())
-            else:
-              return (lambda x:
-                  x.forwardAssociate().forwardFollow(lambda x:
-                    x.forwardOnRightFollow(f(i+1))))
-          values = list(self.values[0].values)
-          values.extend(tgt_values)
-          return Arrow(src = self, tgt = self.__class__(values),
-              basicArrow = self.translate().forwardOnRight(arrow.translate()).forwardFollow(f(0)))
-      else:
-        values = [self.values[0]]
-        values.extend(tgt_values)
-        return Arrow(src = self, tgt = self.__class__(values),
-            basicArrow = self.translate().forwardOnRight(arrow.translate()).forwardFollow(lambda x:
-              x.forwardRemoveRightIfUnit()))
+          values.append(value)
+      if len(values) == len(self.values) and _allSame(self.values, values):
+        return self.identity()
+      return self.forwardRearrange(self.__class__(values))
 
   def backwardIntroduceUnits(self):
     return self.forwardRemoveUnits().invert()
 
+  # tgt: a conjunction of the same class as self, whose values are a permutation of
+  #      the values of self, up to associativity and units.
+  # return: an arrow self --> tgt consisting of a single basic arrow.
+  def forwardRearrange(self, tgt):
+    return Arrow(src = self, tgt = tgt,
+        basicArrow = basicFormula.Rearrange(src = self.translate(), tgt = tgt.translate(),
+          conjunction = self._basicBinop))
+
+  # permutation: a list of the indices of self.values in some order.
+  # return: an arrow self --> self.__class__([self.values[i] for i in permutation])
+  def forwardPermute(self, permutation):
+    assert(sorted(permutation) == range(len(self.values)))
+    return self.forwardRearrange(self.__class__([self.values[i] for i in permutation]))
+
   def forwardMoveBack(self, i, amount):
-    values = list(self.values)
-    a = values.pop(i)
-    values.insert(i - amount, a)
-    return self.__class__(values).forwardMoveForward(i - amount, amount).invert()
+    permutation = range(len(self.values))
+    a = permutation.pop(i)
+    permutation.insert(i - amount, a)
+    return self.forwardPermute(permutation)
 
   def forwardMoveForward(self, i, amount):
-    values = list(self.values)
-    a = values.pop(i)
-    values.insert(i + amount, a)
-    def f(j, x):
-      if j == i:
-        def g(k, x):
-          if k == amount:
-            return x.identity()
-          else:
-            if i + amount == len(self.values) - 1 and k+1 == amount:
-              return x.forwardCommute()
-            else:
-              return x.forwardAssociateOther().forwardFollow(lambda x:
-                  x.forwardOnLeftFollow(lambda x:
-                    x.forwardCommute()).forwardFollow(lambda x:
-                      x.forwardAssociate().forwardFollow(lambda x:
-                        x.forwardOnRightFollow(lambda x:
-                          g(k+1, x)))))
-
-        return g(0, x)
-      else:
-        return x.forwardOnRightFollow(lambda x: f(j+1, x))
-    return Arrow(src = self, tgt = self.__class__(values),
-        basicArrow = f(0, self.translate()))
+    permutation = range(len(self.values))
+    a = permutation.pop(i)
+    permutation.insert(i + amount, a)
+    return self.forwardPermute(permutation)
 
   def forwardOnArrows(self, arrows):
     assert(len(arrows) > 0)
@@ -653,13 +934,20 @@ class Conjunction(Formula):
         leftArrow = arrows[i].basicArrow
         rightArrow = f(i + 1)
         return basicFormula.OnConjunction(leftArrow = leftArrow, rightArrow = rightArrow,
-            src = self.basicBinop(leftArrow.src, rightArrow.src),
-            tgt = self.basicBinop(leftArrow.tgt, rightArrow.tgt))
+            src = self._basicBinop(leftArrow.src, rightArrow.src),
+            tgt = self._basicBinop(leftArrow.tgt, rightArrow.tgt))
     return f(0)
 
   def substituteVariable(self, a, b):
     return self.__class__(values = [v.substituteVariable(a, b) for v in self.values])
 
+  def substitute(self, mapping):
+    values = [v.substitute(mapping) for v in self.values]
+    if _allSame(self.values, values):
+      return self
+    else:
+      return self.__class__(values = values)
+
   def updateVariables(self):
     return self.__class__(values = [v.updateVariables() for v in self.values])
 
@@ -683,6 +971,8 @@ class Conjunction(Formula):
         spacing = distances.divider_spacing)
 
 class And(Conjunction):
+  __slots__ = []
+
   def is_and(self):
     return True
 
@@ -825,6 +1115,8 @@ class And(Conjunction):
               x.forwardUndoubleDual()))
 
 class Or(Conjunction):
+  __slots__ = []
+
   def basicBinop(self):
     return basicFormula.Or
   def name(self):
@@ -866,6 +1158,8 @@ true = And([])
 false = Or([])
 
 class Iff(Formula):
+  __slots__ = ['left', 'right']
+
   def __init__(self, left, right):
     self.left = left
     self.right = right
@@ -881,6 +1175,13 @@ class Iff(Formula):
   def substituteVariable(self, a, b):
     return Iff(left = self.left.substituteVariable(a, b),
         right = self.right.substituteVariable(a, b))
+  def substitute(self, mapping):
+    left = self.left.substitute(mapping)
+    right = self.right.substitute(mapping)
+    if _allSame([self.left, self.right], [left, right]):
+      return self
+    else:
+      return Iff(left = left, right = right)
 
   def forwardLeftToRight(self):
     return Arrow(src = self,
@@ -905,6 +1206,8 @@ class Iff(Formula):
       return primitives.surroundWithNot(res)
 
 class Hidden(Formula):
+  __slots__ = ['base', 'name']
+
   def __init__(self, base, name):
     self.base = base
     self.name = name
@@ -920,24 +1223,42 @@ class Hidden(Formula):
 
   def __repr__(self):
     return "<<" + self.name + ">>"
+  def _hashParts(self):
+    return self.base.hashParts()
+  def _sameConstruction(self, other):
+    return self.base == other.base
   def _translate(self):
     return self.base.translate()
   def updateVariables(self):
     return Hidden(base = self.base.updateVariables(), name = self.name)
   def substituteVariable(self, a, b):
     return Hidden(base = self.base.substituteVariable(a, b), name = self.name)
+  def substitute(self, mapping):
+    base = self.base.substitute(mapping)
+    if base is self.base:
+      return self
+    else:
+      return Hidden(base = base, name = self.name)
 
 class Identical(Formula):
+  __slots__ = ['left', 'right']
+
   def __init__(self, left, right):
     self.left = left
     self.right = right
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     if self.left == self.right:
       return 
   def applied_variables(self):
     return self.left.applied_variables().union(self.right.applied_variables())
   def __repr__(self):
     return "%s = %s"%(self.left, self.right)
+  def _structuralSignature(self):
+    return _internSignature('Identical')
+  def _hashParts(self):
+    return basicFormula.identicalHashParts(self.left, self.right)
+  def _sameConstruction(self, other):
+    return self.left == other.left and self.right == other.right
   def _translate(self):
     return basicFormula.Identical(self.left, self.right)
   def updateVariables(self):
@@ -945,17 +1266,24 @@ class Identical(Formula):
   def substituteVariable(self, a, b):
     return Identical(left = self.left.substituteVariable(a, b),
         right = self.right.substituteVariable(a, b))
+  def substitute(self, mapping):
+    left = self.left.substitute(mapping)
+    right = self.right.substitute(mapping)
+    if _allSame([self.left, self.right], [left, right]):
+      return self
+    else:
+      return Identical(left = left, right = right)
   def render(self, context):
     return self.left.render().stack(0, primitives.identical(context.covariant)).stack(0,
         self.right.render())
-  def forwardSimplify(self):
+  def _forwardSimplify(self):
     if self.left == self.right:
       return Arrow(src = self, tgt = And([]),
           basicArrow = basicFormula.IdenticalReflexive(src = self.translate(),
             tgt = basicFormula.true))
     else:
       return self.identity()
-  def backwardSimplify(self):
+  def _backwardSimplify(self):
     if self.left == self.right:
       return Arrow(tgt = self, src = And([]),
           basicArrow = basicFormula.IdenticalReflexive(src = self.translate(),
@@ -972,6 +1300,8 @@ def Equal(a, b, e):
       variable.ApplySymbolVariable(e, relationSymbol)))
 
 class Unique(Formula):
+  __slots__ = ['variable', 'equivalence', 'formula', 'newVariable']
+
   def __init__(self, variable, equivalence, formula, newVariable = None):
     self.variable = variable
     self.equivalence = equivalence
@@ -999,6 +1329,18 @@ class Unique(Formula):
         formula = self.formula.substituteVariable(a, b),
         newVariable = self.newVariable)
 
+  def substitute(self, mapping):
+    for (a, b) in mapping.iteritems():
+      assert(b != self.newVariable)
+      assert(a != self.newVariable)
+    olds = [self.variable, self.equivalence, self.formula]
+    news = [x.substitute(mapping) for x in olds]
+    if _allSame(olds, news):
+      return self
+    else:
+      return Unique(variable = news[0], equivalence = news[1], formula = news[2],
+          newVariable = self.newVariable)
+
   def updateVariables(self):
     return Unique(variable = self.variable,
         equivalence = self.equivalence,
@@ -19,9 +19,14 @@ class Arrow:
   def translate(self):
     return self.enrichedArrow.translate()
 
-def newArrow(src, tgt, basicArrow):
-  return Arrow(src = src, tgt = tgt,
-      enrichedArrow = formula.Arrow(src = src.top(), tgt = tgt.top(), basicArrow = basicArrow))
+# trusted: True when basicArrow was built by applying the endofunctor of src, which is also
+#          the endofunctor of tgt, to a checked arrow.
+def newArrow(src, tgt, basicArrow, trusted = False):
+  if trusted:
+    enrichedArrow = formula.trustedArrow(src = src.top(), tgt = tgt.top(), basicArrow = basicArrow)
+  else:
+    enrichedArrow = formula.Arrow(src = src.top(), tgt = tgt.top(), basicArrow = basicArrow)
+  return Arrow(src = src, tgt = tgt, enrichedArrow = enrichedArrow)
 
 def newIdentityArrow(src, tgt):
   return newArrow(src = src, tgt = tgt, basicArrow = src.top().translate().identity())
@@ -29,30 +34,39 @@ def newIdentityArrow(src, tgt):
 def new_path(formula):
   return Path(formula = formula, endofunctor = endofunctor.identity_functor)
 
+# A path caches its top formula.  Moving along a path with advance or retreat does not
+# change the top, so the new path shares the cached top, and its translation, instead of
+# rebuilding it.  Only arrows that change the bottom produce a path whose top is dirty.
 class Path:
-  def __init__(self, formula, endofunctor):
+  # top: None, or a formula equal to endofunctor.onObject(formula)
+  def __init__(self, formula, endofunctor, top = None):
     self.formula = formula
     self.endofunctor = endofunctor
+    self._top = top
 
   # self.endofunctor must be covariant.
   # spec: a SearchSpec instance.
   # return: a list of pairs (B, f) such that spec.valid(B) and
   # f() is a an arrow :
   #   self -> Path(formula = And([B, self.formula]), endofunctor = self.endofunctor)
+  # The claims are found with the cached search of self.endofunctor, and the natural
+  # transform importing a claim is built only when its f is called.
   def search(self, spec):
     assert(self.endofunctor.covariant())
     return [( B
-            , lambda B=B, nt=nt: newArrow(src = self,
+            , lambda B=B: newArrow(src = self,
               tgt = Path(formula = formula.And([B, self.formula]),
                 endofunctor = self.endofunctor),
-              basicArrow = nt(self.formula.translate())) )
-      for B in self.endofunctor.search(spec)
-      for nt in [self.endofunctor.translate().importExactly(B.translate())]]
+              basicArrow = self.endofunctor.translate().importExactly(B.translate())(
+                self.formula.translate())) )
+      for B in self.endofunctor.cachedSearch(spec)]
 
   def bottom(self):
     return self.formula
   def top(self):
-    return self.endofunctor.onObject(self.formula)
+    if self._top is None:
+      self._top = self.endofunctor.onObject(self.formula)
+    return self._top
   def identity(self):
     return newIdentityArrow(src = self, tgt = self)
   def onPath(self, enrichedArrow):
@@ -62,7 +76,8 @@ class Path:
       formula = enrichedArrow.src
     return newArrow(src = self,
         tgt = Path(formula = formula, endofunctor = self.endofunctor),
-        basicArrow = self.endofunctor.translate().onArrow(enrichedArrow.translate()))
+        basicArrow = self.endofunctor.translate().onArrow(enrichedArrow.translate()),
+        trusted = True)
 
   def onFormulaAndEndofunctorFollow(self, f):
     enrichedArrow, newFormula = f(self.formula, self.endofunctor)
@@ -87,13 +102,14 @@ class Path:
 
   def retreatTotally(self):
     return newIdentityArrow(src = self,
-        tgt = Path(formula = self.top(), endofunctor = endofunctor.identity_functor))
+        tgt = Path(formula = self.top(), endofunctor = endofunctor.identity_functor,
+          top = self.top()))
 
   def retreat(self, n = None):
     if n is None:
       (a, b) = self.endofunctor.factor_left()
       return newIdentityArrow(src = self,
-          tgt = Path(formula = a.onObject(self.formula), endofunctor = b))
+          tgt = Path(formula = a.onObject(self.formula), endofunctor = b, top = self.top()))
     else:
       a = self.identity()
       for i in range(n):
@@ -142,7 +158,7 @@ class Path:
   def advance(self, index = None):
     a, b = self._factor_for_advance(index)
     return newIdentityArrow(src = self,
-        tgt = Path(formula = a, endofunctor = b.compose(self.endofunctor)))
+        tgt = Path(formula = a, endofunctor = b.compose(self.endofunctor), top = self.top()))
 
   def advanceAll(self, indices):
     a = self.identity()
@@ -151,13 +167,16 @@ class Path:
           p.advance(index))
     return a
 
+  # A bottom already in normal form is skipped.
   def simplifyBottom(self):
     if self.covariant():
-      return self.onPathFollow(lambda x:
-          x.forwardSimplify())
+      arrow = self.bottom().forwardSimplify()
     else:
-      return self.onPathFollow(lambda x:
-          x.backwardSimplify())
+      arrow = self.bottom().backwardSimplify()
+    if arrow.src is arrow.tgt:
+      return self.identity()
+    else:
+      return self.onPath(arrow)
 
   def heavySimplifyWithin(self, index = None):
     return self.advance(index).forwardFollow(lambda p:
@@ -168,15 +187,15 @@ class Path:
     return self.heavySimplifyWithin(index).forwardFollow(lambda p:
         p.simplifyBottom())
 
-  def importAboutNegating(self, variables, f, g):
+  def importAboutNegating(self, variables, f, g, about = None):
     return self.onFormulaAndEndofunctorFollow(lambda x, e:
         e.importAboutNegating(variables = variables,
-          f = f, g = g, x = self.bottom()))
+          f = f, g = g, x = self.bottom(), about = about))
 
-  def importAbout(self, variables, f, g):
+  def importAbout(self, variables, f, g, about = None):
     return self.onFormulaAndEndofunctorFollow(lambda x, e:
         e.importAbout(variables = variables,
-          f = f, g = g, x = self.bottom()))
+          f = f, g = g, x = self.bottom(), about = about))
 
   def maybeExportBottom(self):
     if self.covariant():
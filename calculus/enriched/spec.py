@@ -7,6 +7,11 @@ class SearchSpec:
     raise Exception("Abstract superclass.")
   def search_hidden_formula(self, name):
     raise Exception("Abstract superclass.")
+  # self must search every hidden formula.
+  # database: a ClaimDatabase of the claims found by searching with a spec accepting everything.
+  # return: the list of the claims of database valid for self.
+  def lookup(self, database):
+    return [claim for claim in database.claims if self.valid(claim)]
 
 class SimpleSearchSpec(SearchSpec):
   def __init__(self, f):
@@ -18,7 +23,8 @@ class SimpleSearchSpec(SearchSpec):
   def search_hidden_formula(self, name):
     return True
 
+# Formulas are equal iff their translations are, but they are compared without translating
+# them where possible.
 def equal_translates_search_spec(formula):
-  t = formula.translate()
-  return SimpleSearchSpec(lambda x: t == x.translate())
+  return SimpleSearchSpec(lambda x: formula == x)
 
@@ -2,11 +2,15 @@
 
 from sets import Set
 from calculus import symbol
+from misc import Slotted
+import weakref
 
 from ui.render.text import primitives, colors, distances
 from ui.stack import stack
 
-class GeneralizedVariable:
+class GeneralizedVariable(Slotted):
+  __slots__ = []
+
   # Return an equivalent variable that is possibly simpler.
   def simplify(self):
     return self
@@ -14,11 +18,171 @@ class GeneralizedVariable:
     raise Exception("Abstract superclass.")
   def applied_variables(self):
     raise Exception("Abstract superclass.")
+  # return: the hash parts of self, as described below.
+  # Formulas combine the parts of their subformulas into hashes that respect alpha equivalence.
+  def hashParts(self):
+    raise Exception("Abstract superclass.")
+  # return: a key such that equal variables have equal keys, and keys of unequal variables
+  #         can be compared to order them.
+  def sortKey(self):
+    raise Exception("Abstract superclass.")
+  # mapping: a dictionary mapping variables to generalized variables.
+  # return: self with each key of mapping replaced by its value, simultaneously.
+  #         Returns self itself when no key of mapping occurs in self.
+  def substitute(self, mapping):
+    raise Exception("Abstract superclass.")
   def relatedVariable(self):
     return StringVariable('z')
 
+# The hash parts of a variable or formula are a tuple (shape, weight, free, children, multipliers):
+#   shape is a hash that ignores the names of free variables.
+#   free is the bitset of the ids of the free variables.
+#   children is a tuple of the parts of the immediate subterms, and multipliers is a tuple
+#     holding the multiplier of the position of each of them.
+#   weight is the sum, over the free occurrences of each variable, of the weight of the
+#     variable times the product of the multipliers along the path to the occurrence.
+# The weight of a term is a linear combination of the weights of its children, so the parts of
+# a term are computed from those of its children in time proportional to their number.
+# The positions of a single variable can be recovered with positionsOf.
+
+# Weights are computed modulo this prime.
+_modulus = (1 << 61) - 1
+
+# _multipliers[n] is the tuple of the multipliers of the positions of n ordered children.
+_multipliers = {}
+
+def _positionMultipliers(n):
+  result = _multipliers.get(n)
+  if result is None:
+    result = tuple([hash(('position', i)) % _modulus for i in range(n)])
+    _multipliers[n] = result
+  return result
+
+# The children of symmetric terms all share a position.
+_symmetricMultiplier = hash('symmetric') % _modulus
+
+# shape: a hash of the node, ignoring its children.
+# children: a list of the hash parts of the children of the node.
+# symmetric: True iff the node does not depend on the order of its children.
+# return: the hash parts of the node.
+def nodeParts(shape, children, symmetric = False):
+  if symmetric:
+    multipliers = (_symmetricMultiplier,) * len(children)
+  else:
+    multipliers = _positionMultipliers(len(children))
+  weight = 0
+  free = 0
+  shapes = [shape]
+  for i in range(len(children)):
+    child = children[i]
+    weight += multipliers[i] * child[1]
+    free |= child[2]
+    shapes.append(child[0])
+  if symmetric:
+    shapes[1:] = sorted(shapes[1:])
+  return (hash(tuple(shapes)), weight % _modulus, free, tuple(children), multipliers)
+
+# parts: hash parts
+# variableId: the _id of a variable.
+# return: the sum, over the free occurrences of the variable in the term with the given parts,
+#         of the product of the multipliers along the path to the occurrence.
+# Only the subterms in which the variable is free are visited.
+def positionsOf(parts, variableId):
+  bit = 1 << variableId
+  result = 0
+  stack = [(parts, 1)]
+  while len(stack) > 0:
+    (shape, weight, free, children, multipliers), product = stack.pop()
+    if free & bit == 0:
+      continue
+    elif len(children) == 0:
+      result += product
+    else:
+      for i in range(len(children)):
+        stack.append((children[i], product * multipliers[i] % _modulus))
+  return result % _modulus
+
+# shape: a hash of the binder, ignoring its body.
+# variable: the variable bound by the binder.
+# parts: the hash parts of the body of the binder.
+# return: the hash parts of the binder.
+# The bound variable contributes the positions at which it occurs, but not its name.
+def binderParts(shape, variable, parts):
+  positions = positionsOf(parts, variable._id)
+  shape, weight, free, children, multipliers = nodeParts(hash((shape, positions)), [parts])
+  weight = (weight - multipliers[0] * positions * variable._weight()) % _modulus
+  return (shape, weight, free & ~(1 << variable._id), children, multipliers)
+
 n_variables = 0
+_variableShape = hash('Variable')
+
+# The variables that may be members of a FreeVariables, by _id.
+_variables = weakref.WeakValueDictionary()
+
+# variables: a FreeVariables or an iterable of variables
+# return: the bitset of the ids of variables.
+def _bits(variables):
+  if variables.__class__ == FreeVariables:
+    return variables.bits
+  else:
+    result = 0
+    for variable in variables:
+      result |= variable.freeVariables().bits
+    return result
+
+# An immutable set of variables, represented as a bitset of their ids.
+# Formulas cache the bitsets of their free variables, so that freeVariables() does
+# not need to rebuild a set on each call.
+class FreeVariables(object):
+  __slots__ = ['bits']
+
+  def __init__(self, bits):
+    self.bits = bits
+
+  def __contains__(self, variable):
+    return isinstance(variable, Variable) and (self.bits >> variable._id) & 1 == 1
+
+  def __iter__(self):
+    bits = self.bits
+    while bits != 0:
+      lowest = bits & -bits
+      yield _variables[lowest.bit_length() - 1]
+      bits ^= lowest
+
+  def __len__(self):
+    return bin(self.bits).count('1')
+
+  def __nonzero__(self):
+    return self.bits != 0
+
+  def __eq__(self, other):
+    return other.__class__ == FreeVariables and self.bits == other.bits
+  def __ne__(self, other):
+    return not(self == other)
+  def __hash__(self):
+    return hash(self.bits)
+
+  def __repr__(self):
+    return "FreeVariables(%s)"%(list(self),)
+
+  def union(self, other):
+    return FreeVariables(self.bits | _bits(other))
+
+  def intersection(self, other):
+    return FreeVariables(self.bits & _bits(other))
+
+  def difference(self, other):
+    return FreeVariables(self.bits & ~_bits(other))
+
+  def isdisjoint(self, other):
+    return self.bits & _bits(other) == 0
+
+noFreeVariables = FreeVariables(0)
+
 class Variable(GeneralizedVariable):
+  # Variables are weakly referenced by _variables.
+  __slots__ = ['_id', '__weakref__']
+
   def __init__(self):
     self._generate_id()
 
@@ -26,6 +190,11 @@ class Variable(GeneralizedVariable):
     global n_variables
     self._id = n_variables
     n_variables += 1
+    _variables[self._id] = self
+
+  def __setstate__(self, state):
+    GeneralizedVariable.__setstate__(self, state)
+    _variables[self._id] = self
 
   def updateVariables(self):
     return Variable()
@@ -37,6 +206,16 @@ class Variable(GeneralizedVariable):
   def __hash__(self):
     return hash(self._id)
 
+  def hashParts(self):
+    return (_variableShape, self._weight(), 1 << self._id, (), ())
+
+  # return: the weight of self in hash parts.
+  def _weight(self):
+    return hash(('Variable', self._id)) % _modulus
+
+  def sortKey(self):
+    return (0, self._id)
+
   def applied_variables(self):
     return Set([])
 
@@ -49,10 +228,54 @@ class Variable(GeneralizedVariable):
     else:
       return self
 
+  def substitute(self, mapping):
+    return mapping.get(self, self)
+
+  def freeVariables(self):
+    return FreeVariables(1 << self._id)
+
+# The variable bound by the index-th enclosing binder, in the locally nameless
+# representation of canonical formulas.
+class BoundVariable(GeneralizedVariable):
+  __slots__ = ['index']
+
+  def __init__(self, index):
+    self.index = index
+
+  def __eq__(self, other):
+    return other.__class__ == BoundVariable and self.index == other.index
+  def __ne__(self, other):
+    return not(self == other)
+  def __hash__(self):
+    return hash(('BoundVariable', self.index))
+
+  def __repr__(self):
+    return "<bound variable %s>"%(self.index,)
+
+  def hashParts(self):
+    return (hash(self), 0, 0, (), ())
+
+  def sortKey(self):
+    return (1, self.index)
+
+  def applied_variables(self):
+    return Set([])
+
+  def updateVariables(self):
+    return self
+
+  def substituteVariable(self, a, b):
+    return self
+
+  def substitute(self, mapping):
+    return self
+
   def freeVariables(self):
-    return Set([self])
+    return noFreeVariables
 
 class StringVariable(Variable):
+  __slots__ = ['_name', 'infix']
+
   # infix: either None, or a pair of symbols (a, b) such that when this variable holds
   #        of a variable v, v is a product variable over symbols a and b.
   def __init__(self, name, infix = None):
@@ -92,6 +315,8 @@ def renderInfix(productVariable, infixSymbols, infixVariable):
                            spacing = distances.infixSpacing)
 
 class ApplySymbolVariable(GeneralizedVariable):
+  __slots__ = ['variable', 'symbol']
+
   def __init__(self, variable, symbol):
     self.variable = variable
     self.symbol = symbol
@@ -106,12 +331,24 @@ class ApplySymbolVariable(GeneralizedVariable):
       return self.variable.applied_variables()
   def __ne__(self, other):
     return not (self == other)
+  def __hash__(self):
+    return hash((self.variable, self.symbol))
+  def hashParts(self):
+    return nodeParts(hash(('ApplySymbol', self.symbol)), [self.variable.hashParts()])
+  def sortKey(self):
+    return (2, self.variable.sortKey(), _symbolKey(self.symbol))
   def __repr__(self):
     return "<: " + repr(self.variable) + " :: " + repr(self.symbol) + " :>"
   def updateVariables(self):
     return ApplySymbolVariable(variable = self.variable.updateVariables(), symbol = self.symbol)
   def substituteVariable(self, a, b):
     return ApplySymbolVariable(variable = self.variable.substituteVariable(a, b), symbol = self.symbol)
+  def substitute(self, mapping):
+    variable = self.variable.substitute(mapping)
+    if variable is self.variable:
+      return self
+    else:
+      return ApplySymbolVariable(variable = variable, symbol = self.symbol)
   def freeVariables(self):
     return self.variable.freeVariables()
 
@@ -127,6 +364,10 @@ class ApplySymbolVariable(GeneralizedVariable):
       symbolStack = renderSymbol(self.symbol)
       return self.variable.render().stack(0, primitives.dot).stack(0, symbolStack)
 
+# symbol: a symbol or a variable used as a symbol.
+def _symbolKey(symbol):
+  return (symbol.__class__.__name__, symbol._id)
+
 def colors_for_symbol(symbol):
   if isinstance(symbol, Variable):
     return (colors.callSymbolBackgroundColor, colors.callVariableBackgroundColor)
@@ -137,6 +378,8 @@ def colors_for_symbol(symbol):
 # meant to be used for objects, nether have they any sort of computational manifestation.
 # They are ENTIRELY FOR BOOKEEPING.
 class ProductVariable(GeneralizedVariable):
+  __slots__ = ['symbol_variable_pairs']
+
   def __init__(self, symbol_variable_pairs):
     self.symbol_variable_pairs = symbol_variable_pairs
 
@@ -151,6 +394,13 @@ class ProductVariable(GeneralizedVariable):
         and self.symbol_variable_pairs == other.symbol_variable_pairs)
   def __ne__(self, other):
     return not(self == other)
+  def __hash__(self):
+    return hash(tuple(self.symbol_variable_pairs))
+  def hashParts(self):
+    return nodeParts(hash(('Product', tuple([s for (s, v) in self.symbol_variable_pairs]))),
+        [v.hashParts() for (s, v) in self.symbol_variable_pairs])
+  def sortKey(self):
+    return (3, tuple([(_symbolKey(s), v.sortKey()) for (s, v) in self.symbol_variable_pairs]))
   def __repr__(self):
     return "{" + ", ".join([repr(s) + ": " + repr(v) for (s,v) in self.symbol_variable_pairs]) + "}"
   def updateVariables(self):
@@ -160,11 +410,14 @@ class ProductVariable(GeneralizedVariable):
     return ProductVariable(
         symbol_variable_pairs = [(s, v.substituteVariable(a, b))
                                  for (s,v) in self.symbol_variable_pairs])
+  def substitute(self, mapping):
+    pairs = [(s, v.substitute(mapping)) for (s, v) in self.symbol_variable_pairs]
+    for i in range(len(pairs)):
+      if pairs[i][1] is not self.symbol_variable_pairs[i][1]:
+        return ProductVariable(symbol_variable_pairs = pairs)
+    return self
   def freeVariables(self):
-    result = Set()
-    for (s, v) in self.symbol_variable_pairs:
-      result.union_update(v.freeVariables())
-    return result
+    return FreeVariables(_bits([v for (s, v) in self.symbol_variable_pairs]))
 
   def render(self):
     symbolVariablePairs = []
@@ -2,6 +2,7 @@
 
 from sets import Set
 from calculus.enriched import constructors, path, formula as enrichedFormula
+from calculus.basic import formula as basicFormula
 
 n_libraries = 0
 
@@ -64,10 +65,14 @@ class Proof:
       self.arrow = self.arrow.forwardFollow(lambda p: p.advance())
       self.arrow = self.arrow.forwardFollow(lambda p: p.forwardAndTrue())
     else:
-      assert(arrow.src.top().translate() == library.formula().translate())
       self.arrow = arrow
+      basicFormula.validateByPolicy(self)
     self.tgt = self.arrow.tgt
 
+  # Throw an exception if self does not begin at the formula of self.library.
+  def validate(self):
+    assert(self.arrow.src.top().translate() == self.library.formula().translate())
+
   def translate(self):
     return self.arrow.translate()
 
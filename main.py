@@ -1,9 +1,5 @@
 # Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
 
-from sys import setrecursionlimit
-
-setrecursionlimit(50000000)
-
 from ui.run.text import static
 from lib import natural, equivalence, common_vars
 from examples import QR
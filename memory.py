@@ -0,0 +1,125 @@
+# Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
+
+# Report how many bytes the nodes of a proof occupy.
+#   python memory.py [--save file] [--baseline file] [module]
+# module: the name of a module defining a proof.  Defaults to examples.QR
+# --save file: also write the measurement to file.
+# --baseline file: also report a measurement written by --save, and the change from it.
+# To compare against an older revision, copy this script into a checkout of that revision
+# and run it there with --save, then run it here with --baseline.
+
+import gc
+import json
+import sys
+import types
+
+_nodeModules = ['calculus.basic.formula', 'calculus.variable', 'calculus.enriched.formula']
+
+# Objects of these types are containers whose referents may be nodes.
+_containerTypes = [types.InstanceType, dict, list, tuple, set, frozenset]
+
+# x: an object.
+# return: the bytes used by x, including the __dict__ of x if it has one.
+def sizeOf(x):
+  result = sys.getsizeof(x)
+  if hasattr(x, '__dict__') and not isinstance(x, type):
+    result += sys.getsizeof(x.__dict__)
+  return result
+
+def isNode(x):
+  return (not isinstance(x, (type, types.ClassType))
+      and hasattr(x, '__class__')
+      and x.__class__.__module__ in _nodeModules)
+
+# root: an object.
+# return: a dictionary mapping the name of each node class to a pair (count, bytes)
+#         over the nodes reachable from root.
+def measure(root):
+  seen = set()
+  result = {}
+  stack = [root]
+  while len(stack) > 0:
+    x = stack.pop()
+    if id(x) in seen:
+      continue
+    seen.add(id(x))
+    if isNode(x):
+      name = "%s.%s"%(x.__class__.__module__, x.__class__.__name__)
+      count, total = result.get(name, (0, 0))
+      result[name] = (count + 1, total + sizeOf(x))
+    elif type(x) not in _containerTypes:
+      continue
+    for y in gc.get_referents(x):
+      if isNode(y) or type(y) in _containerTypes:
+        stack.append(y)
+  return result
+
+# return: the pair (nodes, bytes) summed over all the classes of result.
+def totals(result):
+  nodes = 0
+  total = 0
+  for count, size in result.values():
+    nodes += count
+    total += size
+  return (nodes, total)
+
+def report(result):
+  for name in sorted(result.keys()):
+    count, size = result[name]
+    print "%-55s %8d nodes %10d bytes %6.1f bytes/node"%(name, count, size, float(size) / count)
+  nodes, total = totals(result)
+  print "%-55s %8d nodes %10d bytes %6.1f bytes/node"%("total", nodes, total, float(total) / max(nodes, 1))
+
+def bytesPerNode(result):
+  nodes, total = totals(result)
+  return float(total) / max(nodes, 1)
+
+# baseline, result: two results of measure.
+def compare(baseline, result):
+  print "before:"
+  report(baseline)
+  print
+  print "after:"
+  report(result)
+  print
+  before = bytesPerNode(baseline)
+  after = bytesPerNode(result)
+  print "bytes/node: %.1f -> %.1f (%.1f%%)"%(before, after, 100.0 * (after - before) / max(before, 1))
+
+def save(result, fileName):
+  f = open(fileName, 'w')
+  try:
+    json.dump(result, f, indent = 1, sort_keys = True)
+  finally:
+    f.close()
+
+def load(fileName):
+  f = open(fileName)
+  try:
+    return dict([(name, tuple(pair)) for name, pair in json.load(f).items()])
+  finally:
+    f.close()
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  saveName = None
+  baselineName = None
+  while len(args) > 1 and args[0] in ['--save', '--baseline']:
+    if args[0] == '--save':
+      saveName = args[1]
+    else:
+      baselineName = args[1]
+    args = args[2:]
+  if len(args) > 0:
+    moduleName = args[0]
+  else:
+    moduleName = 'examples.QR'
+  __import__(moduleName)
+  proof = sys.modules[moduleName].proof
+  result = measure(proof)
+  if saveName is not None:
+    save(result, saveName)
+  if baselineName is None:
+    report(result)
+  else:
+    compare(load(baselineName), result)
@@ -20,3 +20,21 @@ def _interleave(a, xs):
   result.append(xs[-1])
   return result
 
+
+# A base for classes whose instances store their attributes in __slots__ instead of
+# in a __dict__.  Such instances are much smaller, but they can only be pickled
+# when they supply their own state.
+class Slotted(object):
+  __slots__ = []
+
+  def __getstate__(self):
+    state = {}
+    for cls in self.__class__.__mro__:
+      for name in cls.__dict__.get('__slots__', []):
+        if name != '__weakref__' and hasattr(self, name):
+          state[name] = getattr(self, name)
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.iteritems():
+      setattr(self, name, value)
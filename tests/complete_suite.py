@@ -1,10 +1,14 @@
 # Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
 
 import unittest
-from tests import test_basic_bifunctor, test_basic_endofunctor, test_enriched_functors, test_path
+from calculus.enriched import formula as enrichedFormula
+from tests import test_basic_formula, test_basic_bifunctor, test_basic_endofunctor, test_enriched_functors, test_path
 
 def suite():
-  testSuite = unittest.TestSuite(( test_basic_bifunctor.suite()
+  # The tests check every trusted arrow, not just a sample of them.
+  enrichedFormula.setAuditLevel(enrichedFormula.auditAll)
+  testSuite = unittest.TestSuite(( test_basic_formula.suite()
+                                 , test_basic_bifunctor.suite()
                                  , test_basic_endofunctor.suite()
                                  , test_enriched_functors.suite()
                                  , test_path.suite()))
@@ -2,8 +2,10 @@
 
 from misc import *
 
+import gc
 import unittest
-from calculus.basic import endofunctor, formula
+import weakref
+from calculus.basic import endofunctor, formula, instantiator
 from calculus.enriched import formula as enrichedFormula
 from calculus import variable
 from lib import common_vars
@@ -101,6 +103,333 @@ class ExactImportTests(ImportTest, common_objects.CommonObjects):
     self.assert_can_import_B_from(self.or_d_of_c_functor.compose(self.not_not_functor).compose(self.and_B))
     self.assert_can_import_B_from(self.or_d_of_c_functor.compose(self.not_not_functor.compose(self.and_B)))
 
+# A functor importing each of 20 claims.
+class ClaimsTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.claims = [formula.Always(formula.Holds(self.a, variable.StringVariable('p%s'%(i,))))
+        for i in range(20)]
+    self.functor = endofunctor.identity_functor
+    for claim in self.claims:
+      self.functor = endofunctor.And(side = left, other = claim).compose(self.functor)
+    self.visited = []
+
+  # return: a filter accepting every claim, and recording the claims it was applied to.
+  def accept(self, x):
+    self.visited.append(x)
+    return [x]
+
+class FilteredImportTest(ClaimsTest):
+  def test_first_match_stops_early(self):
+    result = self.functor.importFilteredList(self.accept, 1)
+    self.assertEqual(1, len(result))
+    self.assertEqual(1, len(self.visited))
+    B, nt, X = result[0]
+    self.assertEqual([B], self.visited)
+    self.assertEqual(self.functor.onObject(formula.And(B, formula.true)), nt(formula.true).tgt)
+
+  def test_first_k(self):
+    result = self.functor.importFilteredList(self.accept, 5)
+    self.assertEqual(5, len(result))
+    self.assertEqual(5, len(self.visited))
+    self.assertEqual(5, len(set([B for B, nt, X in result])))
+
+  def test_exhaustive(self):
+    result = self.functor.importFilteredList(self.accept)
+    self.assertEqual(set(self.claims), set([B for B, nt, X in result]))
+    for B, nt, X in result:
+      arrow = nt(formula.true)
+      self.assertEqual(self.functor.onObject(formula.true), arrow.src)
+      self.assertEqual(self.functor.onObject(formula.And(B, formula.true)), arrow.tgt)
+
+  def test_export(self):
+    functor = self.functor.compose(endofunctor.not_functor)
+    result = functor.exportFilteredList(self.accept, 1)
+    self.assertEqual(1, len(result))
+    self.assertEqual(1, len(self.visited))
+    B, nt, X = result[0]
+    self.assertEqual(functor.onObject(formula.true), nt(formula.true).tgt)
+
+  def test_import_exactly(self):
+    nt = self.functor.importExactly(self.claims[7])
+    self.assertEqual(self.functor.onObject(formula.And(self.claims[7], formula.true)),
+        nt(formula.true).tgt)
+    self.assertRaises(endofunctor.UnimportableException, self.functor.importExactly, self.b_of_a)
+
+class ImportIndexTest(ClaimsTest):
+  def test_index_lists_importable_claims(self):
+    self.assertEqual(set(self.claims), set(self.functor.importIndex().keys()))
+    functor = self.functor.compose(endofunctor.not_functor)
+    self.assertEqual(set(self.claims), set(functor.exportIndex().keys()))
+    self.assertEqual(set(self.claims), set(endofunctor.not_functor.compose(functor).importIndex().keys()))
+    self.assertEqual({}, endofunctor.Exists(self.e).importIndex())
+
+  def test_index_is_shared(self):
+    self.functor.importExactly(self.claims[0])
+    larger = endofunctor.Exists(self.e).compose(self.functor)
+    self.assertTrue(larger._layers is self.functor._layers)
+    self.assertEqual(len(self.claims), larger._layers.indexed)
+    self.assertEqual(set(self.claims), set(larger.importIndex().keys()))
+
+  def test_bound_claims_are_not_indexed(self):
+    claim = formula.Always(formula.Holds(self.a, self.b))
+    other = formula.Exists(self.b, formula.And(claim, self.d_of_c))
+    functor = endofunctor.And(side = left, other = other)
+    self.assertEqual(set([self.d_of_c]), set(functor.importIndex().keys()))
+    self.assertRaises(endofunctor.UnimportableException, functor.importExactly, claim)
+
+  def test_first_claim_is_imported(self):
+    functor = endofunctor.And(side = left, other = self.claims[3]).compose(self.functor)
+    for claim in self.claims:
+      expected = functor.importFilteredList(lambda x: [None] if x == claim else [], 1)[0][1]
+      self.assertEqual(expected(formula.true), functor.importExactly(claim)(formula.true))
+
+class FunctorChainTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.exists_a_b = endofunctor.Exists(self.a).compose(endofunctor.Exists(self.b))
+
+  def test_compositions_are_flat(self):
+    functor = self.exists_a_b.compose(endofunctor.not_functor.compose(self.and_b_of_a_functor))
+    self.assertTrue(functor.__class__ == endofunctor.FunctorChain)
+    self.assertEqual(4, functor._length)
+    self.assertTrue(functor.left.__class__ == endofunctor.Exists)
+    self.assertEqual(self.a, functor.left.variable)
+    self.assertTrue(functor.right.left.__class__ == endofunctor.Exists)
+    self.assertEqual(self.and_b_of_a_functor.onObject(formula.Not(
+      formula.Exists(self.b, formula.Exists(self.a, formula.true)))),
+      functor.onObject(formula.true))
+
+  def test_variables_and_variance(self):
+    functor = self.exists_a_b.compose(endofunctor.not_functor).compose(self.exists_c_functor)
+    self.assertEqual([self.a, self.b, self.c], functor.variables())
+    self.assertFalse(functor.covariant())
+    self.assertFalse(functor.right.covariant())
+    self.assertTrue(functor.right.right.right.covariant())
+    self.assertEqual([self.b, self.c], functor.right.variables())
+    self.assertEqual(endofunctor.not_functor, functor.right.right.left)
+
+  def test_pop(self):
+    functor = self.exists_a_b.compose(endofunctor.not_functor)
+    first, rest = functor.pop()
+    self.assertEqual(self.a, first.variable)
+    self.assertEqual([self.b], rest.variables())
+    self.assertFalse(rest.covariant())
+
+  def test_chains_sharing_layers_are_independent(self):
+    base = self.exists_a_b.compose(endofunctor.not_functor)
+    a = self.exists_c_functor.compose(base)
+    b = endofunctor.not_functor.compose(base)
+    self.assertEqual([self.a, self.b], base.variables())
+    self.assertEqual([self.c, self.a, self.b], a.variables())
+    self.assertEqual([self.a, self.b], b.variables())
+    self.assertFalse(a.covariant())
+    self.assertTrue(b.covariant())
+    self.assertEqual(formula.Not(formula.Exists(self.a, formula.Exists(self.b, formula.true))),
+        base.onObject(formula.true))
+
+  def test_deep_chains(self):
+    functor = endofunctor.identity_functor
+    for i in range(3001):
+      functor = endofunctor.not_functor.compose(functor)
+    self.assertEqual(3001, functor._length)
+    self.assertFalse(functor.covariant())
+    self.assertTrue(functor.right.covariant())
+    self.assertEqual(3001, repr(functor.onObject(formula.true)).count('~'))
+
+class NaturalTransformTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.functor = self.or_d_of_c_functor.compose(self.exists_c_functor)
+
+  def test_transforms_are_shared(self):
+    nt = self.functor._import(self.b_of_a)
+    self.assertTrue(isinstance(nt, endofunctor.NaturalTransform))
+    self.assertTrue(nt is self.functor._import(self.b_of_a))
+    self.assertFalse(nt is self.functor._importOther(self.b_of_a))
+    self.assertTrue(nt.functor is self.functor)
+    self.assertEqual('_import', nt.kind)
+    self.assertTrue(nt.B is self.b_of_a)
+
+  def test_components_are_reused(self):
+    nt = self.functor._import(self.b_of_a)
+    arrow = nt(self.e_of_e)
+    self.assertEqual(formula.And(self.b_of_a, self.functor.onObject(self.e_of_e)), arrow.src)
+    self.assertEqual(self.functor.onObject(formula.And(self.b_of_a, self.e_of_e)), arrow.tgt)
+    self.assertTrue(arrow is nt(self.e_of_e))
+    self.assertTrue(arrow is self.functor._import(self.b_of_a)(self.e_of_e))
+    self.assertEqual([((self.e_of_e,), arrow)], nt.components())
+
+  def test_components_are_bounded(self):
+    nt = endofunctor.identity_functor._import(self.b_of_a)
+    for i in range(2 * nt.maxComponents):
+      nt(formula.Always(formula.Holds(self.a, variable.StringVariable('v%s'%(i,)))))
+    self.assertTrue(len(nt.components()) <= nt.maxComponents)
+
+  def test_dropped_formulas_are_freed(self):
+    B = formula.Always(formula.Holds(common_vars.x(), common_vars.y()))
+    x = formula.Not(formula.Holds(common_vars.y(), common_vars.x()))
+    for functor in [endofunctor.identity_functor, endofunctor.always_functor, self.functor]:
+      functor._import(B)(x)
+    refs = [weakref.ref(B), weakref.ref(x)]
+    del B, x
+    gc.collect()
+    self.assertEqual([None, None], [ref() for ref in refs])
+
+  def test_dropped_functors_are_freed(self):
+    B = formula.Always(formula.Holds(common_vars.x(), common_vars.y()))
+    refs = []
+    for i in range(200):
+      functor = endofunctor.And(side = left,
+          other = formula.Holds(self.a, variable.StringVariable('v%s'%(i,))))
+      functor._import(B)(self.e_of_e)
+      refs.append(weakref.ref(functor))
+    del functor
+    gc.collect()
+    self.assertTrue(len([ref for ref in refs if ref() is not None])
+        <= endofunctor.NaturalTransform.maxTransforms)
+    self.assertTrue(len(B._transforms) <= endofunctor.NaturalTransform.maxTransforms)
+
+  def test_failures_are_not_cached(self):
+    self.assertRaises(Exception, endofunctor.always_functor._import, self.d_of_c.value)
+    self.assertRaises(Exception, endofunctor.always_functor._import, self.d_of_c.value)
+    self.assertRaises(endofunctor.UnliftableException, self.exists_c_functor.lift, self.d_of_c)
+
+class ExportNestedAndTest(ClaimsTest):
+  def setUp(self):
+    ClaimsTest.setUp(self)
+    self.functor = endofunctor.not_functor
+    for claim in self.claims[:8]:
+      self.functor = endofunctor.And(side = left, other = claim).compose(self.functor)
+
+  # return: the nested And of xs.
+  def nested(self, xs):
+    result = xs[-1]
+    for x in xs[-2::-1]:
+      result = formula.And(x, result)
+    return result
+
+  def test_export_some(self):
+    x = self.nested([self.claims[3], self.b_of_a, self.claims[5], self.claims[7]])
+    xs, arrow = self.functor.exportNestedAnd(x, 4, lambda y: y != self.claims[5])
+    self.assertEqual([True, False, False, True], xs)
+    self.assertEqual(self.functor.onObject(x), arrow.src)
+    self.assertEqual(self.functor.onObject(formula.And(self.b_of_a,
+      formula.And(self.claims[5], formula.true))), arrow.tgt)
+
+  def test_kept_claims_are_exportable(self):
+    x = self.nested([self.b_of_a, self.b_of_a])
+    decisions = iter([False, True])
+    xs, arrow = self.functor.exportNestedAnd(x, 2, lambda y: decisions.next())
+    self.assertEqual([False, True], xs)
+    self.assertEqual(self.functor.onObject(formula.And(self.b_of_a, formula.true)), arrow.tgt)
+
+  def test_limit(self):
+    x = self.nested([self.claims[0], self.claims[1], self.claims[2]])
+    xs, arrow = self.functor.exportNestedAnd(x, 2, lambda y: True)
+    self.assertEqual([True, False], xs)
+    self.assertEqual(self.functor.onObject(x.right), arrow.tgt)
+    xs, arrow = self.functor.exportNestedAnd(x, 0, lambda y: True)
+    self.assertEqual([], xs)
+    self.assertEqual(self.functor.onObject(x).identity(), arrow)
+
+  def test_blocked_claims(self):
+    functor = endofunctor.SubstituteVariable(self.claims[3].value.holding, self.e).compose(
+        self.functor)
+    self.assertFalse(functor.exportable(self.claims[3]))
+    self.assertTrue(functor.exportable(self.claims[5]))
+    self.assertRaises(endofunctor.UnimportableException, functor.exportExactly, self.claims[3])
+    x = self.nested([self.claims[3], self.claims[5]])
+    xs, arrow = functor.exportNestedAnd(x, 2, lambda y: True)
+    self.assertEqual([False, True], xs)
+    self.assertEqual(functor.onObject(formula.And(self.claims[3], formula.true)), arrow.tgt)
+
+  def test_wide_conjunctions(self):
+    x = self.nested([self.claims[0]] + [self.b_of_a] * 300 + [self.claims[1]])
+    xs, arrow = self.functor.exportNestedAnd(x, 302, lambda y: y != self.b_of_a)
+    self.assertEqual(302, len(xs))
+    self.assertTrue(xs[0])
+    self.assertTrue(xs[-1])
+    self.assertEqual(0, sum(xs[1:-1]))
+
+class ExportByPlanTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.x = common_vars.x()
+    self.y = common_vars.y()
+    self.functor = self.and_b_of_a_functor.compose(endofunctor.not_functor)
+    # Exists x. (a : x) | Exists y. (x : y)
+    self.formula = formula.Exists(self.x, formula.And(
+      formula.Always(formula.Holds(self.a, self.x)),
+      formula.Exists(self.y, formula.Always(formula.Holds(self.y, self.x)))))
+
+  def test_in_order_plan(self):
+    plan = instantiator.inOrderPlan([self.b, self.c], self.formula)
+    self.assertEqual([ (instantiator.instantiateStep, self.b)
+                     , (instantiator.exportStep, left)
+                     , (instantiator.instantiateStep, self.c)], plan.steps)
+    self.assertEqual(2, plan.instantiations())
+    self.assertEqual(2, instantiator.inOrderPlan([self.b, self.c, self.d], self.formula).instantiations())
+
+  def test_export_by_plan(self):
+    plan = instantiator.inOrderPlan([self.b, self.c], self.formula)
+    arrow, value = self.functor.exportByPlan(plan, self.formula)
+    self.assertEqual(self.b_of_c, value)
+    self.assertEqual(self.functor.onObject(self.formula), arrow.src)
+    self.assertEqual(self.functor.onObject(self.b_of_c), arrow.tgt)
+
+  def test_empty_plan(self):
+    arrow, value = self.functor.exportByPlan(instantiator.InstantiationPlan([]), self.formula)
+    self.assertEqual(self.formula, value)
+    self.assertEqual(self.functor.onObject(self.formula).identity(), arrow)
+
+class SubstitutionArrowTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.identical = formula.Always(formula.Identical(self.a, self.b))
+    self.functor = endofunctor.And(side = right, other = self.identical)
+
+  def assert_substitutes(self, functor, x):
+    arrow = endofunctor.substitutionArrow(functor, x, self.a, self.b)
+    self.assertEqual(functor.onObject(x), arrow.src)
+    self.assertEqual(functor.onObject(x.substituteVariable(self.a, self.b)), arrow.tgt)
+    return arrow
+
+  def test_holds(self):
+    self.assert_substitutes(self.functor, formula.Holds(self.a, self.c))
+
+  def test_contravariant(self):
+    self.assert_substitutes(self.functor,
+        formula.And(formula.Holds(self.a, self.c),
+          formula.Not(formula.And(formula.Holds(self.c, self.a), self.d_of_c))))
+
+  def test_binders(self):
+    x = common_vars.x()
+    self.assert_substitutes(self.functor, formula.Exists(x,
+      formula.Or(formula.Identical(self.a, x), formula.Always(formula.Holds(x, self.a)))))
+
+  def test_untouched(self):
+    self.assertEqual(self.functor.onObject(self.d_of_c).identity(),
+        self.assert_substitutes(self.functor, self.d_of_c))
+
+  def test_shared(self):
+    held = formula.Holds(self.a, self.c)
+    x = formula.And(held, formula.And(self.d_of_c, held))
+    arrow = self.assert_substitutes(self.functor, x)
+    self.assertTrue(arrow.tgt.right.right.left is self.d_of_c)
+
+  def test_requires_identical(self):
+    self.assertRaises(endofunctor.UnimportableException,
+        lambda: endofunctor.substitutionArrow(endofunctor.identity_functor,
+          formula.Holds(self.a, self.c), self.a, self.b))
+
 def suite():
-  return unittest.makeSuite(ExactImportTests)
+  return unittest.TestSuite([ unittest.makeSuite(ExactImportTests)
+                            , unittest.makeSuite(FilteredImportTest)
+                            , unittest.makeSuite(ImportIndexTest)
+                            , unittest.makeSuite(FunctorChainTest)
+                            , unittest.makeSuite(NaturalTransformTest)
+                            , unittest.makeSuite(ExportNestedAndTest)
+                            , unittest.makeSuite(ExportByPlanTest)
+                            , unittest.makeSuite(SubstitutionArrowTest)])
 
@@ -0,0 +1,401 @@
+# Copyright (C) 2013 Korei Klein <korei.klein1@gmail.com>
+
+import cPickle as pickle
+import gc
+import sys
+import time
+import unittest
+import weakref
+
+from calculus.basic import formula
+from calculus.variable import StringVariable
+from lib import common_vars
+from tests import common_objects
+
+class InterningTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_identical_formulas_are_shared(self):
+    self.assertTrue(formula.And(self.b_of_a, self.d_of_c) is formula.And(self.b_of_a, self.d_of_c))
+    self.assertTrue(formula.Always(formula.Holds(self.a, self.b)) is self.b_of_a)
+    self.assertTrue(formula.Exists(self.a, self.b_of_a) is formula.Exists(self.a, self.b_of_a))
+    self.assertTrue(formula.Not(formula.Or(self.b_of_a, formula.false))
+        is formula.Not(formula.Or(self.b_of_a, formula.false)))
+
+  def test_different_formulas_are_not_shared(self):
+    self.assertFalse(formula.And(self.b_of_a, self.d_of_c) is formula.And(self.d_of_c, self.b_of_a))
+    self.assertFalse(formula.And(self.b_of_a, self.d_of_c) is formula.Or(self.b_of_a, self.d_of_c))
+    self.assertFalse(formula.Not(self.b_of_a) is formula.Not(self.b_of_a, rendered = True))
+
+  def test_substitution_yields_shared_formulas(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    self.assertTrue(x.substituteVariable(self.c, self.a) is formula.And(self.b_of_a,
+      formula.Always(formula.Holds(self.a, self.d))))
+
+  def test_interned_formulas_are_freed(self):
+    x = formula.Always(formula.Holds(common_vars.x(), common_vars.y()))
+    ref = weakref.ref(x)
+    del x
+    gc.collect()
+    self.assertTrue(ref() is None)
+
+class HashTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_alpha_equivalent_formulas_have_equal_hashes(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, self.d_of_c))
+    y = formula.Exists(self.e, formula.And(formula.Always(formula.Holds(self.e, self.b)), self.d_of_c))
+    self.assertEqual(x, y)
+    self.assertEqual(hash(x), hash(y))
+    self.assertEqual(hash(formula.Identical(self.a, self.b)),
+        hash(formula.Identical(self.b, self.a)))
+    self.assertEqual(hash(formula.Not(self.b_of_a)), hash(formula.Not(self.b_of_a, rendered = True)))
+
+  def test_bound_and_free_variables_hash_differently(self):
+    x = formula.Exists(self.a, formula.Holds(self.a, self.b))
+    y = formula.Exists(self.e, formula.Holds(self.a, self.b))
+    self.assertNotEqual(x, y)
+    self.assertNotEqual(hash(x), hash(y))
+
+  def test_shadowed_variables(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a,
+      formula.Exists(self.a, formula.Holds(self.a, self.b))))
+    y = formula.Exists(self.e, formula.And(formula.Always(formula.Holds(self.e, self.b)),
+      formula.Exists(self.a, formula.Holds(self.a, self.b))))
+    z = formula.Exists(self.e, formula.And(formula.Always(formula.Holds(self.e, self.b)),
+      formula.Exists(self.a, formula.Holds(self.e, self.b))))
+    self.assertEqual(x, y)
+    self.assertEqual(hash(x), hash(y))
+    self.assertNotEqual(x, z)
+    self.assertNotEqual(hash(x), hash(z))
+
+  # Building a node must not cost time proportional to the number of its free variables.
+  def test_wide_conjunctions(self):
+    n = 4000
+    variables = [StringVariable('x%s'%(i,)) for i in range(n)]
+    start = time.time()
+    x = formula.Holds(variables[-1], self.b)
+    for variable in variables[-2::-1]:
+      x = formula.And(formula.Holds(variable, self.b), x)
+    self.assertTrue(time.time() - start < 2.0)
+    y = formula.Exists(variables[0], x)
+    z = formula.Exists(self.e, x.substitute({variables[0]: self.e}))
+    self.assertEqual(hash(y), hash(z))
+    self.assertEqual(y, z)
+
+  def test_formulas_and_arrows_are_dictionary_keys(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    d = {x: 'x', x.forwardCommute(): 'commute'}
+    self.assertEqual('x', d[formula.And(self.b_of_a, self.d_of_c)])
+    self.assertEqual('commute', d[formula.And(self.b_of_a, self.d_of_c).forwardCommute()])
+    self.assertFalse(x.forwardCommute().invert() in d)
+
+class FreeVariablesTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_free_variables(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, self.d_of_c))
+    free = x.freeVariables()
+    self.assertTrue(self.b in free)
+    self.assertTrue(self.c in free)
+    self.assertTrue(self.d in free)
+    self.assertFalse(self.a in free)
+    self.assertEqual(3, len(free))
+    self.assertEqual(set([self.b, self.c, self.d]), set(free))
+    self.assertEqual(free, x.freeVariables())
+
+  def test_set_operations(self):
+    free = formula.And(self.b_of_a, self.d_of_c).freeVariables()
+    self.assertEqual(set([self.b, self.c, self.d]), set(free.difference([self.a])))
+    self.assertEqual(set([self.a, self.b]), set(free.intersection(self.b_of_a.freeVariables())))
+    self.assertTrue(self.e in free.union([self.e]))
+    self.assertTrue(free.isdisjoint([self.e]))
+    self.assertFalse(formula.true.freeVariables())
+
+class CanonicalTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_alpha_equivalent_formulas_share_canonical_forms(self):
+    x = formula.Exists(self.a, formula.Exists(self.c,
+      formula.And(self.b_of_a, formula.Always(formula.Holds(self.c, self.a)))))
+    y = formula.Exists(self.c, formula.Exists(self.e,
+      formula.And(formula.Always(formula.Holds(self.c, self.b)),
+        formula.Always(formula.Holds(self.e, self.c)))))
+    self.assertTrue(x.canonical() is y.canonical())
+    self.assertEqual(x, y)
+
+  def test_binders_are_distinguished(self):
+    x = formula.Exists(self.a, formula.Exists(self.c, formula.Holds(self.a, self.c)))
+    y = formula.Exists(self.a, formula.Exists(self.c, formula.Holds(self.c, self.a)))
+    self.assertNotEqual(x, y)
+    shadowed = formula.Exists(self.a, formula.Exists(self.a, formula.Holds(self.a, self.b)))
+    vacuous = formula.Exists(self.c, formula.Exists(self.a, formula.Holds(self.a, self.b)))
+    self.assertEqual(shadowed, vacuous)
+    self.assertNotEqual(shadowed, formula.Exists(self.a, formula.Exists(self.c,
+      formula.Holds(self.a, self.b))))
+
+  def test_canonical_forms_ignore_presentation(self):
+    self.assertEqual(formula.Exists(self.a, formula.Identical(self.a, self.b)),
+        formula.Exists(self.c, formula.Identical(self.b, self.c)))
+    self.assertEqual(formula.Not(self.b_of_a), formula.Not(self.b_of_a, rendered = True))
+    self.assertTrue(self.b_of_a.canonical() is self.b_of_a)
+
+class SubstituteTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_substitution_is_simultaneous(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    self.assertTrue(x.substitute({self.a: self.c, self.c: self.a}) is
+        formula.And(formula.Always(formula.Holds(self.c, self.b)),
+          formula.Always(formula.Holds(self.a, self.d))))
+
+  def test_unchanged_subformulas_are_shared(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    y = x.substitute({self.c: self.e})
+    self.assertTrue(y.left is self.b_of_a)
+    self.assertTrue(x.substitute({self.e: self.a}) is x)
+
+  def test_bound_variables_are_not_substituted(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, self.d_of_c))
+    y = x.substitute({self.a: self.e, self.c: self.e})
+    self.assertTrue(y.value.left is self.b_of_a)
+    self.assertTrue(self.e in y.freeVariables())
+    self.assertRaises(Exception, x.substitute, {self.c: self.a})
+
+class LayoutTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_nodes_have_no_dict(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, formula.Not(self.d_of_c)))
+    arrow = x.forwardOnBody(x.value.forwardCommute())
+    for node in [x, x.value, x.value.right, self.b_of_a, self.a, arrow, arrow.arrow]:
+      self.assertFalse(hasattr(node, '__dict__'))
+
+  def test_pickled_formulas_are_interned(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, formula.Not(self.d_of_c, True)))
+    for protocol in [0, 2]:
+      self.assertTrue(pickle.loads(pickle.dumps(x, protocol)) is x)
+
+  def test_pickled_arrows_are_equal(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, self.d_of_c))
+    arrow = x.forwardOnBody(x.value.forwardCommute())
+    for protocol in [0, 2]:
+      y = pickle.loads(pickle.dumps(arrow, protocol))
+      self.assertEqual(arrow, y)
+      self.assertTrue(y.src is arrow.src)
+      self.assertTrue(y.tgt is arrow.tgt)
+
+class ValidationTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def tearDown(self):
+    formula.setValidationPolicy(formula.eagerValidation)
+    formula.discardObligations()
+
+  def invalid(self):
+    return formula.Composite(self.b_of_a.identity(), self.d_of_c.identity())
+
+  def test_eager(self):
+    self.assertRaises(Exception, self.invalid)
+
+  def test_deferred(self):
+    formula.setValidationPolicy(formula.deferredValidation)
+    formula.Composite(self.b_of_a.identity(), self.b_of_a.identity())
+    formula.check()
+    invalid = self.invalid()
+    self.assertRaises(Exception, formula.check)
+    self.assertRaises(Exception, formula.check)
+    self.assertEqual([invalid], formula.discardObligations())
+    formula.check()
+
+  def test_sampled(self):
+    formula.setValidationPolicy(formula.sampledValidation, sampleRate = 2)
+    self.invalid()
+    self.assertRaises(Exception, self.invalid)
+
+  def test_off(self):
+    formula.setValidationPolicy(formula.noValidation)
+    self.invalid()
+    formula.check()
+
+  def test_unknown_policy(self):
+    self.assertRaises(Exception, formula.setValidationPolicy, 'sometimes')
+
+class ArrowChainTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.x = formula.And(self.b_of_a, self.d_of_c)
+    self.commute = self.x.forwardCommute()
+    self.commuteBack = self.commute.tgt.forwardCommute()
+
+  # return: a chain of n arrows, alternately commuting self.x and commuting it back.
+  def chain(self, n):
+    arrow = self.commute
+    for i in range(1, n):
+      if i % 2 == 0:
+        arrow = arrow.forwardCompose(self.commute)
+      else:
+        arrow = arrow.forwardCompose(self.commuteBack)
+    return arrow
+
+  def test_compositions_are_flat(self):
+    tail = self.commuteBack.forwardCompose(self.chain(2))
+    arrow = self.chain(2).forwardCompose(tail.backwardCompose(self.commute))
+    self.assertTrue(arrow.__class__ == formula.ArrowChain)
+    self.assertEqual(6, len(arrow.arrows()))
+    self.assertEqual(self.chain(6), arrow)
+
+  def test_composite_interface(self):
+    arrow = formula.Composite(self.chain(2), self.commute)
+    self.assertTrue(arrow.right is self.commute)
+    self.assertEqual(self.chain(2), arrow.left)
+    self.assertTrue(arrow.left.left is self.commute)
+    self.assertTrue(arrow.left.right is self.commuteBack)
+
+  def test_chains_sharing_arrows_are_independent(self):
+    base = self.chain(2)
+    a = base.forwardCompose(self.commute)
+    b = base.forwardCompose(self.x.identity())
+    self.assertEqual(2, len(base.arrows()))
+    self.assertTrue(a.right is self.commute)
+    self.assertTrue(b.right.__class__ == formula.Id)
+    self.assertEqual(self.x, base.tgt)
+    self.assertEqual(self.commute.tgt, a.tgt)
+
+  def test_long_chains(self):
+    arrow = self.chain(20001)
+    self.assertEqual(self.commute, arrow.compress())
+    self.assertEqual(20001, len(arrow.invert().arrows()))
+    self.assertEqual(self.chain(20001), arrow)
+    self.assertNotEqual(self.chain(20003), arrow)
+
+  def test_invalid_composition(self):
+    self.assertRaises(Exception, self.chain(2).forwardCompose, self.commuteBack)
+
+class CompressionTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    formula.resetCompressionStatistics()
+
+  def tearDown(self):
+    if formula.compressionStatistics().has_key('commuteForget'):
+      formula.removeCompressionRule('commuteForget')
+
+  def test_copy_forget(self):
+    arrow = self.b_of_a.forwardCopy().forwardFollow(lambda x: x.forwardForgetLeft())
+    self.assertEqual(self.b_of_a.identity(), arrow.compress())
+    self.assertEqual(2, formula.compressionStatistics()['copyForget'])
+
+  def test_cojoin_unalways(self):
+    arrow = self.b_of_a.forwardCojoin().forwardFollow(lambda x: x.forwardUnalways())
+    self.assertEqual(self.b_of_a.identity(), arrow.compress())
+    self.assertEqual(2, formula.compressionStatistics()['cojoinUnalways'])
+
+  def test_inverse(self):
+    x = formula.And(formula.And(self.b_of_a, self.d_of_c), self.b_of_a)
+    arrow = x.forwardAssociate().forwardFollow(lambda x: x.forwardAssociateOther())
+    self.assertEqual(x.identity(), arrow.compress())
+    self.assertEqual(2, formula.compressionStatistics()['inverseRight'])
+
+  def test_nested(self):
+    x = formula.Always(formula.And(self.b_of_a, self.d_of_c))
+    arrow = x.forwardOnAlways(x.value.forwardCommute()).forwardFollow(lambda x:
+        x.forwardOnAlways(x.value.forwardCommute()))
+    self.assertEqual(x.identity(), arrow.compress())
+    statistics = formula.compressionStatistics()
+    self.assertEqual(2, statistics['commutes'])
+    self.assertEqual(2, statistics['OnAlways'])
+
+  def test_compressed_arrows_are_kept(self):
+    x = formula.Always(formula.And(self.b_of_a, self.d_of_c))
+    arrow = x.forwardOnAlways(x.value.forwardCommute())
+    self.assertTrue(arrow is arrow.compress())
+
+  def test_added_rule(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    arrow = x.forwardCommute().forwardFollow(lambda x: x.forwardForgetLeft())
+    self.assertEqual(arrow, arrow.compress())
+    formula.addCompressionRule('commuteForget',
+        lambda left, right: [formula.Forget(src = left.src, tgt = right.tgt)],
+        formula.Commute, formula.Forget)
+    self.assertEqual(x.forwardForgetRight(), arrow.compress())
+    self.assertEqual(1, formula.compressionStatistics()['commuteForget'])
+    self.assertRaises(Exception, formula.addCompressionRule, 'commuteForget', lambda left, right: None)
+
+class TraversalTest(unittest.TestCase, common_objects.CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  # return: n nested quantifiers, alternately over self.a and self.c, around self.b_of_a.
+  def deep(self, n):
+    x = self.b_of_a
+    for i in range(n):
+      if i % 2 == 0:
+        x = formula.Not(formula.Exists(self.a, x))
+      else:
+        x = formula.Not(formula.Exists(self.c, x))
+    return x
+
+  def test_deep_formulas(self):
+    self.assertTrue(sys.getrecursionlimit() <= 1000)
+    x = self.deep(5000)
+    self.assertTrue(x is self.deep(5000))
+    self.assertEqual(x, x.updateVariables())
+    self.assertTrue(x.substituteVariable(self.a, self.e) is x)
+    y = formula.And(x, self.d_of_c)
+    self.assertEqual(formula.And(x, formula.Always(formula.Holds(self.c, self.e))),
+        y.substituteVariable(self.d, self.e))
+    self.assertEqual(5000, repr(x).count('~'))
+    self.assertEqual(set([self.b]), set(x.freeVariables()))
+
+  # return: n nested functorial arrows, alternately OnNot and OnBody, around arrow.
+  def deepArrow(self, n, arrow):
+    for i in range(n):
+      if i % 2 == 0:
+        arrow = formula.OnBody(variable = self.a, arrow = arrow)
+      else:
+        arrow = formula.OnNot(arrow)
+    return arrow
+
+  def test_deep_arrows(self):
+    x = formula.And(self.b_of_a, self.d_of_c)
+    arrow = self.deepArrow(4000, x.identity())
+    self.assertEqual(arrow.src.identity(), arrow.compress())
+    arrow = self.deepArrow(1200, x.forwardCommute())
+    self.assertEqual(arrow, arrow.compress())
+    substituted = arrow.substituteVariable(self.d, self.e)
+    self.assertEqual(arrow.src.substituteVariable(self.d, self.e), substituted.src)
+    # The repr of a nested arrow is indented, so its length grows quadratically with depth.
+    self.assertEqual(100, repr(self.deepArrow(200, x.forwardCommute())).count('OnBody {'))
+
+  def test_substitute_on_body(self):
+    x = formula.Exists(self.a, formula.And(self.b_of_a, self.d_of_c))
+    arrow = x.forwardOnBodyFollow(lambda y: y.forwardCommute())
+    substituted = arrow.substituteVariable(self.d, self.e)
+    self.assertTrue(substituted.__class__ == formula.OnBody)
+    self.assertEqual(x.substituteVariable(self.d, self.e), substituted.src)
+    self.assertEqual(self.a, substituted.variable)
+
+  def test_repr_identical_reflexive(self):
+    arrow = formula.IdenticalReflexive(src = formula.Identical(self.a, self.a), tgt = formula.true)
+    self.assertEqual("IdenticalReflexive", repr(arrow))
+    self.assertEqual("IdenticalReflexive inverse", repr(arrow.invert()))
+
+def suite():
+  return unittest.TestSuite([ unittest.makeSuite(InterningTest)
+                            , unittest.makeSuite(HashTest)
+                            , unittest.makeSuite(FreeVariablesTest)
+                            , unittest.makeSuite(CanonicalTest)
+                            , unittest.makeSuite(SubstituteTest)
+                            , unittest.makeSuite(LayoutTest)
+                            , unittest.makeSuite(ValidationTest)
+                            , unittest.makeSuite(ArrowChainTest)
+                            , unittest.makeSuite(CompressionTest)
+                            , unittest.makeSuite(TraversalTest)])
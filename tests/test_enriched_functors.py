@@ -4,6 +4,7 @@
 import unittest
 from calculus.enriched import endofunctor, bifunctor, formula, constructors, spec
 from calculus import variable
+from calculus.basic import formula as basicFormula
 from lib import common_vars
 from tests.common_enriched_objects import CommonObjects
 
@@ -170,7 +171,278 @@ class TransportTest(AbstractTransportTest, CommonObjects):
         bifunctor = bifunctor.And(values, leftIndex = 2, rightIndex = 1).precomposeLeft(
           left = left))
 
+class SubstituteTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_substitute_all_variables_in_body(self):
+    x = constructors.Exists([ constructors.OrdinaryVariableBinding(self.d)
+                            , constructors.OrdinaryVariableBinding(self.e)],
+                            constructors.And([self.W, self.Y, self.Z]))
+    y = x.substituteAllVariablesInBody([self.e, self.d])
+    self.assertTrue(y.values[0] is self.W)
+    self.assertEqual(constructors.And([self.W, self.Z, self.Y]).translate(), y.translate())
+    self.assertTrue(endofunctor.fully_substituted([self.d, self.e], x) is x.value)
+
+class ClaimDatabaseTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    d = constructors.OrdinaryVariableBinding(self.d)
+    e = constructors.OrdinaryVariableBinding(self.e)
+    self.F1 = constructors.Always(constructors.Forall([d], constructors.Holds(self.d, self.b)))
+    self.F2 = constructors.Always(constructors.Forall([d, e], constructors.Holds(self.d, self.e)))
+    self.D = constructors.Always(constructors.Forall([d], constructors.Iff(
+      constructors.Holds(self.d, self.a), constructors.Holds(self.d, self.c))))
+    self.functor = endofunctor.And(values = [self.W, self.F1, self.F2, self.D], index = 0)
+
+  def test_select(self):
+    database = self.functor.claimDatabase()
+    self.assertEqual([self.W, self.F1, self.F2, self.D], database.select())
+    self.assertEqual([self.F1, self.D], database.select(count = 1))
+    self.assertEqual([self.F1], database.select(count = 1, head = formula.Holds))
+    self.assertEqual([self.D], database.select(head = formula.Iff))
+    self.assertEqual([self.W, self.F1], database.select(about = self.b))
+    self.assertEqual([self.F1], database.select(count = 1, about = self.b))
+
+  def test_database_is_shared(self):
+    self.assertTrue(self.functor.claimDatabase() is self.functor.claimDatabase())
+    self.assertTrue(endofunctor.not_functor.compose(self.functor).claimDatabase()
+        is self.functor.claimDatabase())
+
+  def test_indexed_search(self):
+    definitions = endofunctor.DefinitionSearchSpec(constructors.Holds(self.c, self.a))
+    self.assertEqual([self.D], self.functor.indexedSearch(definitions))
+    self.assertEqual(self.functor.search(definitions), self.functor.indexedSearch(definitions))
+    equal = spec.equal_translates_search_spec(self.F2)
+    self.assertEqual([self.F2], self.functor.indexedSearch(equal))
+
+  def test_import_about(self):
+    seen = []
+    def g(xs):
+      seen.append(len(xs))
+      return len(xs) - 1
+    expected = constructors.Iff(constructors.Holds(self.c, self.a),
+        constructors.Holds(self.c, self.c)).translate()
+    for about in [None, self.a]:
+      arrow, value = self.functor.importAbout(variables = [self.c],
+          f = lambda bindings, body: True, g = g, x = self.A, about = about)
+      self.assertEqual(self.functor.onObject(self.A).translate(), arrow.src.translate())
+      self.assertEqual(self.functor.onObject(value).translate(), arrow.tgt.translate())
+      self.assertEqual(expected, value.values[0].value.value.value.translate())
+    self.assertEqual([2, 1], seen)
+
+  def test_lazy_list(self):
+    calls = []
+    def thunk(i):
+      calls.append(i)
+      return i * i
+    xs = endofunctor.LazyList([lambda i=i: thunk(i) for i in range(5)])
+    self.assertEqual(5, len(xs))
+    self.assertEqual(9, xs[3])
+    self.assertEqual(9, xs[3])
+    self.assertEqual(16, xs[-1])
+    self.assertEqual([3, 4], calls)
+    self.assertEqual([0, 1, 4, 9, 16], list(xs))
+
+class SameStructureTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_same_structure(self):
+    self.assertTrue(endofunctor.same_structure(self.W_and_X,
+      constructors.And([self.Y, self.Z])))
+    self.assertTrue(endofunctor.same_structure(constructors.Holds(self.a, self.b),
+      constructors.Holds(self.c, self.d)))
+    self.assertEqual(self.W_and_X.structuralSignature(),
+        constructors.And([self.Y, self.Z]).structuralSignature())
+
+  def test_different_structure(self):
+    self.assertFalse(endofunctor.same_structure(self.W_and_X,
+      constructors.And([self.Y, constructors.Not(self.Z)])))
+    self.assertFalse(endofunctor.same_structure(self.W_and_X,
+      constructors.Or([self.Y, self.Z])))
+    self.assertFalse(endofunctor.same_structure(self.W_and_X,
+      constructors.And([self.Y, self.Z, self.Z])))
+    self.assertFalse(endofunctor.same_structure(self.W,
+      constructors.Always(constructors.Identical(self.a, self.b))))
+
+  def test_unstructured(self):
+    x = constructors.Exists([constructors.OrdinaryVariableBinding(self.d)], self.W)
+    self.assertEqual(None, x.structuralSignature())
+    self.assertFalse(endofunctor.same_structure(x, x))
+
+  def test_definitions(self):
+    d = constructors.OrdinaryVariableBinding(self.d)
+    holds = constructors.Always(constructors.Forall([d], constructors.Iff(
+      constructors.Holds(self.d, self.a), self.W)))
+    conjunction = constructors.Always(constructors.Forall([d], constructors.Iff(
+      constructors.And([constructors.Holds(self.d, self.a), constructors.Holds(self.d, self.b)]),
+      self.W)))
+    functor = endofunctor.And(values = [holds, self.X, conjunction], index = 0)
+    for x, expected in [ (constructors.Holds(self.c, self.e), [holds])
+                       , (constructors.And([self.W, self.X]), [])
+                       , (constructors.And([constructors.Holds(self.c, self.e),
+                           constructors.Holds(self.e, self.c)]), [conjunction]) ]:
+      definitions = endofunctor.DefinitionSearchSpec(x)
+      self.assertEqual(expected, functor.indexedSearch(definitions))
+      self.assertEqual(expected, functor.search(definitions))
+
+class EqualityTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    d = constructors.OrdinaryVariableBinding(self.d)
+    self.formulas = [ self.W, self.W_and_X, self.W_AND_X_and_Y_and_Z
+                    , constructors.And([]), constructors.Or([self.W, self.Y])
+                    , constructors.Not(constructors.Or([self.W, self.X]))
+                    , constructors.Equal(self.a, self.b)
+                    , constructors.Hidden(constructors.And([self.Y, self.Z]), 'hidden')
+                    , constructors.Forall([d], constructors.Holds(self.d, self.a))
+                    , self.exists_a_in_domain_b_X_and_Y_and_Z
+                    , self.exists_wd_a_in_domain_b_X_and_Y_and_Z
+                    , constructors.Iff(self.W, self.X) ]
+
+  def test_hash_parts_agree_with_translation(self):
+    for x in self.formulas:
+      self.assertEqual(x.translate().hashParts(), x.hashParts())
+      self.assertEqual(hash(x.translate()), hash(x))
+
+  def test_unequal_formulas_are_not_translated(self):
+    xs = [constructors.And([self.W, self.X]), constructors.And([self.W, self.Y]),
+        constructors.Not(self.X), constructors.Always(constructors.Identical(self.c, self.d))]
+    for x in xs:
+      for y in xs:
+        self.assertEqual(x is y, x == y)
+    for x in xs:
+      self.assertFalse(hasattr(x, '_cached_translate'))
+
+  def test_same_construction_is_not_translated(self):
+    x = constructors.And([self.W, constructors.Not(self.X)])
+    y = constructors.And([self.W, constructors.Not(self.X)])
+    self.assertTrue(x == y)
+    self.assertFalse(hasattr(x, '_cached_translate'))
+    self.assertFalse(hasattr(y, '_cached_translate'))
+
+  def test_equal_translations(self):
+    p = common_vars.p()
+    f = constructors.OrdinaryVariableBinding(p)
+    d = constructors.OrdinaryVariableBinding(self.d)
+    pairs = [ (constructors.And([self.W, constructors.And([self.X, self.Y])]),
+               constructors.And([self.W, self.X, self.Y]))
+            , (constructors.Hidden(self.W, 'W'), self.W)
+            , (constructors.Exists([d], constructors.Holds(self.d, self.a)),
+               constructors.Exists([f], constructors.Holds(p, self.a)))
+            , (constructors.Equal(self.a, self.b), constructors.Equal(self.b, self.a)) ]
+    formula.setEqualityCrossCheck(True)
+    try:
+      for x, y in pairs:
+        self.assertEqual(hash(x), hash(y))
+        self.assertTrue(x == y)
+        self.assertTrue(y == x)
+      for x in self.formulas:
+        for y in self.formulas:
+          self.assertEqual(x is y, x == y)
+    finally:
+      formula.setEqualityCrossCheck(False)
+
+class RearrangeTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def assertSingleArrow(self, arrow):
+    self.assertEqual(basicFormula.Rearrange, arrow.basicArrow.__class__)
+
+  def test_move(self):
+    x = constructors.And([self.W, self.X, self.Y, self.Z])
+    arrow = x.forwardMoveForward(0, 2)
+    self.assertEqual(constructors.And([self.X, self.Y, self.W, self.Z]), arrow.tgt)
+    self.assertSingleArrow(arrow)
+    arrow = x.forwardMoveBack(3, 3)
+    self.assertEqual(constructors.And([self.Z, self.W, self.X, self.Y]), arrow.tgt)
+    self.assertSingleArrow(arrow)
+
+  def test_remove_units(self):
+    x = constructors.Or([constructors.Or([]), self.W,
+      constructors.Or([self.X, self.Y]), constructors.Or([])])
+    arrow = x.forwardRemoveUnits()
+    self.assertEqual(constructors.Or([self.W, self.X, self.Y]), arrow.tgt)
+    self.assertSingleArrow(arrow)
+    self.assertEqual(x, x.backwardIntroduceUnits().tgt)
+
+  def test_wide_permutation(self):
+    n = 300
+    values = [constructors.Always(constructors.Holds(self.a, variable.StringVariable('v%s'%(i,))))
+        for i in range(n)]
+    x = constructors.And(values)
+    arrow = x.forwardPermute(range(n)[::-1])
+    self.assertEqual(constructors.And(values[::-1]), arrow.tgt)
+    self.assertSingleArrow(arrow)
+    self.assertEqual(x, arrow.forwardCompose(arrow.tgt.forwardPermute(range(n)[::-1])).tgt)
+
+  def test_invalid(self):
+    x = constructors.And([self.W, self.X])
+    self.assertRaises(Exception, x.forwardRearrange, constructors.And([self.W, self.W]))
+    self.assertRaises(Exception, x.forwardRearrange, constructors.Or([self.X, self.W]))
+    self.assertRaises(Exception, x.forwardPermute, [0, 0])
+
+class PermuteExistsTest(unittest.TestCase, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.bindings = [ constructors.BoundedVariableBinding(self.c, self.b)
+                    , constructors.OrdinaryVariableBinding(self.d)
+                    , constructors.BoundedVariableBinding(self.e, self.b) ]
+    self.x = constructors.Exists(self.bindings, constructors.And([self.X, self.Y, self.Z]))
+
+  def test_permute(self):
+    arrow = self.x.forwardPermute([2, 0, 1])
+    self.assertEqual(basicFormula.PermuteExists, arrow.basicArrow.__class__)
+    self.assertEqual(constructors.Exists([self.bindings[2], self.bindings[0], self.bindings[1]],
+      self.x.value), arrow.tgt)
+    self.assertEqual(self.x.translate(), arrow.basicArrow.invert().tgt)
+
+  def test_push_and_split(self):
+    arrow = self.x.forwardPushAndSplit(0)
+    self.assertEqual(constructors.Exists(self.bindings[1:],
+      constructors.Exists(self.bindings[:1], self.x.value)), arrow.tgt)
+
+  def test_compress(self):
+    arrow = self.x.forwardPush(0).forwardFollow(lambda x:
+        x.forwardPush(1))
+    compressed = arrow.basicArrow.compress()
+    self.assertEqual(basicFormula.PermuteExists, compressed.__class__)
+    self.assertEqual([1, 2, 0], compressed.permutation)
+    arrow = self.x.forwardPush(1).forwardFollow(lambda x:
+        x.forwardPush(1))
+    self.assertEqual(self.x.translate().identity(), arrow.basicArrow.compress())
+
+  def test_dependent_domain(self):
+    x = constructors.Exists([ constructors.OrdinaryVariableBinding(self.b)
+                            , constructors.BoundedVariableBinding(self.c, self.b) ], self.X)
+    self.assertRaises(Exception, x.forwardPermute, [1, 0])
+
+  def test_repeated_variable(self):
+    # Exists c . (c : b | Exists c . X) must not become Exists c . Exists c . (c : b | X)
+    x = constructors.Exists([constructors.BoundedVariableBinding(self.c, self.b)],
+        constructors.Exists([constructors.OrdinaryVariableBinding(self.c)], self.X))
+    binders = [ x.bindings[0].basicBinder()
+              , x.value.bindings[0].basicBinder() ]
+    body = x.value.value.translate()
+    self.assertRaises(Exception, basicFormula.PermuteExists,
+        src = basicFormula.bindAll(binders, body),
+        tgt = basicFormula.bindAll(binders[::-1], body),
+        binders = binders, permutation = [1, 0])
+
+  def test_unsupported_binding(self):
+    x = constructors.Exists([ constructors.OrdinaryVariableBinding(self.d)
+                            , constructors.WelldefinedVariableBinding(self.a, self.b) ], self.X)
+    self.assertRaises(Exception, x.forwardPermute, [1, 0])
+
 def suite():
   return unittest.TestSuite( [ unittest.makeSuite(TransportTest)
                              , unittest.makeSuite(SearchTest)
+                             , unittest.makeSuite(SubstituteTest)
+                             , unittest.makeSuite(ClaimDatabaseTest)
+                             , unittest.makeSuite(SameStructureTest)
+                             , unittest.makeSuite(EqualityTest)
+                             , unittest.makeSuite(RearrangeTest)
+                             , unittest.makeSuite(PermuteExistsTest)
                              ])
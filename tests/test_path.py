@@ -3,7 +3,8 @@
 
 import unittest
 from calculus import variable
-from calculus.enriched import path, constructors, formula, spec
+from calculus.basic import formula as basicFormula
+from calculus.enriched import path, constructors, formula, spec, endofunctor
 from lib import common_vars
 from tests.common_enriched_objects import CommonObjects
 
@@ -86,5 +87,154 @@ class PathSearchTest(AbstractPathSearchTest, CommonObjects):
     self.assert_exact_path_search_succeeds_once(src_path = self.WDEP1,
         formula = self.B)
 
+class SearchCacheTest(AbstractPathSearchTest, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.visited = []
+    self.spec = spec.SimpleSearchSpec(self.visit)
+    self.P0 = path.new_path(self.W_AND_X_and_Y_and_Z)
+    self.P1 = self.P0.advance(1).tgt.advance().tgt
+
+  def visit(self, x):
+    self.visited.append(x)
+    return True
+
+  def test_repeated_search(self):
+    first = self.P1.search(self.spec)
+    visited = len(self.visited)
+    self.assertTrue(visited > 0)
+    second = self.P1.search(self.spec)
+    self.assertEqual(visited, len(self.visited))
+    self.assertEqual([B for B, f in first], [B for B, f in second])
+
+  def test_advance_searches_one_layer(self):
+    before = self.P1.search(self.spec)
+    visited = len(self.visited)
+    P2 = self.P1.advance(0).tgt
+    after = P2.search(self.spec)
+    self.assertEqual(len(after) - len(before), len(self.visited) - visited)
+    self.assertEqual([B for B, f in before], [B for B, f in after][:len(before)])
+
+  def test_retreat_reuses_search(self):
+    P2 = self.P1.advance(0).tgt
+    P2.search(self.spec)
+    visited = len(self.visited)
+    P1 = P2.retreat().tgt
+    self.assertTrue(P1.endofunctor is self.P1.endofunctor)
+    P1.search(self.spec)
+    self.assertEqual(visited, len(self.visited))
+
+  def test_dropped_specs_are_not_cached(self):
+    for i in range(10):
+      self.P1.search(spec.SimpleSearchSpec(self.visit))
+    self.P1.search(self.spec)
+    functor = self.P1.endofunctor
+    while True:
+      self.assertTrue(len(functor._searches) <= 2)
+      if not isinstance(functor, endofunctor.Composite):
+        break
+      self.assertTrue(len(functor.left._searches) <= 2)
+      functor = functor.right
+
+  def test_deferred_import(self):
+    result = self.P1.search(spec.equal_translates_search_spec(self.W))
+    self.assertEqual(1, len(result))
+    B, f = result[0]
+    self.assertValidPathArrow(f())
+
+class TrustedArrowTest(AbstractPathSearchTest, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+    self.level = formula.auditLevel()
+    # An arrow whose basic arrow does not match its src and tgt.
+    self.bogus = (self.W, self.X, self.X.translate().identity())
+
+  def tearDown(self):
+    formula.setAuditLevel(self.level)
+
+  def trusted(self):
+    src, tgt, basicArrow = self.bogus
+    return formula.trustedArrow(src = src, tgt = tgt, basicArrow = basicArrow)
+
+  def test_audit_all(self):
+    formula.setAuditLevel(formula.auditAll)
+    self.assertRaises(Exception, self.trusted)
+
+  def test_audit_none(self):
+    formula.setAuditLevel(formula.auditNone)
+    self.trusted()
+    src, tgt, basicArrow = self.bogus
+    self.assertRaises(Exception,
+        lambda: formula.Arrow(src = src, tgt = tgt, basicArrow = basicArrow))
+
+  def test_audit_sampled(self):
+    formula.setAuditLevel(formula.auditSampled, sampleRate = 3)
+    self.trusted()
+    self.trusted()
+    self.assertRaises(Exception, self.trusted)
+    self.trusted()
+
+  def test_audit_ignores_validation_policy(self):
+    basicFormula.setValidationPolicy(basicFormula.noValidation)
+    try:
+      formula.setAuditLevel(formula.auditAll)
+      self.assertRaises(Exception, self.trusted)
+      formula.setAuditLevel(formula.auditSampled, sampleRate = 2)
+      self.trusted()
+      self.assertRaises(Exception, self.trusted)
+    finally:
+      basicFormula.setValidationPolicy(basicFormula.eagerValidation)
+
+  def test_bad_audit_level(self):
+    self.assertRaises(Exception, lambda: formula.setAuditLevel('sometimes'))
+    self.assertRaises(Exception, lambda: formula.setAuditLevel(formula.auditSampled, 0))
+
+  def test_composed_path_arrows(self):
+    formula.setAuditLevel(formula.auditAll)
+    P0 = path.new_path(self.W_AND_X_and_Y_and_Z)
+    arrow = P0.advance(1).forwardFollow(lambda p:
+        p.advance().forwardFollow(lambda p:
+          p.simplifyBottom().forwardFollow(lambda p:
+            p.retreat())))
+    self.assertValidPathArrow(arrow)
+    self.assertEqualPaths(P0, arrow.src)
+
+class IncrementalSimplifyTest(AbstractPathSearchTest, CommonObjects):
+  def setUp(self):
+    self.add_common_objects()
+
+  def test_moves_share_top(self):
+    P0 = path.new_path(self.W_AND_X_and_Y_and_Z)
+    arrow = P0.advance(1).forwardFollow(lambda p:
+        p.advance().forwardFollow(lambda p:
+          p.retreat()))
+    self.assertValidPathArrow(arrow)
+    self.assertTrue(arrow.tgt.top() is P0.top())
+    self.assertTrue(P0.retreatTotally().tgt.top() is P0.top())
+
+  def test_simplification_is_cached(self):
+    x = constructors.Or([self.W_and_X, constructors.And([self.Y, constructors.And([])])])
+    arrow = x.forwardSimplify()
+    self.assertTrue(arrow is x.forwardSimplify())
+    self.assertEqual(constructors.Or([self.W_and_X, self.Y]), arrow.tgt)
+    # The branch in normal form is not rebuilt.
+    self.assertTrue(arrow.tgt.values[0] is self.W_and_X)
+
+  def test_normal_form_is_unchanged(self):
+    x = constructors.Not(constructors.Exists(
+      [constructors.BoundedVariableBinding(self.c, self.b)], self.W_and_X))
+    self.assertTrue(x.forwardSimplify().tgt is x)
+    self.assertTrue(x.backwardSimplify().src is x)
+
+  def test_simplify_bottom_skips_normal_form(self):
+    P0 = path.new_path(self.W_and_X)
+    arrow = P0.simplifyBottom()
+    self.assertValidPathArrow(arrow)
+    self.assertTrue(arrow.tgt.bottom() is self.W_and_X)
+    self.assertTrue(arrow.tgt.top() is P0.top())
+
 def suite():
-  return unittest.makeSuite(PathSearchTest)
+  return unittest.TestSuite([ unittest.makeSuite(PathSearchTest)
+                            , unittest.makeSuite(SearchCacheTest)
+                            , unittest.makeSuite(TrustedArrowTest)
+                            , unittest.makeSuite(IncrementalSimplifyTest)])